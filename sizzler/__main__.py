@@ -7,33 +7,55 @@ Check running environment:
     * ensure 3rd party packages installed.
 """
 
+import time
+STARTED = time.monotonic()
+
 import sys
 if sys.version_info < (3, 5):
     print("Error: you have to run Sizzler with Python 3.5 or higher version.")
     exit(1)
 
-try:
-    import websockets
-    import nacl
-    import yaml
-except:
+# Only check for the packages here, they are imported once needed, so that
+# the interface is up before the (slower) imports of websockets and nacl.
+import importlib.util
+if not all([
+    importlib.util.find_spec(name) for name in ["websockets", "nacl", "yaml"]
+]):
     print("Error: one or more 3rd party package(s) not installed.")
     print("To fix this, run:\n sudo pip3 install -r requirements.txt")
     exit(1)
 
 import os
+import signal
 import asyncio
 import logging
 
 from .util.root import RootPriviledgeManager
 from .util.cmdline import parseCommandLineArguments
-from .config.parser import loadConfigFile
+from .util.workers import forkWorkers, WorkerExchange
+from .util.runtime import useEventLoop, tuneEventLoop
+from .config.parser import loadConfigFile, getSessionOptions, \
+    getQueueOptions, getPriorityOptions, getRouterOptions, getMTU, \
+    getShapingOptions, getClientURIs
 from .tun import SizzlerVirtualNetworkInterface
-from .transport.wsserver import WebsocketServer
-from .transport.wsclient import WebsocketClient
+from .metrics import METRICS
+from .capture import CAPTURE
+
+def elapsed():
+    # milliseconds since start
+    return (time.monotonic() - STARTED) * 1000
 
 def main():
 
+    """
+    --------------------------------------------------------------------------
+    Signals for the capture (see capture.py) are handled once the event loop
+    runs, until then they must not end the process.
+    """
+
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
     """
     --------------------------------------------------------------------------
     Parse command line arguments.
@@ -55,6 +77,13 @@ def main():
         print("Error: you need to run sizzler with root priviledge.")
         exit(1)
 
+    """
+    --------------------------------------------------------------------------
+    Choose the event loop before anything gets bound to one.
+    """
+
+    useEventLoop(CONFIG["runtime"]["loop"])
+
     """
     --------------------------------------------------------------------------
     With root priviledge, we have to set up TUN device as soon as possible.
@@ -62,8 +91,29 @@ def main():
 
     tun = SizzlerVirtualNetworkInterface(
         ip=CONFIG["ip"]["client" if ROLE == "client" else "server"],
-        dstip=CONFIG["ip"]["server" if ROLE == "client" else "client"]
+        dstip=CONFIG["ip"]["server" if ROLE == "client" else "client"],
+        engine=CONFIG["tun"]["engine"],
+        offload=CONFIG["tun"]["offload"],
+        mtu=getMTU(CONFIG),
+        clamp=CONFIG["tun"]["clamp"],
+        fair=ROLE == "server" and CONFIG["shaping"]["fair"],
+        queues=CONFIG["workers"],
+        queueOptions=getQueueOptions(CONFIG),
+        routerOptions=getRouterOptions(CONFIG),
+        priorityOptions=getPriorityOptions(CONFIG)
     )
+    logging.info("Interface up after %.1f ms." % elapsed())
+
+    """
+    --------------------------------------------------------------------------
+    Load the transport, while we can still read files of any owner.
+    """
+
+    if ROLE == "client":
+        from .transport.wsclient import WebsocketClient
+    else:
+        from .transport.wsserver import WebsocketServer
+        from .transport.udpserver import DatagramServer
 
     """
     --------------------------------------------------------------------------
@@ -78,30 +128,86 @@ def main():
         print(e)
         exit(1)
 
+    """
+    --------------------------------------------------------------------------
+    In multi-worker mode, fork the workers now. Each one serves one queue of
+    the TUN device with its own event loop and connections, and hands
+    packets over to the others while it has no connections itself.
+    """
+
+    worker = 0
+    if CONFIG["workers"] > 1:
+        exchange = WorkerExchange(CONFIG["workers"])
+        worker = forkWorkers(CONFIG["workers"])
+        exchange.select(worker)
+        tun.selectQueue(worker, exchange)
+
+    cpu = CONFIG["runtime"]["cpu"]
+    tuneEventLoop(
+        asyncio.get_event_loop(),
+        executor=CONFIG["runtime"]["executor"],
+        cpu=None if cpu is None else cpu + worker
+    )
+
     """
     --------------------------------------------------------------------------
     Start the server or client.
     """
 
     if ROLE == "client":
-        transport = WebsocketClient(uris=CONFIG["client"], key=CONFIG["key"])
+        uris, fallbacks = getClientURIs(CONFIG)
+        transports = [WebsocketClient(
+            uris=uris,
+            key=CONFIG["key"],
+            sessionOptions=getSessionOptions(CONFIG),
+            standby=CONFIG["standby"],
+            resume=CONFIG["session"]["resume"],
+            shaping=getShapingOptions(CONFIG),
+            fallbacks=fallbacks
+        )]
 
     else:
-        transport = WebsocketServer(
+        transports = [WebsocketServer(
             host=CONFIG["server"]["host"],
             port=CONFIG["server"]["port"],
-            key=CONFIG["key"]
-        )
-
-    tun.connect(transport)
+            key=CONFIG["key"],
+            sessionOptions=getSessionOptions(CONFIG),
+            reusePort=CONFIG["workers"] > 1,
+            resume=CONFIG["session"]["resume"],
+            shaping=getShapingOptions(CONFIG)
+        )]
+        if CONFIG["server"]["udp"]:
+            transports.append(DatagramServer(
+                host=CONFIG["server"]["host"],
+                port=CONFIG["server"]["udp"],
+                key=CONFIG["key"],
+                sessionOptions=getSessionOptions(CONFIG),
+                reusePort=CONFIG["workers"] > 1,
+                shaping=getShapingOptions(CONFIG)
+            ))
+
+    for transport in transports: tun.connect(transport)
 
     """
     --------------------------------------------------------------------------
     Start event loop.
     """
 
+    services = [tun] + transports
+    if CONFIG["metrics"]["port"]:
+        services.append(METRICS.serve(
+            CONFIG["metrics"]["host"],
+            CONFIG["metrics"]["port"] + worker
+        ))
+
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.gather(tun, transport))
+    capture = CONFIG["capture"]
+    CAPTURE.configure(
+        capture["packets"], capture["snaplen"], capture["directory"])
+    CAPTURE.handleSignals(loop)
+    if capture["armed"]: CAPTURE.arm()
+    loop.call_soon(lambda: logging.info("Started after %.1f ms." % elapsed()))
+    loop.run_until_complete(asyncio.gather(*services))
 
 
 if __name__ == "__main__":
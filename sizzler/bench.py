@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+"""
+------------------------------------------------------------------------------
+Loopback benchmark for Sizzler, runs without root and TUN devices:
+
+    python3 -m sizzler.bench [options]
+
+A server and a client are started in this process and connected over
+localhost. In place of each TUN device a socketpair is used, so packets go
+through the whole datapath: TUN engine, queues, router, sessions, padding,
+encryption and WebSocket. Packets of a configurable size mix are written to
+the client's interface at a given rate, and read from the server's interface
+(or the other way around with --reverse).
+
+Reported are packets/s, Mbit/s (of IP packets), loss, latency percentiles and
+CPU time per packet. CPU time is that of the whole process, i.e. both peers.
+Packets are sent for --duration seconds, then those still queued are waited
+for (up to --drain seconds), so that queueing, e.g. due to shaping, shows in
+latency and throughput, not as loss.
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import logging
+
+from .tun import SizzlerVirtualNetworkInterface, TUN_ENGINES, \
+    _getNonblockingReader, _getNonblockingWriter
+from .transport.wsserver import WebsocketServer
+from .transport.wsclient import WebsocketClient
+from .transport.udpserver import DatagramServer
+from .packet import PACKET_INFO_SIZE
+from .packetqueue import QUEUE_POLICIES, PRIORITY_SCHEDULERS
+from .crypto.crypto import CRYPTO_STRATEGIES
+from .compress import COMPRESSIONS
+from .crypto.padding import PADDING_POLICIES
+from .util.runtime import EVENT_LOOPS, useEventLoop, tuneEventLoop
+from .capture import CAPTURE
+
+KEY = "sizzler-benchmark"
+SMALL_SIZE = 128
+SERVER_IP, CLIENT_IP = "10.1.0.1", "10.1.0.2"
+
+# a probe carries sequence number and time of sending
+PROBE = struct.Struct("<Qd")
+PROBE_HEAD_SIZE = PACKET_INFO_SIZE + 20 + 8 # packet info, IPv4, UDP
+PROBE_MIN_SIZE = PROBE_HEAD_SIZE + PROBE.size - PACKET_INFO_SIZE
+
+# Waiting for queued packets stops once none arrived for this many seconds.
+DRAIN_IDLE = 1
+
+
+def parseArguments(args):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m sizzler.bench",
+        description="""Loopback benchmark of the Sizzler datapath, with
+        socketpairs in place of TUN devices."""
+    )
+    parser.add_argument("--duration", type=float, default=10,
+        help="seconds of measurement (default: 10)")
+    parser.add_argument("--drain", type=float, default=10,
+        help="max. seconds to wait for packets still queued after sending "
+        "(default: 10)")
+    parser.add_argument("--rate", type=float, default=0,
+        help="packets/s to send, 0 for as fast as possible (default: 0)")
+    parser.add_argument("--mix", default="64:7,576:4,1400:1",
+        help="""sizes of IP packets and their weights, as
+        SIZE:WEIGHT,... (default: 64:7,576:4,1400:1)""")
+    parser.add_argument("--flows", type=int, default=16,
+        help="number of distinct UDP flows (default: 16)")
+    parser.add_argument("--connections", type=int, default=1,
+        help="WebSocket connections of the client (default: 1)")
+    parser.add_argument("--standby", type=int, default=0,
+        help="standby connections per client connection (default: 0)")
+    parser.add_argument("--resume", type=int, default=0,
+        help="frames kept for resuming sessions, 0 to disable (default: 0)")
+    parser.add_argument("--reverse", action="store_true",
+        help="send from server to client")
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--udp", action="store_true",
+        help="connect over UDP, on the port after --port")
+    parser.add_argument("--engine", choices=TUN_ENGINES,
+        default="executor")
+    parser.add_argument("--crypto", choices=CRYPTO_STRATEGIES,
+        default="executor")
+    parser.add_argument("--aggregate", type=int, default=0,
+        help="max. bytes of aggregated frames, 0 to disable (default: 0)")
+    parser.add_argument("--linger", type=float, default=0,
+        help="max. seconds to wait for aggregating packets (default: 0)")
+    parser.add_argument("--compress", choices=COMPRESSIONS, default="none",
+        help="compression of frames, packets are filled with zeros")
+    parser.add_argument("--padding", choices=PADDING_POLICIES,
+        default="random")
+    parser.add_argument("--shape", type=int, default=0,
+        help="limit of bytes/s per client and direction, 0 for no limit "
+        "(default: 0)")
+    parser.add_argument("--fair", action="store_true",
+        help="queue received packets per client on the server")
+    parser.add_argument("--capture", default=None, metavar="FILE",
+        help="capture packets while running, and write them to FILE")
+    parser.add_argument("--loop", choices=EVENT_LOOPS, default="asyncio")
+    parser.add_argument("--executor", type=int, default=0,
+        help="threads of the default executor, 0 for CPUs + 1 (default: 0)")
+    parser.add_argument("--cpu", type=int, default=None,
+        help="pin the event loop to this CPU")
+    parser.add_argument("--queue-packets", type=int, default=1000)
+    parser.add_argument("--queue-policy", choices=QUEUE_POLICIES,
+        default="taildrop")
+    parser.add_argument("--priority", choices=["none"] + PRIORITY_SCHEDULERS,
+        default="none", help="priority lanes, small packets are interactive")
+    parser.add_argument("-l", "--loglevel", default="warning",
+        choices=["debug", "warning", "error", "critical", "info"])
+    return parser.parse_args(args)
+
+def parseMix(mix):
+    sizes = []
+    for item in mix.split(","):
+        size, weight = (item.split(":") + ["1"])[:2]
+        size = max(int(size), PROBE_MIN_SIZE)
+        sizes += [size] * int(weight)
+    return sizes
+
+def buildPacket(size, flow, sequence, src, dst):
+    # a TUN packet: packet information, IPv4 and UDP header, probe, filling
+    ipLength = size
+    ip = struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45, 0, ipLength, 0, 0x4000, 64, 17, 0,
+        socket.inet_aton(src), socket.inet_aton(dst)
+    )
+    udp = struct.pack("!HHHH", 10000 + flow, 9, ipLength - 20, 0)
+    probe = PROBE.pack(sequence, time.perf_counter())
+    filling = bytes(ipLength - 20 - 8 - PROBE.size)
+    return b"\x00\x00\x08\x00" + ip + udp + probe + filling
+
+def percentile(values, p):
+    if not values: return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Benchmark:
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.sizes = parseMix(argv.mix)
+        self.sent = 0
+        self.sentBytes = 0
+        self.received = 0
+        self.receivedBytes = 0
+        self.latencies = []
+        self.smallLatencies = []    # of packets up to SMALL_SIZE bytes
+        self.measuring = False
+        self.firstArrival = None
+        # only probes sent while measuring count, once each
+        self.firstSequence, self.lastSequence = None, None
+        self.arrived = set()
+
+    def createInterface(self, ip, dstip, fair=False):
+        # returns the interface, and the socket standing for the network
+        # stack behind it
+        inner, outer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for sock in [inner, outer]:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        outer.setblocking(False)
+        tun = SizzlerVirtualNetworkInterface(
+            ip=ip,
+            dstip=dstip,
+            engine=self.argv.engine,
+            queueOptions={
+                "maxPackets": self.argv.queue_packets,
+                "policy": self.argv.queue_policy,
+            },
+            priorityOptions=None if self.argv.priority == "none" else {
+                "scheduler": self.argv.priority,
+                "small": SMALL_SIZE,
+            },
+            fair=fair,
+            fd=inner.detach()
+        )
+        return tun, outer
+
+    async def send(self, sock, src, dst):
+        # the socket is used like a nonblocking TUN device, which behaves the
+        # same on any event loop (uvloop's sock_recv() is slow on these)
+        write = _getNonblockingWriter(sock.fileno())
+        rate, sequence = self.argv.rate, 0
+        start = time.perf_counter()
+        while True:
+            if rate:
+                due = int((time.perf_counter() - start) * rate) - sequence
+                if due <= 0:
+                    await asyncio.sleep(0.001)
+                    continue
+            else:
+                due = 64
+            for i in range(due):
+                size = self.sizes[sequence % len(self.sizes)]
+                packet = buildPacket(
+                    size, sequence % self.argv.flows, sequence, src, dst)
+                if self.measuring:
+                    if self.firstSequence is None:
+                        self.firstSequence = sequence
+                    self.lastSequence = sequence
+                    self.sent += 1
+                    self.sentBytes += size
+                await write(packet)
+                sequence += 1
+            if not rate: await asyncio.sleep(0)
+
+    async def receive(self, sock):
+        read = _getNonblockingReader(sock.fileno())
+        while True:
+            packet = await read()
+            now = time.perf_counter()
+            if len(packet) < PROBE_HEAD_SIZE + PROBE.size: continue
+            if self.firstArrival is None: self.firstArrival = now
+            sequence, sent = PROBE.unpack_from(packet, PROBE_HEAD_SIZE)
+            if self.firstSequence is None or \
+                    not self.firstSequence <= sequence <= self.lastSequence:
+                continue
+            if sequence in self.arrived: continue
+            self.arrived.add(sequence)
+            self.received += 1
+            self.receivedBytes += len(packet) - PACKET_INFO_SIZE
+            self.latencies.append(now - sent)
+            if len(packet) - PACKET_INFO_SIZE <= SMALL_SIZE:
+                self.smallLatencies.append(now - sent)
+
+    async def run(self):
+        argv = self.argv
+        serverTUN, serverSock = self.createInterface(
+            SERVER_IP, CLIENT_IP, fair=argv.fair)
+        clientTUN, clientSock = self.createInterface(CLIENT_IP, SERVER_IP)
+        sessionOptions = {
+            "aggregateBytes": argv.aggregate,
+            "aggregateLinger": argv.linger,
+            "cryptoStrategy": argv.crypto,
+            "compression": argv.compress,
+            "padding": argv.padding,
+        }
+        shaping = None
+        if argv.shape:
+            shaping = {"clientSend": argv.shape, "clientReceive": argv.shape}
+        server = WebsocketServer(
+            host="127.0.0.1",
+            port=argv.port,
+            key=KEY,
+            sessionOptions=sessionOptions,
+            resume=argv.resume,
+            shaping=shaping
+        )
+        uri = "ws://127.0.0.1:%d/" % argv.port
+        if argv.udp:
+            server = DatagramServer(
+                host="127.0.0.1",
+                port=argv.port + 1,
+                key=KEY,
+                sessionOptions=sessionOptions,
+                shaping=shaping
+            )
+            uri = "udp://127.0.0.1:%d" % (argv.port + 1)
+        client = WebsocketClient(
+            uris=[uri] * argv.connections,
+            key=KEY,
+            sessionOptions=sessionOptions,
+            standby=argv.standby,
+            resume=argv.resume,
+            shaping=shaping
+        )
+        serverTUN.connect(server)
+        clientTUN.connect(client)
+
+        if argv.reverse:
+            source, sink = serverSock, clientSock
+            src, dst = SERVER_IP, CLIENT_IP
+        else:
+            source, sink = clientSock, serverSock
+            src, dst = CLIENT_IP, SERVER_IP
+
+        await server
+        sender = asyncio.ensure_future(self.send(source, src, dst))
+        jobs = [sender] + [
+            asyncio.ensure_future(each) for each in [
+                serverTUN, clientTUN, client, self.receive(sink)
+            ]
+        ]
+        try:
+            # wait until packets get through, then measure
+            for i in range(200):
+                if self.firstArrival: break
+                await asyncio.sleep(0.05)
+            else:
+                raise Exception("No packets got through within 10 seconds.")
+            await asyncio.sleep(1)
+            if argv.capture: CAPTURE.arm()
+            self.measuring = True
+            start, cpuStart = time.perf_counter(), time.process_time()
+            await asyncio.sleep(argv.duration)
+            self.measuring = False
+            elapsed = time.perf_counter() - start
+            sender.cancel()
+            # wait for packets still queued, as long as they keep arriving:
+            # late ones were delivered all the same, at the rate of the path
+            stop = time.perf_counter()
+            while self.received < self.sent and \
+                    time.perf_counter() - stop < argv.drain:
+                received = self.received
+                await asyncio.sleep(min(
+                    DRAIN_IDLE, argv.drain - (time.perf_counter() - stop)))
+                if self.received == received: break
+            cpu = time.process_time() - cpuStart
+        finally:
+            for job in jobs: job.cancel()
+        self.report(elapsed, cpu)
+        if argv.capture:
+            print("packets captured:  %d" % CAPTURE.dump(argv.capture))
+
+    def report(self, elapsed, cpu):
+        latencies = sorted(self.latencies)
+        lost = max(0, self.sent - self.received)
+        print("packets sent:      %d" % self.sent)
+        print("packets received:  %d (%.2f%% lost)" % (
+            self.received, 100.0 * lost / max(1, self.sent)))
+        print("packets/s:         %.0f" % (self.received / elapsed))
+        print("Mbit/s:            %.2f" % (
+            self.receivedBytes * 8 / elapsed / 1e6))
+        print("latency p50:       %.3f ms" % (percentile(latencies, 50) * 1e3))
+        print("latency p99:       %.3f ms" % (percentile(latencies, 99) * 1e3))
+        print("latency p99 small: %.3f ms" % (
+            percentile(sorted(self.smallLatencies), 99) * 1e3))
+        print("CPU per packet:    %.1f us" % (
+            cpu / max(1, self.received) * 1e6))
+
+
+def main():
+    argv = parseArguments(sys.argv[1:])
+    logging.basicConfig(level=argv.loglevel.upper())
+    useEventLoop(argv.loop)
+    loop = asyncio.get_event_loop()
+    tuneEventLoop(loop, executor=argv.executor, cpu=argv.cpu)
+    loop.run_until_complete(Benchmark(argv).run())
+
+
+if __name__ == "__main__":
+    main()
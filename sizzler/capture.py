@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Capture of recent packets for debugging, cheap enough to leave on under
+# load. While armed, packets are copied into a ring buffer allocated once,
+# at the points below: read from and written to the TUN device, and sent and
+# received by a session (with its connection ID). The ring is written to a
+# pcapng file on demand, one interface per point, to be read by Wireshark.
+# While disarmed, each point costs one attribute lookup.
+
+import os
+import time
+import struct
+import signal
+from logging import info, debug, critical, exception
+
+from . import packet
+
+CAPTURE_POINTS = ["tun-read", "tun-write", "ws-send", "ws-receive"]
+CAPTURE_TUN_READ, CAPTURE_TUN_WRITE, CAPTURE_WS_SEND, CAPTURE_WS_RECEIVE = \
+    range(len(CAPTURE_POINTS))
+
+# pcapng, see https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-01.txt
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_COMMENT = 1
+PCAPNG_OPTION_IF_NAME = 2
+LINKTYPE_RAW = 101          # IPv4 or IPv6 packets without link layer
+
+# what's kept for each packet besides its bytes: time, original length,
+# captured length, connection ID, capture point
+CAPTURE_RECORD = struct.Struct("=dIIIB")
+
+
+def _pcapngOption(code, value):
+    padding = b"\x00" * (-len(value) % 4)
+    return struct.pack("<HH", code, len(value)) + value + padding
+
+def _pcapngBlock(blockType, body, options=b""):
+    if options: options += struct.pack("<HH", 0, 0)    # end of options
+    length = 12 + len(body) + len(options)
+    return b"".join([
+        struct.pack("<II", blockType, length),
+        body,
+        options,
+        struct.pack("<I", length)
+    ])
+
+
+class CaptureRing:
+
+    # The last `size` packets, of which the first `snaplen` bytes (after the
+    # headers of the TUN device) are kept. Dumps on signals go to files in
+    # `directory`.
+
+    def __init__(self, size=4096, snaplen=256, directory="/tmp"):
+        self.armed = False
+        self.configure(size, snaplen, directory)
+
+    def configure(self, size, snaplen, directory="/tmp"):
+        assert size > 0 and snaplen > 0
+        self.directory = directory
+        self.size = size
+        self.snaplen = snaplen
+        self.buffer = bytearray(size * snaplen)
+        self.records = bytearray(size * CAPTURE_RECORD.size)
+        self.next = 0           # slot for the next packet
+        self.count = 0          # packets recorded, up to `size`
+
+    def arm(self, armed=True):
+        self.armed = armed
+        info("Packet capture %s." % ("armed" if armed else "disarmed"))
+
+    def record(self, point, wsid, data):
+        # keep `data`, a packet of the TUN device
+        index = self.next
+        self.next = index + 1 if index + 1 < self.size else 0
+        if self.count < self.size: self.count += 1
+        offset = packet.ipOffset
+        length = len(data) - offset
+        if length < 0: length = 0
+        captured = length if length < self.snaplen else self.snaplen
+        start = index * self.snaplen
+        self.buffer[start:start+captured] = data[offset:offset+captured]
+        CAPTURE_RECORD.pack_into(
+            self.records, index * CAPTURE_RECORD.size,
+            time.time(), length, captured, wsid, point
+        )
+
+    def dump(self, filename):
+        # Write the recorded packets to `filename` in pcapng format, oldest
+        # first. Returns the number of packets written.
+        blocks = [_pcapngBlock(
+            PCAPNG_SECTION_HEADER,
+            struct.pack("<IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+        )]
+        for name in CAPTURE_POINTS:
+            blocks.append(_pcapngBlock(
+                PCAPNG_INTERFACE_DESCRIPTION,
+                struct.pack("<HHI", LINKTYPE_RAW, 0, self.snaplen),
+                _pcapngOption(PCAPNG_OPTION_IF_NAME, name.encode("ascii"))
+            ))
+        first = (self.next - self.count) % self.size
+        for i in range(self.count):
+            index = (first + i) % self.size
+            start = index * self.snaplen
+            seconds, length, captured, wsid, point = \
+                CAPTURE_RECORD.unpack_from(
+                    self.records, index * CAPTURE_RECORD.size)
+            data = bytes(self.buffer[start:start+captured])
+            timestamp = int(seconds * 1e6)
+            body = struct.pack(
+                "<IIIII",
+                point,
+                timestamp >> 32,
+                timestamp & 0xFFFFFFFF,
+                captured,
+                length
+            ) + data + b"\x00" * (-captured % 4)
+            options = b""
+            if wsid:
+                options = _pcapngOption(
+                    PCAPNG_OPTION_COMMENT,
+                    ("connection %d" % wsid).encode("ascii")
+                )
+            blocks.append(_pcapngBlock(PCAPNG_ENHANCED_PACKET, body, options))
+        # a new file only, never following links, as the directory may be
+        # writable by others (like /tmp)
+        fd = os.open(
+            filename,
+            os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+            0o600
+        )
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(blocks))
+        return self.count
+
+    def dumpToDirectory(self):
+        filename = os.path.join(self.directory, "sizzler-%d-%s.pcapng" % (
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        try:
+            count = self.dump(filename)
+            info("Captured %d packets written to %s." % (count, filename))
+        except Exception as e:
+            critical("Cannot write captured packets: %s" % e)
+
+    def handleSignals(self, loop):
+        # SIGUSR1 writes the capture to a file, SIGUSR2 arms or disarms it
+        loop.add_signal_handler(signal.SIGUSR1, self.dumpToDirectory)
+        loop.add_signal_handler(
+            signal.SIGUSR2, lambda: self.arm(not self.armed))
+
+
+CAPTURE = CaptureRing()
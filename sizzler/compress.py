@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import zlib
+
+from .packet import getFlowKey
+
+# Compression of frames, before padding and encryption:
+#   none: no compression (default)
+#   zlib: deflate, one stream per connection and direction, so that packets
+#         compress against all earlier ones (connections are reliable and
+#         ordered, which streaming needs)
+#   lz4:  each frame on its own, faster but compresses less; needs the lz4
+#         package on both ends
+COMPRESSIONS = ["none", "zlib", "lz4"]
+
+# Frame types of compressed frames, their content is another frame.
+COMPRESSED_TYPES = {"zlib": b"z-", "lz4": b"l-"}
+
+COMPRESS_MIN = 128          # frames smaller than this are not compressed
+COMPRESS_BAD_RATIO = 0.9    # compressing worse than this is wasted CPU time
+COMPRESS_SKIP_MIN = 16      # frames to skip for flows not compressing well,
+COMPRESS_SKIP_MAX = 1024    # doubled each time they still don't
+COMPRESS_FLOWS_MAX = 4096   # flows to remember
+
+ZLIB_SYNC_TAIL = b"\x00\x00\xff\xff"
+
+
+def getCompressBound(algorithm, length):
+    # The most `length` bytes may take once compressed, with incompressible
+    # data: lz4 adds a byte per 255 and 16 more, and 4 for the stored size;
+    # deflate falls back to stored blocks, bounded as by zlib's deflateBound,
+    # plus the sync flush.
+    if algorithm == "lz4":
+        return length + length // 255 + 16 + 4
+    return length + (length >> 12) + (length >> 14) + (length >> 25) + 13 + 5
+
+
+def _importLZ4():
+    try:
+        import lz4.block
+        return lz4.block
+    except ImportError:
+        raise Exception("Compression lz4 requires the lz4 package.")
+
+
+class Compressor:
+
+    # Compresses frames of one connection, up to `maxLength` bytes after
+    # compression, frame type included. Frames that might grow beyond are
+    # sent uncompressed, as are lz4 frames not getting smaller. Packets of
+    # flows that don't compress well (e.g. TLS) are skipped for a while,
+    # i.e. frames with such packets are sent uncompressed. Sizes before and
+    # after are counted in `metrics`.
+
+    def __init__(self, algorithm, level, maxLength, metrics):
+        if algorithm not in COMPRESSIONS or algorithm == "none":
+            raise Exception("Unknown compression: %s" % algorithm)
+        self.algorithm = algorithm
+        self.level = level
+        self.maxLength = maxLength
+        self.metrics = metrics
+        self.frameType = COMPRESSED_TYPES[algorithm]
+        if algorithm == "zlib":
+            self.stream = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            self.lz4 = _importLZ4()
+        self.flows = {}     # flow key -> [frames to skip, next skip]
+
+    def __compress(self, plain):
+        if self.algorithm == "lz4":
+            return self.lz4.compress(plain, store_size=True)
+        # a sync flush always ends with the same 4 bytes, which we omit
+        compressed = self.stream.compress(plain) + \
+            self.stream.flush(zlib.Z_SYNC_FLUSH)
+        return compressed[:-len(ZLIB_SYNC_TAIL)]
+
+    def __isSkipped(self, keys):
+        skipped = False
+        for key in keys:
+            state = self.flows.get(key)
+            if state and state[0] > 0:
+                state[0] -= 1
+                skipped = True
+        return skipped
+
+    def __feedback(self, keys, ratio):
+        if len(self.flows) > COMPRESS_FLOWS_MAX: self.flows.clear()
+        for key in keys:
+            if ratio <= COMPRESS_BAD_RATIO:
+                self.flows.pop(key, None)
+                continue
+            state = self.flows.setdefault(key, [0, COMPRESS_SKIP_MIN])
+            state[0] = state[1]
+            state[1] = min(COMPRESS_SKIP_MAX, state[1] * 2)
+
+    def compress(self, packets, chunks):
+        # Returns the frame made of `chunks` (containing `packets`),
+        # compressed and with its frame type, or None to send it as is.
+        length = sum([len(each) for each in chunks])
+        if length < COMPRESS_MIN: return None
+        bound = len(self.frameType) + getCompressBound(self.algorithm, length)
+        if bound > self.maxLength: return None
+        keys = [getFlowKey(each) for each in packets]
+        if self.__isSkipped(keys):
+            self.metrics.compressSkipped += 1
+            return None
+        compressed = self.__compress(b"".join(chunks))
+        self.metrics.compressIn += length
+        self.metrics.compressOut += len(compressed)
+        self.__feedback(keys, len(compressed) / length)
+        # frames of lz4 stand on their own, so one not getting smaller is
+        # just not sent; zlib's stream has taken it in already, and its
+        # bound kept it small enough
+        if self.algorithm == "lz4" and len(compressed) >= length:
+            return None
+        return self.frameType + compressed
+
+
+class Decompressor:
+
+    # Decompresses frames of one connection, whatever the peer chose. A
+    # frame failing to decompress breaks the zlib stream, so an exception is
+    # raised, which ends the connection.
+
+    def __init__(self, maxLength):
+        self.maxLength = maxLength
+        self.stream = None
+        self.lz4 = None
+
+    def decompress(self, frameType, data):
+        try:
+            if frameType == COMPRESSED_TYPES["lz4"]:
+                if not self.lz4: self.lz4 = _importLZ4()
+                plain = self.lz4.decompress(data)
+                assert len(plain) <= self.maxLength
+                return plain
+            if not self.stream: self.stream = zlib.decompressobj(-15)
+            plain = self.stream.decompress(
+                bytes(data) + ZLIB_SYNC_TAIL, self.maxLength)
+            assert not self.stream.unconsumed_tail
+            return plain
+        except Exception:
+            raise Exception("Cannot decompress frame.")
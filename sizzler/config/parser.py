@@ -2,9 +2,15 @@
 
 import yaml
 
+from ..mtu import getTunnelMTU, getFrameSize, MTU_MIN
+from ..transport._datagram import parseDatagramURI
+from ..transport.router import parsePrefix
+
 def loadConfigFile(filename):
     try:
-        config = yaml.load(open(filename, "r").read())
+        # the C loader is a lot faster, if PyYAML was built with it
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        config = yaml.load(open(filename, "r").read(), Loader=loader)
     except:
         raise Exception("Cannot read given config file.")
 
@@ -12,8 +18,253 @@ def loadConfigFile(filename):
         assert type(config["key"]) == str
         assert type(config["ip"]["server"]) == str
         assert type(config["ip"]["client"]) == str
+        config["ip"].setdefault("ipv6", None)
+        if config["ip"]["ipv6"] is not None:
+            parsePrefix(config["ip"]["ipv6"])
+
+        config["server"] = config.get("server") or {}
+        config["server"].setdefault("udp", 0)
+        assert type(config["server"]["udp"]) == int
+        assert 0 <= config["server"]["udp"] <= 0xFFFF
+        datagrams = config["server"]["udp"] > 0
+
+        config["client"] = config.get("client") or []
+        for each in config["client"]:
+            if type(each) == dict:
+                each.setdefault("fallback", None)
+                assert each["fallback"] is None or \
+                    type(each["fallback"]) == str
+                each = each["uri"]
+            assert type(each) == str
+            if each.startswith("udp://"):
+                parseDatagramURI(each)
+                datagrams = True
+
+        config.setdefault("standby", 0)
+        assert type(config["standby"]) == int and config["standby"] >= 0
+
+        config.setdefault("workers", 1)
+        assert type(config["workers"]) == int and config["workers"] >= 1
+
+        config["tun"] = config.get("tun") or {}
+        config["tun"].setdefault("engine", "executor")
+        assert type(config["tun"]["engine"]) == str
+        config["tun"].setdefault("offload", False)
+        assert type(config["tun"]["offload"]) == bool
+        config["tun"].setdefault("mtu", "auto")
+        config["tun"].setdefault("path", 1500)
+        config["tun"].setdefault("clamp", True)
+        assert config["tun"]["mtu"] == "auto" or \
+            (type(config["tun"]["mtu"]) == int and \
+            config["tun"]["mtu"] >= MTU_MIN)
+        assert type(config["tun"]["path"]) == int
+        assert config["tun"]["path"] >= MTU_MIN
+        assert type(config["tun"]["clamp"]) == bool
+        # super-packets of offloading don't fit into datagrams
+        assert not (config["tun"]["offload"] and datagrams)
+
+        config["session"] = config.get("session") or {}
+        aggregate = config["session"].get("aggregate") or {}
+        config["session"]["aggregate"] = aggregate
+        aggregate.setdefault("bytes", 0)
+        aggregate.setdefault("linger", 0)
+        assert type(aggregate["bytes"]) == int
+        assert 0 <= aggregate["bytes"] <= 0xFFFF - 12
+        assert type(aggregate["linger"]) in [int, float]
+        assert aggregate["linger"] >= 0
+        config["session"].setdefault("crypto", "executor")
+        assert type(config["session"]["crypto"]) == str
+        config["session"].setdefault("resume", 0)
+        assert type(config["session"]["resume"]) == int
+        assert config["session"]["resume"] >= 0
+        config["session"].setdefault("heartbeat", 5)
+        assert type(config["session"]["heartbeat"]) in [int, float]
+        assert config["session"]["heartbeat"] > 0
+        compress = config["session"].get("compress") or {}
+        config["session"]["compress"] = compress
+        compress.setdefault("algorithm", "none")
+        compress.setdefault("level", 1)
+        assert type(compress["algorithm"]) == str
+        assert type(compress["level"]) == int
+        padding = config["session"].get("padding") or {}
+        config["session"]["padding"] = padding
+        padding.setdefault("policy", "random")
+        padding.setdefault("buckets", [128, 256, 512, 1024, 1536, 2048])
+        assert type(padding["policy"]) == str
+        assert all([type(each) == int for each in padding["buckets"]])
+
+        config["queue"] = config.get("queue") or {}
+        queue = config["queue"]
+        queue.setdefault("packets", 1000)
+        queue.setdefault("bytes", 0)
+        queue.setdefault("policy", "taildrop")
+        queue.setdefault("target", 0.005)
+        queue.setdefault("interval", 0.1)
+        assert type(queue["packets"]) == int and queue["packets"] >= 0
+        assert type(queue["bytes"]) == int and queue["bytes"] >= 0
+        assert type(queue["policy"]) == str
+        assert type(queue["target"]) in [int, float]
+        assert type(queue["interval"]) in [int, float]
+
+        config["priority"] = config.get("priority") or {}
+        priority = config["priority"]
+        priority.setdefault("scheduler", "none")
+        priority.setdefault("small", 128)
+        priority.setdefault("interactive", [22, 53, 123, 3389, 5900])
+        priority.setdefault("bulk", [])
+        priority.setdefault("weights", [8, 4, 1])
+        assert type(priority["scheduler"]) == str
+        assert type(priority["small"]) == int
+        assert all([type(each) == int for each in priority["interactive"]])
+        assert all([type(each) == int for each in priority["bulk"]])
+        assert len(priority["weights"]) == 3
+        assert all([type(each) == int for each in priority["weights"]])
+
+        config["schedule"] = config.get("schedule") or {}
+        schedule = config["schedule"]
+        schedule.setdefault("policy", "hash")
+        schedule.setdefault("congested", 100)
+        assert type(schedule["policy"]) == str
+        assert type(schedule["congested"]) == int
+
+        config["shaping"] = config.get("shaping") or {}
+        shaping = config["shaping"]
+        shaping.setdefault("fair", True)
+        assert type(shaping["fair"]) == bool
+        for name, burst in [("session", 65536), ("client", 262144)]:
+            limits = shaping[name] = shaping.get(name) or {}
+            limits.setdefault("send", 0)
+            limits.setdefault("receive", 0)
+            limits.setdefault("burst", burst)
+            for key in ["send", "receive", "burst"]:
+                assert type(limits[key]) in [int, float] and limits[key] >= 0
+            assert limits["burst"] > 0
+
+        config["runtime"] = config.get("runtime") or {}
+        runtime = config["runtime"]
+        runtime.setdefault("loop", "asyncio")
+        runtime.setdefault("executor", 0)
+        runtime.setdefault("cpu", None)
+        runtime.setdefault("sndbuf", 0)
+        runtime.setdefault("rcvbuf", 0)
+        runtime.setdefault("nodelay", True)
+        assert type(runtime["loop"]) == str
+        assert type(runtime["executor"]) == int and runtime["executor"] >= 0
+        assert runtime["cpu"] is None or type(runtime["cpu"]) == int
+        assert type(runtime["sndbuf"]) == int
+        assert type(runtime["rcvbuf"]) == int
+        assert type(runtime["nodelay"]) == bool
+
+        config["capture"] = config.get("capture") or {}
+        capture = config["capture"]
+        capture.setdefault("packets", 4096)
+        capture.setdefault("snaplen", 256)
+        capture.setdefault("armed", False)
+        capture.setdefault("directory", "/tmp")
+        assert type(capture["packets"]) == int and capture["packets"] > 0
+        assert type(capture["snaplen"]) == int and capture["snaplen"] > 0
+        assert type(capture["armed"]) == bool
+        assert type(capture["directory"]) == str
+
+        config["metrics"] = config.get("metrics") or {}
+        config["metrics"].setdefault("host", "127.0.0.1")
+        config["metrics"].setdefault("port", 0)
+        assert type(config["metrics"]["host"]) == str
+        assert type(config["metrics"]["port"]) == int
 
     except:
         raise Exception("Malformed config file.")
 
+    if config["session"]["compress"]["algorithm"] != "none" and \
+            config["session"]["padding"]["policy"] == "none":
+        # unpadded sizes of compressed frames leak their contents
+        raise Exception("Compression requires padding of frames.")
+
     return config
+
+def getMTU(config):
+    # the MTU of the TUN device, as configured or computed from the path
+    if config["tun"]["mtu"] == "auto":
+        return getTunnelMTU(config["tun"]["path"])
+    return config["tun"]["mtu"]
+
+def getClientURIs(config):
+    # URIs of the `client` section, and the fallback of each, or None
+    uris, fallbacks = [], []
+    for each in config["client"]:
+        if type(each) == dict:
+            uris.append(each["uri"])
+            fallbacks.append(each["fallback"])
+        else:
+            uris.append(each)
+            fallbacks.append(None)
+    return uris, fallbacks
+
+def getSessionOptions(config):
+    # translate the `session` section into WebsocketSession arguments
+    session = config["session"]
+    return {
+        "aggregateBytes": session["aggregate"]["bytes"],
+        "aggregateLinger": session["aggregate"]["linger"],
+        "cryptoStrategy": session["crypto"],
+        "compression": session["compress"]["algorithm"],
+        "compressionLevel": session["compress"]["level"],
+        "padding": session["padding"]["policy"],
+        "paddingBuckets": session["padding"]["buckets"],
+        "paddingTarget": getFrameSize(getMTU(config)),
+        "heartbeatInterval": session["heartbeat"],
+        "socketOptions": {
+            "sndbuf": config["runtime"]["sndbuf"],
+            "rcvbuf": config["runtime"]["rcvbuf"],
+            "nodelay": config["runtime"]["nodelay"],
+        },
+    }
+
+def getQueueOptions(config):
+    # translate the `queue` section into PacketQueue arguments
+    queue = config["queue"]
+    return {
+        "maxPackets": queue["packets"],
+        "maxBytes": queue["bytes"],
+        "policy": queue["policy"],
+        "target": queue["target"],
+        "interval": queue["interval"],
+    }
+
+def getPriorityOptions(config):
+    # translate the `priority` section into PriorityPacketQueue arguments,
+    # None if disabled
+    priority = config["priority"]
+    if priority["scheduler"] == "none": return None
+    return {
+        "scheduler": priority["scheduler"],
+        "small": priority["small"],
+        "interactivePorts": priority["interactive"],
+        "bulkPorts": priority["bulk"],
+        "weights": priority["weights"],
+    }
+
+def getShapingOptions(config):
+    # translate the `shaping` section into Shaping arguments, None if there
+    # are no limits
+    session, client = config["shaping"]["session"], config["shaping"]["client"]
+    if not any([session["send"], session["receive"],
+            client["send"], client["receive"]]):
+        return None
+    return {
+        "sessionSend": session["send"],
+        "sessionReceive": session["receive"],
+        "sessionBurst": session["burst"],
+        "clientSend": client["send"],
+        "clientReceive": client["receive"],
+        "clientBurst": client["burst"],
+    }
+
+def getRouterOptions(config):
+    # translate the `schedule` section into PacketRouter arguments
+    schedule = config["schedule"]
+    return {
+        "policy": schedule["policy"],
+        "congested": schedule["congested"],
+        "ipv6": config["ip"]["ipv6"],
+    }
@@ -4,50 +4,145 @@ import asyncio
 import hashlib
 import nacl.secret
 
-def __getEncryptor(box):
+# How encryption and decryption are run:
+#   executor: every call is a job in the default executor
+#   inline:   every call runs directly on the event loop
+#   batch:    calls made within one event loop iteration are collected and
+#             run as one executor job, PyNaCl releases the GIL meanwhile
+#   auto:     inline for payloads up to CRYPTO_INLINE_MAX bytes, otherwise
+#             batch
+CRYPTO_STRATEGIES = ["executor", "inline", "batch", "auto"]
+CRYPTO_INLINE_MAX = 2048
+
+
+def __getExecutorRunner(function):
     loop = asyncio.get_event_loop()
-    async def encrypt(data):
-        future = loop.run_in_executor(None, box.encrypt, data)
+    async def run(data):
+        future = loop.run_in_executor(None, function, data)
         return await future
-    return encrypt
+    return run
+
+def __getInlineRunner(function):
+    async def run(data):
+        return function(data)
+    return run
 
-def __getDecryptor(box):
+def __getBatchRunner(function):
     loop = asyncio.get_event_loop()
-    async def decrypt(data):
-        def _wrapDecrypt(data):
-            try:
-                return box.decrypt(data)
-            except:
-                return None
-        future = loop.run_in_executor(None, _wrapDecrypt, data)
+    batch = []
+
+    def runBatch(items):
+        return [function(data) for data in items]
+
+    def flush():
+        items = batch[:]
+        del batch[:]
+        job = loop.run_in_executor(None, runBatch, [d for d, f in items])
+        def done(job):
+            for i, (data, future) in enumerate(items):
+                if future.done(): continue
+                if job.exception():
+                    future.set_exception(job.exception())
+                else:
+                    future.set_result(job.result()[i])
+        job.add_done_callback(done)
+
+    async def run(data):
+        future = loop.create_future()
+        if not batch: loop.call_soon(flush)
+        batch.append((data, future))
         return await future
-    return decrypt
+    return run
 
+def __getAutoRunner(function):
+    inline = __getInlineRunner(function)
+    batch = __getBatchRunner(function)
+    async def run(data):
+        if len(data) <= CRYPTO_INLINE_MAX:
+            return await inline(data)
+        return await batch(data)
+    return run
 
+def __getRunner(function, strategy):
+    if strategy == "executor": return __getExecutorRunner(function)
+    if strategy == "inline": return __getInlineRunner(function)
+    if strategy == "batch": return __getBatchRunner(function)
+    if strategy == "auto": return __getAutoRunner(function)
+    raise Exception("Unknown crypto strategy: %s" % strategy)
 
-def getCrypto(key):
-    if type(key) == str: key = key.encode('utf-8')
-    assert type(key) == bytes
-    
+def __getEncryptor(box, strategy):
+    return __getRunner(box.encrypt, strategy)
+
+def __getDecryptor(box, strategy):
+    def _wrapDecrypt(data):
+        try:
+            return box.decrypt(data)
+        except:
+            return None
+    return __getRunner(_wrapDecrypt, strategy)
+
+
+
+# Crypto contexts by key, strategy and event loop. Deriving the key and
+# setting up the runners is done once, all sessions with the same key share
+# the result (and with the batch strategy, their batches).
+__contexts = {}
+
+def __deriveBox(key):
     encryptKey = hashlib.sha512(key).digest()
     authkey = hashlib.sha512(encryptKey).digest()
 
     encryptKey = encryptKey[:nacl.secret.SecretBox.KEY_SIZE]
 
-    box = nacl.secret.SecretBox(encryptKey)
+    return nacl.secret.SecretBox(encryptKey)
+
+def getCrypto(key, strategy="executor"):
+    if type(key) == str: key = key.encode('utf-8')
+    assert type(key) == bytes
 
-    return __getEncryptor(box), __getDecryptor(box)
+    loop = asyncio.get_event_loop()
+    context = __contexts.get((key, strategy, loop))
+    if context: return context
+
+    for each in list(__contexts):
+        if each[2].is_closed(): del __contexts[each]
+    box = __deriveBox(key)
+    context = __getEncryptor(box, strategy), __getDecryptor(box, strategy)
+    __contexts[(key, strategy, loop)] = context
+    return context
 
 
 
 if __name__ == "__main__":
+    # Benchmark: packets/s for each strategy, encrypting and decrypting
+    # 1400-byte packets in a number of concurrent sessions.
+    import os
+    import time
+
+    PACKETS = 20000
+    PACKET_SIZE = 1400
+
+    async def session(encryptor, decryptor, count):
+        data = os.urandom(PACKET_SIZE)
+        for i in range(count):
+            assert await decryptor(await encryptor(data)) == data
+
     async def main():
-        encryptor, decryptor = getCrypto("test")
-        d = await encryptor(b"plaintext")
-        print(d)
-        d = await decryptor(d)
-        print(d)
+        print("%10s  %8s  %12s" % ("strategy", "sessions", "packets/s"))
+        for strategy in CRYPTO_STRATEGIES:
+            encryptor, decryptor = getCrypto("test", strategy)
+            for sessions in [1, 8, 64]:
+                start = time.time()
+                await asyncio.gather(*[
+                    session(encryptor, decryptor, PACKETS // sessions)
+                    for i in range(sessions)
+                ])
+                print("%10s  %8d  %12d" % (
+                    strategy,
+                    sessions,
+                    PACKETS / (time.time() - start)
+                ))
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main())
-        
+
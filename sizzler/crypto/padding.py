@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
 import asyncio
+import array
+import bisect
 import os
 import random
 import struct
 import time
+from logging import warning
 
 
 # tell calculation how many bytes will be added after encryption with respect
 # to input before padding
 
-PADDING_FORMAT_OVERHEAD = 2 + 8
+PADDING_HEAD = struct.Struct("<HQ")      # data length, nonce
+PADDING_FORMAT_OVERHEAD = PADDING_HEAD.size
 ENCRYPTION_OVERHEAD = 40
 
 PADDING_TOTAL_OVERHEAD = ENCRYPTION_OVERHEAD + PADDING_FORMAT_OVERHEAD
@@ -18,92 +22,306 @@ PADDING_TOTAL_OVERHEAD = ENCRYPTION_OVERHEAD + PADDING_FORMAT_OVERHEAD
 # How many nonces may be (theoretically) issued per second, limits the max.
 # network speed!
 NONCES_RESOLUTION = 1e6 # < if packet size = 4kB, limits to 4GB/s(???)
-DELETE_NONCES_BEFORE = 300 * NONCES_RESOLUTION
+
+# Replay protection remembers every nonce within a sliding window below the
+# newest one seen, as a bitmap of one bit per possible nonce. Older nonces are
+# refused. Frames of one session arrive nearly in order, so ~0.5 seconds is
+# plenty, and the bitmap costs 64kB per session no matter the packet rate.
+REPLAY_WINDOW = 1 << 19
+
+# The first nonce of a session is refused if it's older than this, by our
+# clock: so frames of sessions ended long enough ago can't be replayed. This
+# requires the clocks of both peers to agree within 5 minutes.
+ACCEPT_FIRST_NONCE_AFTER = 300 * NONCES_RESOLUTION
+
+# Refused nonces are logged at most every this many seconds, not for each.
+NONCE_FAILURE_LOG_INTERVAL = 10
+
+# How frames are padded before encryption:
+#   none:   not at all, cheapest, but the size of each frame tells the size
+#           of the packets within
+#   bucket: up to the next of a few fixed frame sizes, which only tells the
+#           range of the size
+#   random: up to a random size between the frame's own size and the max.
+#           size, uniformly distributed (default)
+PADDING_POLICIES = ["none", "bucket", "random"]
+PADDING_BUCKETS = [128, 256, 512, 1024, 1536, 2048]
+
+# Random bytes padding is cut from, renewed every few seconds.
+PADDING_POOL_SIZE = 65536
+PADDING_POOL_RENEW = 5
+
+# Random numbers for padding lengths are read by each padder for itself, so
+# many at a time, and each is used once.
+PADDING_NUMBERS = 256
+
+
+ZEROS = memoryview(bytes(REPLAY_WINDOW // 8))
 
 
 class NonceManagement:
 
-    def __init__(self):
-        self.nonces = []
+    def __init__(self, window=REPLAY_WINDOW):
+        assert window % 8 == 0
+        self.window = window
+        self.bitmap = bytearray(window // 8)
+        self.zeros = ZEROS if window == REPLAY_WINDOW else \
+            memoryview(bytes(window // 8))
+        self.newest = None
+        self.last = 0
+        self.failures = 0           # refused since last logged
+        self.failuresLogged = 0
 
     def new(self):
-        return int(time.time() * NONCES_RESOLUTION)
+        # timestamp based, but never issue the same nonce twice
+        self.last = max(self.last + 1, int(time.time() * NONCES_RESOLUTION))
+        return self.last
 
     def verify(self, nonce):
-        if not self.nonces:
-            self.nonces.append(nonce)
-            self.oldest = nonce - DELETE_NONCES_BEFORE
-            return True
-        if nonce < self.oldest or nonce in self.nonces:
-            print("Nonce failure: Replay attack or unexpected bug!")
-            return False
-        self.nonces.append(nonce)
+        if self.newest is None:
+            # accept the first nonce, unless it is too old
+            oldest = time.time() * NONCES_RESOLUTION - ACCEPT_FIRST_NONCE_AFTER
+            if nonce < oldest: return self.__refuse()
+            self.__advance(nonce)
+        elif nonce > self.newest:
+            self.__advance(nonce)
+        elif nonce <= self.newest - self.window + 8:
+            return self.__refuse()
+        index = nonce % self.window
+        byte, bit = index >> 3, 1 << (index & 7)
+        if self.bitmap[byte] & bit: return self.__refuse()
+        self.bitmap[byte] |= bit
         return True
 
-    def __await__(self):
+    def __refuse(self):
+        self.failures += 1
+        now = time.time()
+        if now - self.failuresLogged >= NONCE_FAILURE_LOG_INTERVAL:
+            warning("Nonce failure: Replay attack or unexpected bug! "
+                "(%d frames refused)" % self.failures)
+            self.failures = 0
+            self.failuresLogged = now
+        return False
+
+    def __advance(self, nonce):
+        # Slide the window up to `nonce`. Bits of all nonces above the newest
+        # one up to the end of its byte are always clear, so it's sufficient
+        # to clear whole bytes from there up to the byte of `nonce`. (The
+        # oldest 8 nonces of the window share bytes with future nonces and
+        # are refused to keep this true.)
+        size = len(self.bitmap)
+        if self.newest is None:
+            start = stop = (nonce + 8) >> 3
+        else:
+            start, stop = (self.newest + 8) >> 3, (nonce + 8) >> 3
+        self.newest = nonce
+        if stop - start >= size:
+            self.bitmap[:] = self.zeros
+            return
+        start, stop = start % size, stop % size
+        if start <= stop:
+            self.bitmap[start:stop] = self.zeros[:stop-start]
+        else:
+            self.bitmap[start:] = self.zeros[:size-start]
+            self.bitmap[:stop] = self.zeros[:stop]
+
+
+class PaddingPool:
+
+    # Random bytes for padding, shared by all sessions of a process, so that
+    # new sessions cost no reads from os.urandom. A single housekeeping task
+    # renews them, started by whoever uses the pool on an event loop.
+
+    def __init__(self, size=PADDING_POOL_SIZE, interval=PADDING_POOL_RENEW):
+        self.interval = interval
+        self.task = None
+        self.__fill(size)
+
+    def __fill(self, size):
+        self.random = os.urandom(size)
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        if self.task and not self.task.done() and self.task.get_loop() is loop:
+            return
+        self.task = loop.create_task(self.__renew())
+
+    async def __renew(self):
         while True:
-            # recalculate acceptable nonce time
-            if self.nonces:
-                self.oldest = max(self.nonces) - DELETE_NONCES_BEFORE
-                # clear nonces cache
-                self.nonces = [e for e in self.nonces if e >= self.oldest]
-            yield from asyncio.sleep(30)
+            await asyncio.sleep(self.interval)
+            self.__fill(len(self.random))
+
+
+PADDING_POOL = PaddingPool()
 
 
 class RandomPadding:
+
+    # Pads frames according to `policy`: with "random", to at most
+    # `targetSize` bytes after encryption, with "bucket", to the next of the
+    # sizes in `buckets` after encryption, which are capped at `targetSize`
+    # too. Frames larger than that are left as they are.
     
-    def __init__(self, targetSize=4096):
+    def __init__(
+        self,
+        targetSize=4096,
+        pool=PADDING_POOL,
+        policy="random",
+        buckets=PADDING_BUCKETS
+    ):
+        if policy not in PADDING_POLICIES:
+            raise Exception("Unknown padding policy: %s" % policy)
         assert targetSize > PADDING_TOTAL_OVERHEAD
         self.maxAfterPaddingLength = targetSize - PADDING_TOTAL_OVERHEAD
-        self.paddingTemplate = os.urandom(65536)
+        self.pool = pool
         self.nonces = NonceManagement()
 
+        # random 16-bit numbers, scaled to random padding lengths, which is
+        # a lot cheaper than calling random.randint() for each frame
+        self.numbers = None
+        self.numberIndex = PADDING_NUMBERS
+        # data length -> padding length, for each length below the largest
+        # bucket
+        self.bucketTable = []
+        sizes = sorted(set([
+            min(size, targetSize) - PADDING_TOTAL_OVERHEAD for size in buckets
+            if size > PADDING_TOTAL_OVERHEAD
+        ]))
+        for dataLength in range(sizes[-1] if sizes else 0):
+            self.bucketTable.append(
+                sizes[bisect.bisect_left(sizes, dataLength)] - dataLength)
+        self.paddingLength = {
+            "none": self.__noPadding,
+            "bucket": self.__bucketPadding,
+            "random": self.__randomPadding,
+        }[policy]
+
+    def __noPadding(self, dataLength):
+        return 0
+
+    def __bucketPadding(self, dataLength):
+        if dataLength >= len(self.bucketTable): return 0
+        return self.bucketTable[dataLength]
+
+    def __randomPadding(self, dataLength):
+        if dataLength >= self.maxAfterPaddingLength: return 0
+        if self.numberIndex >= PADDING_NUMBERS:
+            self.numbers = array.array("H", os.urandom(2 * PADDING_NUMBERS))
+            self.numberIndex = 0
+        number = self.numbers[self.numberIndex]
+        self.numberIndex += 1
+        # scale a number of 0..65535 to 0..(max. length - data length)
+        return number * (self.maxAfterPaddingLength - dataLength + 1) >> 16
+
     def __packHead(self, dataLength):
         # put `dataLength` and nonce(timestamp-based) into a header
-        return struct.pack("<HQ", dataLength, self.nonces.new())
+        return PADDING_HEAD.pack(dataLength, self.nonces.new())
 
     def __unpackHead(self, data):
         # unpack header, extract nonce and dataLength.
-        dataLength, nonce = struct.unpack("<HQ", data)
+        dataLength, nonce = PADDING_HEAD.unpack_from(data)
         # verify nonce, if invalid, drop it internally
         if self.nonces.verify(nonce):
             return dataLength
         else:
             return None
 
-    def pad(self, data):
-        dataLength = len(data)
-        if dataLength >= self.maxAfterPaddingLength:
-            return self.__packHead(dataLength) + data
-        else:
-            targetLength = random.randint(
-                dataLength, self.maxAfterPaddingLength
-            )
-            paddingLength = targetLength - dataLength
-            padding = self.paddingTemplate[:paddingLength]
-            return self.__packHead(dataLength) + data + padding
+    def pad(self, *chunks):
+        # Returns header, all chunks and padding as one bytes object. The
+        # chunks are copied only once, straight into it.
+        dataLength = sum(map(len, chunks))
+        parts = [self.__packHead(dataLength)]
+        parts.extend(chunks)
+        paddingLength = self.paddingLength(dataLength)
+        if paddingLength:
+            parts.append(memoryview(self.pool.random)[:paddingLength])
+        return b"".join(parts)
 
     def unpad(self, data):
-        dataLength = self.__unpackHead(data[:PADDING_FORMAT_OVERHEAD])
+        # Returns a memoryview of the data within `data`, without copying.
+        if len(data) < PADDING_FORMAT_OVERHEAD: return None
+        dataLength = self.__unpackHead(data)
         if not dataLength: return None
         if dataLength > len(data) - PADDING_FORMAT_OVERHEAD: return None
-        return data[PADDING_FORMAT_OVERHEAD:][:dataLength]
-
-    def __await__(self):
-        async def job1():
-            while True:
-                self.paddingTemplate = os.urandom(65536)
-                await asyncio.sleep(5) # change random padding every 5 sec
-        yield from asyncio.gather(job1(), self.nonces)
+        start = PADDING_FORMAT_OVERHEAD
+        return memoryview(data)[start:start+dataLength]
 
 
 if __name__ == "__main__":
-    async def main():
-        p = RandomPadding(100)
-        print(p.pad(b"aaa"*10))
+    import timeit
+
+    # Micro-benchmark: cost of NonceManagement.verify at different packet
+    # rates. Nonces are spaced as a sender at that rate would issue them.
+
+    COUNT = 200000
+    print("%12s  %14s" % ("packets/s", "ns per verify"))
+    for rate in [1e3, 1e4, 5e4, 1e5, 1e6]:
+        step = max(1, int(NONCES_RESOLUTION / rate))
+        first = int(time.time() * NONCES_RESOLUTION)
+        nonces = list(range(first, first + step * COUNT, step))
+        manager = NonceManagement()
+        verify = manager.verify
+        seconds = timeit.timeit(lambda: [verify(n) for n in nonces], number=1)
+        print("%12d  %14.1f" % (rate, seconds / COUNT * 1e9))
+
+    # Micro-benchmark: framing of one packet, i.e. prefixing it with its type
+    # and padding on sending, and the reverse on receiving; compared with
+    # the former implementation by concatenation and slicing. Copied bytes
+    # are the payload bytes copied on the way.
+
+    def framePrevious(padder, packet):
+        data = b"d-" + packet                   # copy 1
+        head = struct.pack("<HQ", len(data), padder.nonces.new())
+        targetLength = random.randint(len(data), padder.maxAfterPaddingLength)
+        padding = padder.pool.random[:max(0, targetLength - len(data))]
+        return head + data + padding            # copies 2, 3
+
+    def unframePrevious(padder, frame):
+        dataLength, nonce = struct.unpack("<HQ", frame[:10])
+        padder.nonces.verify(nonce)
+        raw = frame[10:][:dataLength]           # copies 1, 2
+        return raw[2:]                          # copy 3
+
+    def frame(padder, packet):
+        return padder.pad(b"d-", packet)        # copy 1
+
+    def unframe(padder, frame):
+        raw = padder.unpad(frame)
+        return raw[2:]                          # no copies
+
+    COUNT = 100000
+    print()
+    print("%10s  %6s  %14s  %14s" % (
+        "framing", "size", "ns per packet", "bytes copied"))
+    for size in [64, 576, 1400]:
+        packet = os.urandom(size)
+        for name, send, receive, copies in [
+            ("previous", framePrevious, unframePrevious, 6),
+            ("current", frame, unframe, 1),
+        ]:
+            sender, receiver = RandomPadding(2048), RandomPadding(2048)
+            def run():
+                for i in range(COUNT):
+                    receive(receiver, send(sender, packet))
+            seconds = timeit.timeit(run, number=1)
+            print("%10s  %6d  %14.1f  %14d" % (
+                name, size, seconds / COUNT * 1e9, copies * size))
 
-        
+    # Micro-benchmark: padding policies, by cost of padding one packet and
+    # average size of the padded frame, for the default mix of packet sizes.
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
-        
+    SIZES = [64] * 7 + [576] * 4 + [1400]
+    packets = [os.urandom(size) for size in SIZES]
+    print()
+    print("%10s  %14s  %14s" % ("policy", "ns per packet", "avg. bytes"))
+    for policy in PADDING_POLICIES:
+        padder = RandomPadding(2048, policy=policy)
+        def run():
+            return sum([len(padder.pad(b"d-", each)) for each in packets])
+        total = run()
+        seconds = timeit.timeit(run, number=COUNT // len(packets))
+        print("%10s  %14.1f  %14d" % (
+            policy,
+            seconds / (COUNT // len(packets) * len(packets)) * 1e9,
+            total / len(packets) + ENCRYPTION_OVERHEAD
+        ))
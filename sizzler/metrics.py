@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import bisect
+import asyncio
+from logging import info, debug, critical, exception
+
+# Upper bounds of histogram buckets, in seconds.
+CRYPTO_BUCKETS = [
+    1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2
+]
+RTT_BUCKETS = [
+    1e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1, 2.5, 5
+]
+
+
+class Histogram:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts): self.counts[i] += count
+        self.sum += other.sum
+
+
+class SessionMetrics:
+
+    # Counters of one session. The datapath updates the attributes directly,
+    # which is as cheap as it gets; everything else is computed on scraping.
+
+    COUNTERS = [
+        # (attribute, metric name, help)
+        ("framesIn", "frames_in", "Frames received"),
+        ("framesOut", "frames_out", "Frames sent"),
+        ("bytesIn", "bytes_in", "Bytes of frames received"),
+        ("bytesOut", "bytes_out", "Bytes of frames sent"),
+        ("packetsIn", "packets_in", "Packets received for TUN"),
+        ("packetsOut", "packets_out", "Packets from TUN sent"),
+        ("decryptFailures", "decrypt_failures", "Frames failed to decrypt"),
+        ("rejects", "rejects", "Frames rejected, e.g. replayed nonces"),
+        ("framesResent", "frames_resent", "Frames resent after resuming"),
+        ("compressIn", "compress_in_bytes", "Bytes of frames compressed"),
+        ("compressOut", "compress_out_bytes", "Bytes of compressed frames"),
+        ("compressSkipped", "compress_skipped",
+            "Frames not compressed as their flows compress badly"),
+    ]
+    HISTOGRAMS = [
+        ("encryptTime", "encrypt_seconds", "Time to encrypt a frame"),
+        ("decryptTime", "decrypt_seconds", "Time to decrypt a frame"),
+        ("rttTime", "rtt_seconds", "Measured round trip times"),
+    ]
+
+    def __init__(self):
+        for attribute, name, description in self.COUNTERS:
+            setattr(self, attribute, 0)
+        self.encryptTime = Histogram(CRYPTO_BUCKETS)
+        self.decryptTime = Histogram(CRYPTO_BUCKETS)
+        self.rttTime = Histogram(RTT_BUCKETS)
+
+    def merge(self, other):
+        for attribute, name, description in self.COUNTERS:
+            setattr(self, attribute,
+                getattr(self, attribute) + getattr(other, attribute))
+        for attribute, name, description in self.HISTOGRAMS:
+            getattr(self, attribute).merge(getattr(other, attribute))
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.sessions = {}      # session -> SessionMetrics
+        self.closed = SessionMetrics()  # sum of all closed sessions
+        self.sessionsOpened = 0
+        self.reconnects = 0
+        self.queues = {}        # name -> PacketQueue
+
+    def addSession(self, session):
+        metrics = SessionMetrics()
+        self.sessions[session] = metrics
+        self.sessionsOpened += 1
+        return metrics
+
+    def removeSession(self, session):
+        metrics = self.sessions.pop(session, None)
+        if metrics: self.closed.merge(metrics)
+
+    def addQueue(self, name, queue):
+        self.queues[name] = queue
+
+    # ---- Rendering in Prometheus' text format
+
+    def __renderHistogram(self, lines, name, histogram):
+        cumulative = 0
+        bounds = [repr(float(b)) for b in histogram.bounds] + ["+Inf"]
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+        lines.append("%s_sum %f" % (name, histogram.sum))
+        lines.append("%s_count %d" % (name, cumulative))
+
+    def __renderFamily(self, lines, name, kind, description, samples):
+        # one metric family as a block: HELP, TYPE, then all its samples,
+        # given as (labels, value) with labels like '{session="1"}' or ""
+        lines.append("# HELP %s %s." % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            if isinstance(value, float):
+                lines.append("%s%s %f" % (name, labels, value))
+            else:
+                lines.append("%s%s %d" % (name, labels, value))
+
+    def render(self):
+        lines = []
+        total = SessionMetrics()
+        total.merge(self.closed)
+        for metrics in self.sessions.values(): total.merge(metrics)
+        labels = dict([
+            (session, '{session="%d"}' % session.wsid)
+            for session in self.sessions
+        ])
+
+        for attribute, name, description in SessionMetrics.COUNTERS:
+            self.__renderFamily(
+                lines, "sizzler_%s_total" % name, "counter", description,
+                [("", getattr(total, attribute))])
+        for attribute, name, description in SessionMetrics.COUNTERS:
+            self.__renderFamily(
+                lines, "sizzler_session_%s_total" % name, "counter",
+                "%s, by session" % description,
+                [
+                    (labels[session], getattr(metrics, attribute))
+                    for session, metrics in self.sessions.items()
+                ])
+
+        for attribute, name, description in SessionMetrics.HISTOGRAMS:
+            lines.append("# HELP sizzler_%s %s." % (name, description))
+            lines.append("# TYPE sizzler_%s histogram" % name)
+            self.__renderHistogram(
+                lines, "sizzler_%s" % name, getattr(total, attribute))
+
+        self.__renderFamily(
+            lines, "sizzler_compression_ratio", "gauge",
+            "Compressed to uncompressed size of compressed frames",
+            [("", float(total.compressOut) / total.compressIn
+                if total.compressIn else 1.0)])
+
+        self.__renderFamily(
+            lines, "sizzler_session_rtt_seconds", "gauge",
+            "Smoothed round trip time, by session",
+            [
+                (labels[session], float(session.rtt))
+                for session in self.sessions if session.rtt is not None
+            ])
+        self.__renderFamily(
+            lines, "sizzler_session_jitter_seconds", "gauge",
+            "Variation of the round trip time, by session",
+            [
+                (labels[session], float(session.jitter))
+                for session in self.sessions if session.jitter is not None
+            ])
+        self.__renderFamily(
+            lines, "sizzler_session_queue_depth", "gauge",
+            "Packets queued towards the connection, by session",
+            [
+                (labels[session], session.toWSQueue.qsize())
+                for session in self.sessions
+            ])
+
+        self.__renderFamily(
+            lines, "sizzler_sessions", "gauge", "Sessions open",
+            [("", len(self.sessions))])
+        self.__renderFamily(
+            lines, "sizzler_sessions_opened_total", "counter",
+            "Sessions opened", [("", self.sessionsOpened)])
+        self.__renderFamily(
+            lines, "sizzler_reconnects_total", "counter",
+            "Reconnections of clients", [("", self.reconnects)])
+
+        stats = dict([
+            (queueName, queue.stats())
+            for queueName, queue in self.queues.items()
+        ])
+        for key, name, kind, description in [
+            ("depth", "depth", "gauge", "Packets queued"),
+            ("bytes", "bytes", "gauge", "Bytes of packets queued"),
+            ("enqueued", "enqueued_total", "counter", "Packets enqueued"),
+            ("dequeued", "dequeued_total", "counter", "Packets dequeued"),
+            ("dropped", "dropped_total", "counter", "Packets dropped"),
+            ("droppedBytes", "dropped_bytes_total", "counter",
+                "Bytes of packets dropped"),
+        ]:
+            self.__renderFamily(
+                lines, "sizzler_queue_%s" % name, kind,
+                "%s, by queue" % description,
+                [
+                    ('{queue="%s"}' % queueName, stats[queueName][key])
+                    for queueName in self.queues
+                ])
+
+        return "\n".join(lines) + "\n"
+
+    # ---- HTTP endpoint
+
+    async def __handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip(): pass
+            if request.split(b" ")[:2] == [b"GET", b"/metrics"]:
+                status, body = "200 OK", self.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found, try /metrics\n"
+            writer.write((
+                "HTTP/1.0 %s\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n\r\n" % (status, len(body))
+            ).encode("ascii") + body)
+            await writer.drain()
+        except Exception as e:
+            debug("Metrics request failed: %s" % e)
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        # serve metrics via HTTP on http://host:port/metrics
+        self.server = await asyncio.start_server(self.__handle, host, port)
+        info("Metrics available at http://%s:%d/metrics" % (host, port))
+
+
+METRICS = MetricsRegistry()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+# Sizing of the TUN device's MTU and of frames after the path between the
+# peers. An IP packet of the TUN device travels in one frame, which goes in
+# one WebSocket message over TLS over TCP. Everything added on the way must
+# fit into the MTU of the path as well, or each full-size packet costs two
+# TCP segments (and reverse proxies see frames larger than the MTU).
+
+import socket
+from logging import info, debug, critical, exception
+
+from .packet import PACKET_INFO_SIZE
+from .crypto.padding import PADDING_TOTAL_OVERHEAD
+
+# per frame: packet info, frame type, "s-" sequence header of resumable
+# sessions (see _wssession.py), padding header and encryption
+FRAME_OVERHEAD = PACKET_INFO_SIZE + 2 + (2 + 8) + PADDING_TOTAL_OVERHEAD
+
+# per message: TLS 1.3 record (header, content type, tag), WebSocket header
+# of a masked message shorter than 64kB
+STREAM_OVERHEAD = (5 + 1 + 16) + (2 + 2 + 4)
+
+# per TCP segment: IPv6 header (the larger one, we can't know in advance),
+# TCP header with timestamps option
+SEGMENT_OVERHEAD = 40 + 20 + 12
+
+MTU_MIN = 576
+
+IP_MTU = 14                 # from linux/in.h, not exported by socket
+IPV6_MTU = 24
+
+
+def getTunnelMTU(pathMTU):
+    # MTU of the TUN device, so that frames of full-size packets fit into a
+    # single TCP segment over a path of `pathMTU`
+    mtu = pathMTU - SEGMENT_OVERHEAD - STREAM_OVERHEAD - FRAME_OVERHEAD
+    return max(MTU_MIN, mtu)
+
+def getFrameSize(tunnelMTU):
+    # size of the encrypted frame of a full-size packet of the TUN device,
+    # which random padding should not exceed
+    return tunnelMTU + FRAME_OVERHEAD
+
+def getPathMTU(websocket):
+    # The path MTU of the socket under a WebSocket connection, as known to
+    # the kernel, or None. For localhost, this is the loopback MTU.
+    try:
+        sock = websocket.transport.get_extra_info("socket")
+        if sock.family == socket.AF_INET:
+            return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        if sock.family == socket.AF_INET6:
+            return sock.getsockopt(socket.IPPROTO_IPV6, IPV6_MTU)
+    except Exception as e:
+        debug("Cannot get path MTU of connection: %s" % e)
+    return None
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Handling of packets with a virtio-net header, as read from and written to a
+# TUN device with IFF_VNET_HDR. Such a device passes TCP super-packets of up
+# to 64kB (GSO/TSO), and packets whose checksum is only partially computed
+# (only the pseudo header), to be completed by whoever sends them out.
+#
+# These helpers convert between packets with a header and packets without
+# (by completing checksums and segmenting super-packets in software), and
+# split super-packets too large for a frame into smaller super-packets.
+
+import struct
+
+from .packet import PACKET_INFO_SIZE, VNET_HEADER, VNET_HEADER_SIZE
+
+VIRTIO_NET_HDR_F_NEEDS_CSUM = 0x01
+VIRTIO_NET_HDR_GSO_NONE = 0x00
+VIRTIO_NET_HDR_GSO_TCPV4 = 0x01
+VIRTIO_NET_HDR_GSO_TCPV6 = 0x04
+VIRTIO_NET_HDR_GSO_ECN = 0x80
+
+TCP_FIN, TCP_PSH, TCP_CWR = 0x01, 0x08, 0x80
+PROTOCOL_TCP, PROTOCOL_UDP = 6, 17
+
+ZERO_VNET_HEADER = bytes(VNET_HEADER_SIZE)
+HEAD_SIZE = PACKET_INFO_SIZE + VNET_HEADER_SIZE
+
+
+def onesComplementSum(data, initial=0):
+    # 16-bit ones' complement sum of `data`, as used by IP checksums
+    if len(data) % 2: data = bytes(data) + b"\x00"
+    total = int.from_bytes(data, "big") + initial
+    folded = total % 0xFFFF
+    return 0xFFFF if folded == 0 and total else folded
+
+def _pseudoHeaderSum(ip, protocol, length):
+    if ip[0] >> 4 == 4:
+        pseudo = bytes(ip[12:20]) + struct.pack("!BBH", 0, protocol, length)
+    else:
+        pseudo = bytes(ip[8:40]) + struct.pack("!I3xB", length, protocol)
+    return onesComplementSum(pseudo)
+
+def _completeChecksum(ip, start, offset):
+    # the checksum field holds the pseudo header sum, add up the rest
+    checksum = ~onesComplementSum(ip[start:]) & 0xFFFF
+    if checksum == 0 and offset == 6: checksum = 0xFFFF   # UDP
+    struct.pack_into("!H", ip, start + offset, checksum)
+
+def _tcpLayout(ip):
+    # returns offset of the TCP header and of its payload, or None
+    if ip[0] >> 4 == 4:
+        if ip[9] != PROTOCOL_TCP: return None
+        tcpStart = (ip[0] & 0x0F) * 4
+    else:
+        if ip[6] != PROTOCOL_TCP: return None
+        tcpStart = 40
+    if len(ip) < tcpStart + 20: return None
+    return tcpStart, tcpStart + (ip[tcpStart + 12] >> 4) * 4
+
+def _resegment(ip, chunkSize, gsoSize, partial):
+    # Cut the payload of TCP super-packet `ip` into chunks of `chunkSize`
+    # bytes, and return an IP packet for each, with fixed up lengths, IDs,
+    # sequence numbers, flags and checksums. With `partial`, TCP checksums
+    # are left partial (pseudo header only) for offloading.
+    layout = _tcpLayout(ip)
+    if not layout: return []
+    tcpStart, headerLength = layout
+    version = ip[0] >> 4
+    header, payload = bytes(ip[:headerLength]), memoryview(ip)[headerLength:]
+    sequence, = struct.unpack_from("!I", header, tcpStart + 4)
+    flags = header[tcpStart + 13]
+    ipID, = struct.unpack_from("!H", header, 4)
+
+    packets = []
+    for offset in range(0, len(payload), chunkSize):
+        chunk = payload[offset:offset+chunkSize]
+        packet = bytearray(header)
+        packet += chunk
+        segmentFlags = flags
+        if offset + chunkSize < len(payload):
+            segmentFlags &= ~(TCP_FIN | TCP_PSH) & 0xFF
+        if offset > 0:
+            segmentFlags &= ~TCP_CWR & 0xFF
+        packet[tcpStart + 13] = segmentFlags
+        struct.pack_into("!I", packet, tcpStart + 4,
+            (sequence + offset) & 0xFFFFFFFF)
+
+        if version == 4:
+            struct.pack_into("!HH", packet, 2,
+                len(packet), (ipID + offset // gsoSize) & 0xFFFF)
+            struct.pack_into("!H", packet, 10, 0)
+            struct.pack_into("!H", packet, 10,
+                ~onesComplementSum(packet[:tcpStart]) & 0xFFFF)
+        else:
+            struct.pack_into("!H", packet, 4, len(packet) - 40)
+
+        tcpLength = len(packet) - tcpStart
+        pseudo = _pseudoHeaderSum(packet, PROTOCOL_TCP, tcpLength)
+        if partial:
+            struct.pack_into("!H", packet, tcpStart + 16, pseudo)
+        else:
+            struct.pack_into("!H", packet, tcpStart + 16, 0)
+            struct.pack_into("!H", packet, tcpStart + 16, ~onesComplementSum(
+                packet[tcpStart:], pseudo) & 0xFFFF)
+        packets.append(packet)
+    return packets
+
+
+def addVnetHeader(packet):
+    # packet without header -> packet with a header requesting nothing
+    return b"".join([
+        memoryview(packet)[:PACKET_INFO_SIZE],
+        ZERO_VNET_HEADER,
+        memoryview(packet)[PACKET_INFO_SIZE:]
+    ])
+
+def removeVnetHeader(packet):
+    # Packet with header -> list of packets without, complete on their own.
+    # Returns an empty list for malformed packets.
+    if len(packet) < HEAD_SIZE + 20: return []
+    flags, gsoType, hdrLength, gsoSize, csumStart, csumOffset = \
+        VNET_HEADER.unpack_from(packet, PACKET_INFO_SIZE)
+    info = bytes(packet[:PACKET_INFO_SIZE])
+    gsoType &= ~VIRTIO_NET_HDR_GSO_ECN
+
+    if gsoType == VIRTIO_NET_HDR_GSO_NONE:
+        if not flags & VIRTIO_NET_HDR_F_NEEDS_CSUM:
+            return [info + bytes(packet[HEAD_SIZE:])]
+        ip = bytearray(packet[HEAD_SIZE:])
+        if csumStart + csumOffset + 2 > len(ip): return []
+        _completeChecksum(ip, csumStart, csumOffset)
+        return [info + ip]
+
+    if gsoType in [VIRTIO_NET_HDR_GSO_TCPV4, VIRTIO_NET_HDR_GSO_TCPV6]:
+        if not gsoSize: return []
+        return [
+            info + segment for segment in _resegment(
+                packet[HEAD_SIZE:], gsoSize, gsoSize, partial=False)
+        ]
+    return []
+
+def splitVnetPacket(packet, maxLength):
+    # Packet with header -> list of packets with header, each no longer than
+    # `maxLength`. TCP super-packets are split at segment boundaries into
+    # smaller super-packets, still to be segmented by the receiving kernel.
+    if len(packet) <= maxLength: return [packet]
+    if len(packet) < HEAD_SIZE + 20: return []
+    flags, gsoType, hdrLength, gsoSize, csumStart, csumOffset = \
+        VNET_HEADER.unpack_from(packet, PACKET_INFO_SIZE)
+    layout = _tcpLayout(packet[HEAD_SIZE:])
+    if not gsoSize or not layout: return []
+    segments = (maxLength - HEAD_SIZE - layout[1]) // gsoSize
+    if segments < 1: return []
+
+    info = bytes(packet[:PACKET_INFO_SIZE])
+    packets = []
+    for ip in _resegment(
+        packet[HEAD_SIZE:],
+        segments * gsoSize,
+        gsoSize,
+        partial=bool(flags & VIRTIO_NET_HDR_F_NEEDS_CSUM)
+    ):
+        pieceType, pieceSize = gsoType, gsoSize
+        if len(ip) - layout[1] <= gsoSize:
+            # a single segment is no super-packet anymore
+            pieceType, pieceSize = VIRTIO_NET_HDR_GSO_NONE, 0
+        header = VNET_HEADER.pack(
+            flags, pieceType, hdrLength, pieceSize, csumStart, csumOffset)
+        packets.append(info + header + ip)
+    return packets
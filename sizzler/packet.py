@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# Helpers for looking into IP packets as read from or written to the TUN
+# device. The device is opened without IFF_NO_PI, so each packet begins with
+# 4 bytes of packet information (flags and protocol), then the IP header.
+# In offload mode (IFF_VNET_HDR), a virtio-net header follows in between.
+
+import struct
+
+PACKET_INFO_SIZE = 4
+
+# virtio_net_hdr: flags, gso_type, hdr_len, gso_size, csum_start, csum_offset
+VNET_HEADER = struct.Struct("=BBHHHH")
+VNET_HEADER_SIZE = VNET_HEADER.size
+
+# where the IP header starts in packets of the TUN device of this process
+ipOffset = PACKET_INFO_SIZE
+
+FLOW_PORT_PROTOCOLS = (6, 17, 132)  # TCP, UDP, SCTP
+
+
+def setVnetHeader(enabled):
+    # called by the TUN device, telling whether its packets carry a header
+    global ipOffset
+    ipOffset = PACKET_INFO_SIZE + (VNET_HEADER_SIZE if enabled else 0)
+
+
+def getSourceAddress(packet):
+    # returns the IPv4/IPv6 source address as bytes, or None
+    offset = ipOffset
+    if len(packet) < offset + 20: return None
+    version = packet[offset] >> 4
+    if version == 4:
+        return bytes(packet[offset+12:offset+16])
+    if version == 6 and len(packet) >= offset + 40:
+        return bytes(packet[offset+8:offset+24])
+    return None
+
+def getDestinationAddress(packet):
+    # returns the IPv4/IPv6 destination address as bytes, or None
+    offset = ipOffset
+    if len(packet) < offset + 20: return None
+    version = packet[offset] >> 4
+    if version == 4:
+        return bytes(packet[offset+16:offset+20])
+    if version == 6 and len(packet) >= offset + 40:
+        return bytes(packet[offset+24:offset+40])
+    return None
+
+def getFlowKey(packet):
+    # Returns bytes identifying the flow of the packet: addresses, protocol,
+    # and for TCP/UDP/SCTP also the ports. Fragments use no ports, so all
+    # fragments of a datagram stay together. None if not an IP packet.
+    offset = ipOffset
+    if len(packet) < offset + 20: return None
+    version = packet[offset] >> 4
+    if version == 4:
+        protocol = packet[offset+9]
+        headerLength = (packet[offset] & 0x0F) * 4
+        fragmented = (packet[offset+6] & 0x3F) or packet[offset+7]
+        key = bytes(packet[offset+9:offset+10]) + \
+            bytes(packet[offset+12:offset+20])
+        start = offset + headerLength
+    elif version == 6 and len(packet) >= offset + 40:
+        protocol = packet[offset+6]
+        fragmented = False
+        key = bytes(packet[offset+6:offset+7]) + \
+            bytes(packet[offset+8:offset+40])
+        start = offset + 40
+    else:
+        return None
+    if protocol in FLOW_PORT_PROTOCOLS and not fragmented:
+        key += bytes(packet[start:start+4])
+    return key
+
+# Priority lanes of packets, see getPriority()
+PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
+PRIORITY_LANES = 3
+
+DSCP_INTERACTIVE = (34, 36, 38, 40, 46, 48, 56)    # AF4x, CS5, EF, CS6, CS7
+DSCP_BULK = (1, 8)                                  # LE, CS1
+TCP_FIN, TCP_SYN, TCP_RST, TCP_ACK = 0x01, 0x02, 0x04, 0x10
+
+def getPriority(packet, small=128, interactivePorts=(), bulkPorts=()):
+    # Returns the lane of the packet: interactive for DSCP marked as such,
+    # packets from or to `interactivePorts`, and other than TCP packets up
+    # to `small` bytes; bulk for DSCP LE/CS1 and `bulkPorts`; normal for
+    # everything else. TCP packets are classified by what all packets of
+    # their connection share, so that segments aren't reordered by lanes.
+    offset = ipOffset
+    if len(packet) < offset + 20: return PRIORITY_NORMAL
+    version = packet[offset] >> 4
+    if version == 4:
+        dscp = packet[offset+1] >> 2
+        protocol = packet[offset+9]
+        start = offset + (packet[offset] & 0x0F) * 4
+        if (packet[offset+6] & 0x3F) or packet[offset+7]: protocol = None
+    elif version == 6 and len(packet) >= offset + 40:
+        dscp = ((packet[offset] & 0x0F) << 2) | (packet[offset+1] >> 6)
+        protocol = packet[offset+6]
+        start = offset + 40
+    else:
+        return PRIORITY_NORMAL
+
+    if dscp in DSCP_INTERACTIVE: return PRIORITY_INTERACTIVE
+    if dscp in DSCP_BULK: return PRIORITY_BULK
+    if protocol != 6 and len(packet) - offset <= small:
+        return PRIORITY_INTERACTIVE
+    if protocol not in FLOW_PORT_PROTOCOLS or len(packet) < start + 4:
+        return PRIORITY_NORMAL
+    source = (packet[start] << 8) | packet[start+1]
+    destination = (packet[start+2] << 8) | packet[start+3]
+    if source in interactivePorts or destination in interactivePorts:
+        return PRIORITY_INTERACTIVE
+    if source in bulkPorts or destination in bulkPorts:
+        return PRIORITY_BULK
+    return PRIORITY_NORMAL
+
+def isTcpControl(packet):
+    # Tells if the packet is a TCP segment without payload opening or
+    # closing a connection (SYN, FIN) or only acknowledging (pure ACK).
+    # These may go ahead of the data segments of their flow: being empty,
+    # they don't reorder its payload. RST could cut off data before it.
+    offset = ipOffset
+    if len(packet) < offset + 20: return False
+    version = packet[offset] >> 4
+    if version == 4:
+        if packet[offset+9] != 6: return False
+        if (packet[offset+6] & 0x3F) or packet[offset+7]: return False
+        start = offset + (packet[offset] & 0x0F) * 4
+    elif version == 6 and len(packet) >= offset + 40:
+        if packet[offset+6] != 6: return False  # incl. extension headers
+        start = offset + 40
+    else:
+        return False
+    if len(packet) < start + 20: return False
+    if len(packet) != start + (packet[start+12] >> 4) * 4: return False
+    flags = packet[start+13]
+    if flags & TCP_RST: return False
+    return bool(flags & (TCP_SYN | TCP_FIN)) or flags & 0x3F == TCP_ACK
+
+TCP_OPTION_END, TCP_OPTION_NOP, TCP_OPTION_MSS = 0, 1, 2
+VNET_NEEDS_CSUM = 0x01
+
+def clampMSS(packet, mtu):
+    # Returns the packet, with the MSS option of TCP SYN packets lowered to
+    # what fits into `mtu`, as a modified copy. The checksum is updated
+    # incrementally (RFC 1624), unless left partial for offloading.
+    offset = ipOffset
+    if len(packet) < offset + 20: return packet
+    version = packet[offset] >> 4
+    if version == 4:
+        if packet[offset+9] != 6: return packet
+        if (packet[offset+6] & 0x3F) or packet[offset+7]: return packet
+        start = offset + (packet[offset] & 0x0F) * 4
+        mss = mtu - 40
+    elif version == 6 and len(packet) >= offset + 40:
+        if packet[offset+6] != 6: return packet   # incl. extension headers
+        start = offset + 40
+        mss = mtu - 60
+    else:
+        return packet
+    if len(packet) < start + 20 or not packet[start+13] & TCP_SYN:
+        return packet
+
+    end = min(len(packet), start + (packet[start+12] >> 4) * 4)
+    i = start + 20
+    while i + 1 < end and packet[i] != TCP_OPTION_END:
+        if packet[i] == TCP_OPTION_NOP:
+            i += 1
+            continue
+        length = packet[i+1]
+        if length < 2: return packet
+        if packet[i] == TCP_OPTION_MSS and length == 4 and i + 4 <= end:
+            old = (packet[i+2] << 8) | packet[i+3]
+            if old <= mss: return packet
+            clamped = bytearray(packet)
+            clamped[i+2:i+4] = struct.pack("!H", mss)
+            partial = offset > PACKET_INFO_SIZE and \
+                packet[PACKET_INFO_SIZE] & VNET_NEEDS_CSUM
+            if not partial:
+                if (i - start) % 2:
+                    # the field is not aligned to 16 bits, so it's summed
+                    # with its bytes swapped
+                    old = ((old & 0xFF) << 8) | (old >> 8)
+                    mss = ((mss & 0xFF) << 8) | (mss >> 8)
+                checksum, = struct.unpack_from("!H", packet, start + 16)
+                total = (~checksum & 0xFFFF) + (~old & 0xFFFF) + mss
+                total = (total & 0xFFFF) + (total >> 16)
+                total = (total & 0xFFFF) + (total >> 16)
+                struct.pack_into("!H", clamped, start + 16, ~total & 0xFFFF)
+            return clamped
+        i += length
+    return packet
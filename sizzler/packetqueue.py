@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import asyncio
+import collections
+
+from .packet import getPriority, getFlowKey, isTcpControl, \
+    PRIORITY_INTERACTIVE, PRIORITY_LANES
+
+# What to do with packets once a queue is full:
+#   taildrop: drop the incoming packet
+#   headdrop: drop the oldest packets to make room for it
+#   codel:    like taildrop when full, but also drop packets on dequeue once
+#             they have been waiting longer than `target` seconds for at
+#             least `interval` seconds (CoDel, RFC 8289)
+QUEUE_POLICIES = ["taildrop", "headdrop", "codel"]
+
+CODEL_TARGET = 0.005
+CODEL_INTERVAL = 0.1
+CODEL_MIN_BYTES = 1500  # never drop when less than this is queued
+
+# How packets are taken from the lanes of a PriorityPacketQueue:
+#   strict: always from the most important lane with packets
+#   drr:    deficit round-robin, each lane gets bandwidth proportional to
+#           its weight when all are busy
+PRIORITY_SCHEDULERS = ["strict", "drr"]
+PRIORITY_QUANTUM = 1500     # bytes per round and unit of weight, for drr
+PRIORITY_FLOWS = 4096       # flows whose lane is remembered
+
+# Bytes per round and client of a FairPacketQueue.
+FAIR_QUANTUM = 1500
+
+
+class PacketQueue:
+
+    # A FIFO queue of packets, for use in place of asyncio.Queue. It's
+    # bounded in packets and/or bytes (0 means unlimited), putting never
+    # blocks, and packets are dropped according to `policy` instead.
+
+    def __init__(
+        self,
+        maxPackets=0,
+        maxBytes=0,
+        policy="taildrop",
+        target=CODEL_TARGET,
+        interval=CODEL_INTERVAL
+    ):
+        if policy not in QUEUE_POLICIES:
+            raise Exception("Unknown queue policy: %s" % policy)
+        self.maxPackets = maxPackets
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.target = target
+        self.interval = interval
+
+        self.items = collections.deque()    # (packet, time of enqueue)
+        self.bytes = 0
+        self.getters = collections.deque()
+
+        # counters
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.droppedBytes = 0
+        self.peak = 0
+
+        # CoDel state
+        self.dropping = False
+        self.firstAboveTime = 0
+        self.dropNext = 0
+        self.count = 0
+        self.lastCount = 0
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def stats(self):
+        return {
+            "depth": len(self.items),
+            "bytes": self.bytes,
+            "peak": self.peak,
+            "enqueued": self.enqueued,
+            "dequeued": self.dequeued,
+            "dropped": self.dropped,
+            "droppedBytes": self.droppedBytes,
+        }
+
+    # ---- Enqueue
+
+    def __isFull(self, length):
+        if self.maxPackets and len(self.items) >= self.maxPackets:
+            return True
+        if self.maxBytes and self.bytes + length > self.maxBytes:
+            return True
+        return False
+
+    def __drop(self, packet):
+        self.dropped += 1
+        self.droppedBytes += len(packet)
+
+    def put_nowait(self, packet):
+        # returns False if the packet was dropped
+        length = len(packet)
+        if self.__isFull(length):
+            if self.policy != "headdrop" or \
+                    (self.maxBytes and length > self.maxBytes):
+                self.__drop(packet)
+                return False
+            while self.items and self.__isFull(length):
+                old, t = self.items.popleft()
+                self.bytes -= len(old)
+                self.__drop(old)
+        self.items.append((packet, time.monotonic()))
+        self.bytes += length
+        self.enqueued += 1
+        self.peak = max(self.peak, len(self.items))
+        self.__wakeup()
+        return True
+
+    def __wakeup(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def put(self, packet):
+        return self.put_nowait(packet)
+
+    # ---- Dequeue
+
+    def __popleft(self):
+        packet, enqueued = self.items.popleft()
+        self.bytes -= len(packet)
+        return packet, enqueued
+
+    def __codelDoDequeue(self, now):
+        # returns the next packet or None, and whether it's ok to drop it
+        if not self.items:
+            self.firstAboveTime = 0
+            return None, False
+        packet, enqueued = self.__popleft()
+        if now - enqueued < self.target or self.bytes <= CODEL_MIN_BYTES:
+            self.firstAboveTime = 0
+            return packet, False
+        if self.firstAboveTime == 0:
+            self.firstAboveTime = now + self.interval
+            return packet, False
+        return packet, now >= self.firstAboveTime
+
+    def __codelControlLaw(self, t):
+        return t + self.interval / math.sqrt(self.count)
+
+    def __codelDequeue(self):
+        now = time.monotonic()
+        packet, okToDrop = self.__codelDoDequeue(now)
+        if self.dropping:
+            if not okToDrop: self.dropping = False
+            while self.dropping and now >= self.dropNext:
+                self.__drop(packet)
+                self.count += 1
+                packet, okToDrop = self.__codelDoDequeue(now)
+                if not okToDrop:
+                    self.dropping = False
+                else:
+                    self.dropNext = self.__codelControlLaw(self.dropNext)
+        elif okToDrop:
+            self.__drop(packet)
+            packet, okToDrop = self.__codelDoDequeue(now)
+            self.dropping = True
+            delta = self.count - self.lastCount
+            if delta > 1 and now - self.dropNext < 16 * self.interval:
+                self.count = delta
+            else:
+                self.count = 1
+            self.dropNext = self.__codelControlLaw(now)
+            self.lastCount = self.count
+        return packet
+
+    def __dequeue(self):
+        # returns the next packet, or None if all remaining were dropped
+        if self.policy == "codel":
+            packet = self.__codelDequeue()
+        elif self.items:
+            packet, enqueued = self.__popleft()
+        else:
+            packet = None
+        if packet is not None: self.dequeued += 1
+        return packet
+
+    def get_nowait(self):
+        packet = self.__dequeue()
+        if packet is None: raise asyncio.QueueEmpty()
+        return packet
+
+    async def get(self):
+        while True:
+            while not self.items:
+                getter = asyncio.get_event_loop().create_future()
+                self.getters.append(getter)
+                try:
+                    await getter
+                except:
+                    getter.cancel()
+                    try:
+                        self.getters.remove(getter)
+                    except ValueError:
+                        pass
+                    # pass on the wakeup we may have consumed
+                    if self.items: self.__wakeup()
+                    raise
+            packet = self.__dequeue()
+            if packet is not None: return packet
+
+
+class PriorityPacketQueue:
+
+    # Like PacketQueue, but packets are classified into lanes (interactive,
+    # normal, bulk; see packet.getPriority()), each a PacketQueue of its own
+    # with the given `queueOptions`. Packets are taken from the lanes by
+    # `scheduler`, so that e.g. SSH keystrokes and DNS queries don't wait
+    # behind bulk transfers. A flow stays in the lane of its first packet
+    # (as long as it is among the last PRIORITY_FLOWS seen), as packets of
+    # one flow in different lanes would be reordered. Only TCP segments
+    # without payload (SYN, FIN, pure ACKs, see packet.isTcpControl()) are
+    # always interactive, without choosing the lane of their flow.
+
+    def __init__(
+        self,
+        scheduler="strict",
+        small=128,
+        interactivePorts=(),
+        bulkPorts=(),
+        weights=(8, 4, 1),
+        queueOptions=None
+    ):
+        if scheduler not in PRIORITY_SCHEDULERS:
+            raise Exception("Unknown priority scheduler: %s" % scheduler)
+        assert len(weights) == PRIORITY_LANES and min(weights) > 0
+        self.scheduler = scheduler
+        self.small = small
+        self.interactivePorts = frozenset(interactivePorts)
+        self.bulkPorts = frozenset(bulkPorts)
+        self.lanes = [
+            PacketQueue(**(queueOptions or {})) for i in range(PRIORITY_LANES)
+        ]
+        self.getters = collections.deque()
+        self.flows = collections.OrderedDict()  # flow key -> lane
+
+        # deficit round-robin state
+        self.quanta = [PRIORITY_QUANTUM * weight for weight in weights]
+        self.deficits = [0] * PRIORITY_LANES
+        self.current = 0
+        self.visited = False    # if the current lane got its quantum
+
+    def qsize(self):
+        return sum([lane.qsize() for lane in self.lanes])
+
+    def empty(self):
+        return not any([lane.items for lane in self.lanes])
+
+    def stats(self):
+        total = {}
+        for lane in self.lanes:
+            for key, value in lane.stats().items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    # ---- Enqueue
+
+    def put_nowait(self, packet):
+        if isTcpControl(packet):
+            lane = PRIORITY_INTERACTIVE
+        else:
+            lane = self.__classify(packet)
+        if not self.lanes[lane].put_nowait(packet): return False
+        self.__wakeup()
+        return True
+
+    def __classify(self, packet):
+        # the lane of the packet's flow, chosen by its first packet
+        key = getFlowKey(packet)
+        if key is None:
+            return getPriority(
+                packet, self.small, self.interactivePorts, self.bulkPorts)
+        lane = self.flows.get(key)
+        if lane is not None:
+            self.flows.move_to_end(key)
+            return lane
+        lane = getPriority(
+            packet, self.small, self.interactivePorts, self.bulkPorts)
+        self.flows[key] = lane
+        if len(self.flows) > PRIORITY_FLOWS:
+            self.flows.popitem(last=False)
+        return lane
+
+    def __wakeup(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    async def put(self, packet):
+        return self.put_nowait(packet)
+
+    # ---- Dequeue
+
+    def __nextStrict(self):
+        for lane in self.lanes:
+            if lane.items: return lane
+        return None
+
+    def __nextDRR(self):
+        # each lane, when its turn comes, gets its quantum and sends packets
+        # as long as its deficit covers them
+        while not self.empty():
+            index = self.current
+            lane = self.lanes[index]
+            if lane.items:
+                if not self.visited:
+                    self.deficits[index] += self.quanta[index]
+                    self.visited = True
+                if len(lane.items[0][0]) <= self.deficits[index]:
+                    return lane
+            else:
+                self.deficits[index] = 0
+            self.current = (index + 1) % PRIORITY_LANES
+            self.visited = False
+        return None
+
+    def get_nowait(self):
+        while True:
+            if self.scheduler == "drr":
+                lane = self.__nextDRR()
+            else:
+                lane = self.__nextStrict()
+            if lane is None: raise asyncio.QueueEmpty()
+            try:
+                packet = lane.get_nowait()
+            except asyncio.QueueEmpty:
+                continue                # all dropped by CoDel, next lane
+            if self.scheduler == "drr":
+                self.deficits[self.current] -= len(packet)
+            return packet
+
+    async def get(self):
+        while True:
+            while self.empty():
+                getter = asyncio.get_event_loop().create_future()
+                self.getters.append(getter)
+                try:
+                    await getter
+                except:
+                    getter.cancel()
+                    try:
+                        self.getters.remove(getter)
+                    except ValueError:
+                        pass
+                    # pass on the wakeup we may have consumed
+                    if not self.empty(): self.__wakeup()
+                    raise
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+
+
+class FairPacketQueue:
+
+    # Like PacketQueue, but packets are put via lanes, one for each client
+    # (see lane()), each a PacketQueue of its own with the given
+    # `queueOptions`. Lanes with packets take turns by deficit round-robin
+    # with equal quanta, so each busy client gets an equal share, and a
+    # client sending too much only fills its own lane.
+
+    def __init__(self, queueOptions=None):
+        self.queueOptions = queueOptions or {}
+        self.lanes = {}     # client -> PacketQueue
+        self.users = {}     # client -> number of lanes handed out
+        self.getters = collections.deque()
+        # clients with packets, in turn, and their deficits
+        self.active = collections.deque()
+        self.deficits = {}
+        self.visited = False    # if the current client got its quantum
+        # counters of lanes no longer in use
+        self.retired = PacketQueue().stats()
+
+    def lane(self, client):
+        # Returns the lane of `client`, to put its packets in. Release it
+        # once done with it.
+        if client not in self.lanes:
+            self.lanes[client] = PacketQueue(**self.queueOptions)
+            self.users[client] = 0
+        self.users[client] += 1
+        return FairQueueLane(self, client)
+
+    def release(self, client):
+        self.users[client] -= 1
+        if self.users[client] <= 0 and client not in self.deficits:
+            self.__retire(client)
+
+    def __retire(self, client):
+        del self.users[client]
+        for key, value in self.lanes.pop(client).stats().items():
+            if key == "peak":
+                self.retired[key] = max(self.retired[key], value)
+            else:
+                self.retired[key] += value
+
+    def qsize(self):
+        return sum([lane.qsize() for lane in self.lanes.values()])
+
+    def empty(self):
+        return not self.active
+
+    def stats(self):
+        total = dict(self.retired)
+        for lane in self.lanes.values():
+            for key, value in lane.stats().items():
+                if key == "peak":
+                    total[key] = max(total[key], value)
+                else:
+                    total[key] += value
+        return total
+
+    # ---- Enqueue
+
+    def putInLane(self, client, packet):
+        lane = self.lanes[client]
+        if not lane.put_nowait(packet): return False
+        if client not in self.deficits:
+            self.deficits[client] = 0
+            self.active.append(client)
+        self.__wakeup()
+        return True
+
+    def __wakeup(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    # ---- Dequeue
+
+    def __deactivate(self, client):
+        self.active.popleft()
+        del self.deficits[client]
+        self.visited = False
+        if self.users[client] <= 0: self.__retire(client)
+
+    def get_nowait(self):
+        while self.active:
+            client = self.active[0]
+            lane = self.lanes[client]
+            if not lane.items:
+                self.__deactivate(client)
+                continue
+            if not self.visited:
+                self.deficits[client] += FAIR_QUANTUM
+                self.visited = True
+            if len(lane.items[0][0]) > self.deficits[client]:
+                self.active.rotate(-1)
+                self.visited = False
+                continue
+            try:
+                packet = lane.get_nowait()
+            except asyncio.QueueEmpty:
+                continue                # all dropped by CoDel
+            self.deficits[client] -= len(packet)
+            if not lane.items: self.__deactivate(client)
+            return packet
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while True:
+            while self.empty():
+                getter = asyncio.get_event_loop().create_future()
+                self.getters.append(getter)
+                try:
+                    await getter
+                except:
+                    getter.cancel()
+                    try:
+                        self.getters.remove(getter)
+                    except ValueError:
+                        pass
+                    # pass on the wakeup we may have consumed
+                    if not self.empty(): self.__wakeup()
+                    raise
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+
+
+class FairQueueLane:
+
+    # What a session puts its packets in, see FairPacketQueue.lane().
+
+    def __init__(self, queue, client):
+        self.queue = queue
+        self.client = client
+
+    def put_nowait(self, packet):
+        return self.queue.putInLane(self.client, packet)
+
+    async def put(self, packet):
+        return self.put_nowait(packet)
+
+    def release(self):
+        self.queue.release(self.client)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+from logging import info, debug, critical, exception
+
+
+class TokenBucket:
+
+    # Allows `rate` bytes per second on average, in bursts of up to `burst`
+    # bytes. Sizes are taken even if there aren't enough tokens, the bucket
+    # then owes them, and tells how long to wait until the debt is paid.
+
+    def __init__(self, rate, burst):
+        assert rate > 0 and burst > 0
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self, size):
+        # returns seconds to wait before sending `size` bytes
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= size
+        if self.tokens >= 0: return 0
+        return -self.tokens / self.rate
+
+
+def getShaper(buckets):
+    # Returns an async function, waiting until all of `buckets` (None for no
+    # limit) allow a frame of the given size, or None if none are set.
+    buckets = [each for each in buckets if each]
+    if not buckets: return None
+    if len(buckets) == 1:
+        bucket = buckets[0]
+        async def shapeOne(size):
+            delay = bucket.take(size)
+            if delay: await asyncio.sleep(delay)
+        return shapeOne
+    async def shape(size):
+        delay = max([each.take(size) for each in buckets])
+        if delay: await asyncio.sleep(delay)
+    return shape
+
+
+class Shaping:
+
+    # Token buckets limiting the frames of a transport's sessions, in bytes
+    # per second and per direction, with 0 for no limit. Each session has
+    # buckets of its own, and shares another pair with all sessions of the
+    # same client, as told by an identity chosen by the transport.
+
+    def __init__(
+        self,
+        sessionSend=0,
+        sessionReceive=0,
+        sessionBurst=65536,
+        clientSend=0,
+        clientReceive=0,
+        clientBurst=262144
+    ):
+        self.sessionSend = sessionSend
+        self.sessionReceive = sessionReceive
+        self.sessionBurst = sessionBurst
+        self.clientSend = clientSend
+        self.clientReceive = clientReceive
+        self.clientBurst = clientBurst
+        self.clients = {}   # identity -> [send bucket, receive bucket, users]
+
+    def __bucket(self, rate, burst):
+        return TokenBucket(rate, burst) if rate else None
+
+    def acquire(self, identity):
+        # returns shapers for sending and receiving of a new session
+        client = self.clients.get(identity)
+        if client is None:
+            client = self.clients[identity] = [
+                self.__bucket(self.clientSend, self.clientBurst),
+                self.__bucket(self.clientReceive, self.clientBurst),
+                0
+            ]
+        client[2] += 1
+        return (
+            getShaper([
+                self.__bucket(self.sessionSend, self.sessionBurst), client[0]
+            ]),
+            getShaper([
+                self.__bucket(self.sessionReceive, self.sessionBurst),
+                client[1]
+            ])
+        )
+
+    def release(self, identity):
+        # called once a session of `identity` has ended
+        client = self.clients.get(identity)
+        if client is None: return
+        client[2] -= 1
+        if client[2] <= 0: del self.clients[identity]
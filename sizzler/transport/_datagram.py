@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Connections over UDP, looking like WebSocket connections to a session, so
+# that the same padded and encrypted frames are sent one per datagram. Each
+# datagram starts with the connection's ID, chosen by the client at random:
+# the server tells connections apart by it, not by address, so a client may
+# move to another address (e.g. after a NAT rebinding) and carry on. The ID
+# is sent in the clear though, so the server only follows the client to an
+# address once a frame from there was decrypted and its nonce was fresh
+# (see `confirm`). A new connection is set up only once its first datagram
+# turns out to be a heartbeat for its ID, see udpserver.py.
+#
+# With several workers, the kernel passes datagrams to workers by their
+# addresses: a client moving elsewhere reaches another worker, which doesn't
+# know its connection, and the client reconnects instead.
+#
+# Datagrams may get lost or reordered, which sessions cope with as long as
+# frames don't depend on each other: nonces are checked in a window, but
+# zlib compression (one stream per connection) and resuming (sequences of
+# frames) are not used over UDP.
+
+import os
+import asyncio
+import collections
+from logging import info, debug, critical, exception
+from urllib.parse import urlsplit
+
+from ..mtu import getTunnelMTU, getFrameSize
+from ..crypto.padding import PADDING_TOTAL_OVERHEAD
+
+UDP_ID_SIZE = 16
+UDP_INBOX_MAX = 4096        # datagrams not yet received by a session
+UDP_PENDING_MAX = 64        # new connections not yet authenticated ...
+UDP_PENDING_INBOX = 8       # ... and datagrams each may have meanwhile
+UDP_PROBE_TIMEOUT = 3       # for the peer to answer, or it's unreachable
+UDP_PATH_MTU = 1500         # assumed if the frame size isn't configured
+
+
+def getDatagramSessionOptions(sessionOptions):
+    # WebsocketSession arguments for sessions over UDP. Aggregated frames
+    # are no larger than the frame of a full-size packet, sized to fit into
+    # the path MTU (see mtu.py), as larger datagrams would be fragmented.
+    options = dict(sessionOptions)
+    if options.get("compression") == "zlib":
+        options["compression"] = "none"
+    frameSize = options.get("paddingTarget") or \
+        getFrameSize(getTunnelMTU(UDP_PATH_MTU))
+    options["aggregateBytes"] = min(
+        options.get("aggregateBytes", 0), frameSize - PADDING_TOTAL_OVERHEAD)
+    return options
+
+def parseDatagramURI(uri):
+    # host and port of a udp://host:port URI
+    parts = urlsplit(uri)
+    if parts.scheme != "udp" or not parts.hostname or not parts.port:
+        raise Exception("Invalid URI for UDP: %s" % uri)
+    return parts.hostname, parts.port
+
+
+class DatagramConnection:
+
+    # One connection, fed with datagrams by the protocol of its socket.
+    # `send`, `recv`, `ping` and `close` behave like those of WebSocket
+    # connections, as far as sessions use them. With an `address` of None,
+    # the socket is connected to the peer; otherwise datagrams go to where
+    # the last authentic one came from. At most `inboxMax` datagrams wait
+    # to be received, further ones are dropped.
+
+    def __init__(
+        self,
+        transport,
+        address,
+        connectionID,
+        onClose=None,
+        inboxMax=UDP_INBOX_MAX
+    ):
+        self.transport = transport
+        self.remote_address = address
+        self.roaming = address is not None
+        self.connectionID = connectionID
+        self.path = "/?_=%s" % connectionID.hex()
+        self.onClose = onClose
+        self.inbox = collections.deque()    # (data, address)
+        self.inboxMax = inboxMax
+        self.lastAddress = address          # of the datagram last received
+        self.waiter = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = None      # reason, once closed
+
+    def received(self, data, address):
+        # a datagram for this connection, without the ID
+        if self.closed: return
+        if len(self.inbox) >= self.inboxMax: return
+        self.inbox.append((data, address))
+        if self.waiter and not self.waiter.done(): self.waiter.set_result(None)
+
+    async def recv(self):
+        while not self.inbox:
+            if self.closed: raise Exception(self.closed)
+            self.waiter = asyncio.get_event_loop().create_future()
+            await self.waiter
+        data, self.lastAddress = self.inbox.popleft()
+        return data
+
+    def confirm(self):
+        # called by the session once the datagram last received turned out
+        # to be authentic, so it's safe to follow the peer there
+        if self.roaming and self.lastAddress != self.remote_address:
+            debug("Connection over UDP moved from %s to %s." % (
+                self.remote_address, self.lastAddress))
+            self.remote_address = self.lastAddress
+
+    async def send(self, data):
+        if not self.writable.is_set(): await self.writable.wait()
+        if self.closed: raise Exception(self.closed)
+        self.transport.sendto(self.connectionID + data, self.remote_address)
+
+    async def ping(self):
+        # there are no pings, sessions over UDP measure the RTT themselves
+        return asyncio.get_event_loop().create_future()
+
+    def close(self, reason="Connection closed."):
+        if self.closed: return
+        self.closed = reason
+        self.writable.set()
+        if self.waiter and not self.waiter.done(): self.waiter.set_result(None)
+        if self.onClose: self.onClose(self)
+
+    def probe(self, session):
+        # close unless `session` heard from its peer in time
+        def check():
+            if not session.peerAuthenticated:
+                self.close("No answer over UDP from %s." % (
+                    self.remote_address,))
+        asyncio.get_event_loop().call_later(UDP_PROBE_TIMEOUT, check)
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+
+    # Passes datagrams to connections by their ID. Unknown IDs are passed to
+    # `accept`, if given, which returns a new connection or None.
+
+    def __init__(self, accept=None):
+        self.connections = {}   # ID -> DatagramConnection
+        self.accept = accept
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        connectionID = data[:UDP_ID_SIZE]
+        connection = self.connections.get(connectionID)
+        if connection is None:
+            if not self.accept or len(data) <= UDP_ID_SIZE: return
+            connection = self.accept(connectionID, address)
+            if connection is None: return
+        connection.received(data[UDP_ID_SIZE:], address)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, only reported on connected sockets,
+        # i.e. those of clients with their only connection
+        debug("UDP error: %s" % exc)
+        if not self.accept:
+            for connection in list(self.connections.values()):
+                connection.close("UDP error: %s" % exc)
+
+    def connection_lost(self, exc):
+        for connection in list(self.connections.values()):
+            connection.close("UDP socket closed.")
+
+    def pause_writing(self):
+        for connection in self.connections.values():
+            connection.writable.clear()
+
+    def resume_writing(self):
+        for connection in self.connections.values():
+            connection.writable.set()
+
+    def register(self, connection):
+        self.connections[connection.connectionID] = connection
+
+    def unregister(self, connection):
+        if self.connections.get(connection.connectionID) is connection:
+            del self.connections[connection.connectionID]
+
+
+class DatagramConnector:
+
+    # Async context manager of a new connection over UDP to `uri`, on a
+    # socket of its own, like websockets' `connect`.
+
+    def __init__(self, uri):
+        self.host, self.port = parseDatagramURI(uri)
+        self.transport = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            DatagramProtocol, remote_addr=(self.host, self.port))
+        connection = DatagramConnection(
+            self.transport,
+            None,
+            os.urandom(UDP_ID_SIZE),
+            onClose=protocol.unregister
+        )
+        protocol.register(connection)
+        self.connection = connection
+        return connection
+
+    async def __aexit__(self, *args):
+        self.connection.close()
+        self.transport.close()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import collections
+from logging import info, debug, critical, exception
+
+# States of sessions without a connection are kept this many seconds, and
+# looked for at most every RESUME_PRUNE_INTERVAL seconds.
+RESUME_TIMEOUT = 60
+RESUME_PRUNE_INTERVAL = 1
+
+# A receiver acknowledges frames at least every this many frames, and with
+# each heartbeat.
+RESUME_ACK_FRAMES = 64
+
+
+class ResumeState:
+
+    # What a session needs to resume on a new connection: frames sent but
+    # not yet acknowledged by the peer (at most `size`, the oldest are given
+    # up), and the sequence numbers of the last frames sent and received.
+    # Each state has a random epoch, told to the peer with the sequence
+    # numbers: a peer with another epoch than before has been restarted and
+    # lost its state, so it counts from scratch.
+
+    def __init__(self, resumeID, size):
+        self.resumeID = resumeID
+        self.size = size
+        self.unacknowledged = collections.deque()   # (sequence, packets)
+        self.sequence = 0
+        self.received = 0
+        self.epoch = int.from_bytes(os.urandom(8), "little")
+        self.peerEpoch = None
+        self.owner = None           # session using this state
+        self.released = time.time() # when the last owner went away
+
+    def record(self, packets):
+        # returns the sequence number for a new frame carrying `packets`
+        self.sequence += 1
+        self.unacknowledged.append((self.sequence, packets))
+        if len(self.unacknowledged) > self.size:
+            self.unacknowledged.popleft()
+        return self.sequence
+
+    def acknowledge(self, sequence):
+        # beyond what we sent, it's about frames sent before we restarted
+        if sequence > self.sequence: return
+        while self.unacknowledged and self.unacknowledged[0][0] <= sequence:
+            self.unacknowledged.popleft()
+
+    def meet(self, epoch):
+        # Called with the peer's epoch. If it changed, frames it received
+        # are lost and its sequence numbers start anew. Our own go on, as
+        # the peer accepts any, and may have accepted some already.
+        if self.peerEpoch is not None and epoch != self.peerEpoch:
+            debug("Peer of %s restarted, resume state reset." % self.resumeID)
+            self.received = 0
+            self.unacknowledged.clear()
+        self.peerEpoch = epoch
+
+    def accept(self, sequence):
+        # returns False for frames already received, e.g. resent ones
+        if sequence <= self.received: return False
+        self.received = sequence
+        return True
+
+
+class ResumeStore:
+
+    # States of resumable sessions by their resume ID. A session binding a
+    # state takes it over from a previous session, which then ends.
+
+    def __init__(self, size):
+        self.size = size
+        self.states = {}
+        self.pruned = 0
+
+    def prune(self):
+        # forget states without a session for longer than RESUME_TIMEOUT
+        now = self.pruned = time.time()
+        for key, state in list(self.states.items()):
+            if state.owner is None and now - state.released > RESUME_TIMEOUT:
+                del self.states[key]
+
+    def isResumable(self):
+        # whether any session may still be resumed, cheap enough to be asked
+        # for every packet
+        if time.time() - self.pruned >= RESUME_PRUNE_INTERVAL: self.prune()
+        return bool(self.states)
+
+    def bind(self, resumeID, session):
+        self.prune()
+        state = self.states.get(resumeID)
+        if state is None:
+            state = self.states[resumeID] = ResumeState(resumeID, self.size)
+        elif state.owner is not None:
+            debug("Connection %d takes over from connection %d." % (
+                session.wsid, state.owner.wsid
+            ))
+        state.owner = session
+        return state
+
+    def release(self, state, session):
+        if state.owner is not session: return
+        state.owner = None
+        state.released = time.time()
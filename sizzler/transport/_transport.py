@@ -1,10 +1,35 @@
 #!/usr/bin/env python3
 
+from ._resume import ResumeStore
+from ..shaping import Shaping
+
 class SizzlerTransport:
 
-    def __init__(self):
+    def __init__(self, sessionOptions=None, resume=0, shaping=None):
         self.connections = 0
         self.toWSQueue, self.fromWSQueue = None, None
+        self.router = None
+        # whether packets of the TUN device carry a virtio-net header
+        self.vnetHeader = False
+        # extra keyword arguments for each WebsocketSession
+        self.sessionOptions = sessionOptions or {}
+        # states of resumable sessions, keeping up to `resume` frames each
+        self.resumeStore = ResumeStore(resume) if resume else None
+        # token buckets for sessions, from arguments for Shaping, if any
+        self.shaping = Shaping(**shaping) if shaping else None
+
+    def isAvailable(self):
+        # whether packets for this transport should be queued, or dropped
+        return self.connections > 0
+
+    def acquireShapers(self, identity):
+        # returns shapers for sending and receiving of a new session of the
+        # client `identity`, None if not limited
+        if not self.shaping: return None, None
+        return self.shaping.acquire(identity)
+
+    def releaseShapers(self, identity):
+        if self.shaping: self.shaping.release(identity)
 
     def increaseConnectionsCount(self):
         self.connections += 1
@@ -1,20 +1,101 @@
 #!/usr/bin/env python3
 
 import time
+import struct
 import asyncio
 import hashlib
-from logging import info, debug, critical, exception
+import logging
+import collections
+from logging import info, debug, warning, critical, exception
 
 from ..crypto.crypto import getCrypto
-from ..crypto.padding import RandomPadding
+from ..crypto.padding import RandomPadding, PADDING_BUCKETS, PADDING_HEAD
+from ..metrics import METRICS
+from ..capture import CAPTURE, CAPTURE_WS_SEND, CAPTURE_WS_RECEIVE
+from ..util.runtime import tuneSocket
+from ..mtu import getPathMTU
+from ..compress import Compressor, Decompressor, COMPRESSED_TYPES
+from ._resume import RESUME_ACK_FRAMES
+from ..offload import addVnetHeader, removeVnetHeader, splitVnetPacket
 
 
 wsid = 0
 
 TIMEDIFF_TOLERANCE = 300
-CONNECTION_TIMEOUT = 30
+CONNECTION_TIMEOUT = 30     # longest silence of a peer before giving up
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_MISSES = 3        # heartbeats missed before a peer is dead ...
+TIMEOUT_MIN = 2             # ... but after no less than this many seconds
+RTT_INTERVAL = 5
 PADDING_MAX = 2048
 
+# Resumable sessions wrap data frames in "s-" frames with a sequence number,
+# and acknowledge received ones by control frames (see below), or by "a-"
+# frames to peers not sending those.
+SEQUENCE_HEAD = struct.Struct("<Q")
+
+# Aggregated frames ("m-") carry several packets, each prefixed by its length.
+# Their total size is limited by the 16-bit length field used for padding,
+# less the frame type and room for a sequence number.
+# Frames "v-" and "w-" are the same as "d-" and "m-", but their packets carry
+# a virtio-net header, as sent by peers in offload mode.
+AGGREGATE_ITEM_HEAD = struct.Struct("<H")
+AGGREGATE_MAX = 0xFFFF - 2 - (2 + SEQUENCE_HEAD.size)
+
+# Control frames ("c-") carry a number of control messages, and optionally
+# any other frame after them, so that control rides along with data. Each
+# message is its type and length, followed by its body:
+#   ping:   sent as heartbeat, with our time, flags (see below) and a digest
+#           of the connection's ID
+#   pong:   the time of the peer's last ping, and how long we held it until
+#           sending this, so the peer knows the RTT without timing us
+#   resume: resume ID, sequence number of the last frame received, and the
+#           epoch of our resume state (see _resume.py)
+#   ack:    sequence number of the last frame received
+# Messages of unknown types are skipped. Heartbeats are sent as "h-" frames
+# first, as older peers understand those only, telling that we understand
+# control frames; once the peer told so too, as control frames.
+CONTROL_HEAD = struct.Struct("<BB")
+CONTROL_PING, CONTROL_PONG, CONTROL_RESUME, CONTROL_ACK = 1, 2, 3, 4
+CONTROL_MESSAGES = {
+    CONTROL_PING: struct.Struct("<dB16s"),
+    CONTROL_PONG: struct.Struct("<dd"),
+    CONTROL_RESUME: struct.Struct("<16sQQ"),
+    CONTROL_ACK: SEQUENCE_HEAD,
+}
+PING_ACTIVE = 0x01
+
+
+def getUniqueID(path):
+    # the ID of a connection, derived from the query part of its `path`
+    f = path.find("?")
+    assert f >= 0
+    return hashlib.sha512(path[f:].encode("ascii")).hexdigest()
+
+def isGreeting(raw, path):
+    # Whether the decrypted frame `raw` is a heartbeat for the connection at
+    # `path`, as the first frame of each peer is. Its nonce is left to be
+    # checked by the session.
+    if len(raw) < PADDING_HEAD.size: return False
+    length, nonce = PADDING_HEAD.unpack_from(raw)
+    frame = bytes(raw[PADDING_HEAD.size:PADDING_HEAD.size+length])
+    uniqueID = getUniqueID(path)
+    if frame[:2] == b"h-":
+        return frame.split(b"-")[1:2] == [uniqueID.encode("ascii")]
+    if frame[:2] != b"c-" or len(frame) < 3: return False
+    offset = 3
+    for i in range(frame[2]):
+        if offset + CONTROL_HEAD.size > len(frame): return False
+        kind, size = CONTROL_HEAD.unpack_from(frame, offset)
+        offset += CONTROL_HEAD.size
+        message = CONTROL_MESSAGES[CONTROL_PING]
+        if kind == CONTROL_PING and size >= message.size and \
+                offset + message.size <= len(frame):
+            digest = message.unpack_from(frame, offset)[2]
+            return digest == bytes.fromhex(uniqueID)[:16]
+        offset += size
+    return False
+
 class WebsocketSession:
 
     wsid = 0
@@ -25,120 +106,589 @@ class WebsocketSession:
         path,
         key,
         fromWSQueue,
-        toWSQueue
+        toWSQueue,
+        aggregateBytes=0,
+        aggregateLinger=0,
+        cryptoStrategy="executor",
+        router=None,
+        client=None,
+        learnAddresses=False,
+        vnetHeader=False,
+        socketOptions=None,
+        compression="none",
+        compressionLevel=1,
+        padding="random",
+        paddingBuckets=PADDING_BUCKETS,
+        paddingTarget=PADDING_MAX,
+        heartbeatInterval=HEARTBEAT_INTERVAL,
+        activateByPeer=False,
+        resumeStore=None,
+        resumeID=None,
+        sendShaper=None,
+        receiveShaper=None
     ):
         global wsid
         wsid += 1
         self.wsid = wsid
         self.websocket = websocket
+        if socketOptions: tuneSocket(websocket, **socketOptions)
+        # connections over UDP send to where the last authentic frame came
+        # from, see _datagram.py
+        self.confirmAddress = getattr(websocket, "confirm", None)
         self.fromWSQueue = fromWSQueue
         self.toWSQueue = toWSQueue
-        self.encryptor, self.decryptor = getCrypto(key)
-        self.padder = RandomPadding(PADDING_MAX) 
+        # limits of frames per second, see shaping.py, or None
+        self.sendShaper = sendShaper
+        self.receiveShaper = receiveShaper
+
+        # with a router, packets for this session come in its own queue, and
+        # on a server, the router learns which addresses the peer owns; it
+        # tells the sessions of different clients apart by `client`
+        self.router = router
+        self.client = client
+        self.learnAddresses = router is not None and learnAddresses
+
+        # A session sends no packets until activated. Until then, it's a
+        # standby connection, only kept alive by heartbeats, which tell the
+        # peer so. With `activateByPeer` (on a server), a session activates
+        # once the peer's heartbeats say it's no standby (anymore).
+        self.active = False
+        self.activated = asyncio.Event()
+        self.activateByPeer = activateByPeer
+
+        # A resumable session continues where an earlier one with the same
+        # resume ID stopped: frames not acknowledged by the peer are sent
+        # again, and frames received already are dropped. A client chooses
+        # the ID, which the server learns from its first heartbeat.
+        self.resumeStore = resumeStore
+        self.resumeID = resumeID
+        self.resume = None
+        self.unacknowledged = 0     # frames received since last ack
+        # crypto is shared by all sessions with the same key, as is the
+        # randomness for padding; nonces are per session
+        self.encryptor, self.decryptor = getCrypto(key, cryptoStrategy)
+        self.padder = RandomPadding(
+            paddingTarget, policy=padding, buckets=paddingBuckets)
+
+        # if aggregateBytes > 0, queued packets are packed into frames up to
+        # this size, waiting at most aggregateLinger seconds for more packets
+        assert 0 <= aggregateBytes <= AGGREGATE_MAX
+        self.aggregateBytes = aggregateBytes
+        self.aggregateLinger = aggregateLinger
+        self.__carried = collections.deque()    # for the next frame
+
+        # whether packets of our TUN device carry a virtio-net header
+        self.vnetHeader = vnetHeader
+        self.singleType, self.multipleType = \
+            (b"v-", b"w-") if vnetHeader else (b"d-", b"m-")
 
         # get path, which is the unique ID for this connection
         try:
-            f = path.find("?")
-            assert f >= 0
-            self.uniqueID = hashlib.sha512(
-                path[f:].encode("ascii")
-            ).hexdigest()
+            self.uniqueID = getUniqueID(path)
         except:
             raise Exception("Connection %d without valid ID." % self.wsid)
 
         # parameters for heartbeating
         self.peerAuthenticated = False
-        self.lastHeartbeat = time.time()
+        self.lastHeartbeat = time.time()    # timestamp of the peer's clock
+        self.lastReceived = time.time()     # of any valid frame, our clock
+        self.heartbeatInterval = heartbeatInterval
+        self.heartbeatGap = None            # smoothed, between peer's ones
+        self.__heartbeatNow = asyncio.Event()
+        self.connectionDigest = bytes.fromhex(self.uniqueID)[:16]
+        self.peerControl = False    # whether the peer sends control frames
+        self.peerPing = None        # its last ping's time, and when received
+        self.__pendingAck = False   # for the next data frame
+        self.__acknowledging = None # task sending an acknowledgement
 
+        # smoothed round trip time and its mean deviation (like TCP's RTTVAR)
+        # in seconds, None until measured
+        self.rtt = None
+        self.jitter = None
 
-    def __beforeSend(self, data=None, heartbeat=None):
+        self.metrics = METRICS.addSession(self)
+
+        # frames may be compressed before padding, as configured for sending;
+        # received ones are decompressed whatever the peer chose
+        self.compressor = None
+        if compression != "none":
+            self.compressor = Compressor(
+                compression, compressionLevel, AGGREGATE_MAX, self.metrics)
+        self.decompressor = Decompressor(AGGREGATE_MAX + 2)
+        # formatting per-packet debug lines is costly, only do it if needed
+        self.debugging = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+    def __beforeSend(self, data=None, heartbeat=None, sequence=None):
         # Pack plaintext with headers etc. Returns packed data if they are
-        # ok for outgoing traffic, or None.
-        ret = None
-        if data:
-            ret = b"d-" + data
+        # ok for outgoing traffic, or None. `data` is a list of packets, each
+        # copied only once, into the padded frame.
+        chunks = None
+        if data and len(data) == 1:
+            chunks = [self.singleType, data[0]]
+        elif data:
+            chunks = [self.multipleType]
+            for each in data:
+                chunks.append(AGGREGATE_ITEM_HEAD.pack(len(each)))
+                chunks.append(each)
+        if chunks and self.compressor:
+            compressed = self.compressor.compress(data, chunks)
+            if compressed: chunks = [compressed]
+        if data and sequence:
+            chunks.insert(0, b"s-" + SEQUENCE_HEAD.pack(sequence))
         if heartbeat:
-            ret = ("h-%s-%s" % (self.uniqueID, time.time())).encode('ascii')
-        return self.padder.pad(ret)
+            chunks = [self.__packControl(self.__heartbeatMessages())]
+        elif chunks and self.__pendingAck:
+            # acknowledge along with data, if there's room
+            ack = self.__packControl(
+                [(CONTROL_ACK, (self.resume.received,))])
+            if sum(map(len, chunks)) + len(ack) <= 0xFFFF:
+                chunks.insert(0, ack)
+                self.__pendingAck = False
+        if not chunks: return None
+        return self.padder.pad(*chunks)
+
+    def __packControl(self, messages):
+        # header of a control frame with `messages`, (type, values) each
+        chunks = [b"c-", bytes([len(messages)])]
+        for kind, values in messages:
+            message = CONTROL_MESSAGES[kind]
+            chunks.append(CONTROL_HEAD.pack(kind, message.size))
+            chunks.append(message.pack(*values))
+        return b"".join(chunks)
+
+    def __heartbeatMessages(self):
+        messages = [(CONTROL_PING, (
+            time.time(),
+            PING_ACTIVE if self.active else 0,
+            self.connectionDigest
+        ))]
+        if self.peerPing:
+            timestamp, received = self.peerPing
+            messages.append(
+                (CONTROL_PONG, (timestamp, time.monotonic() - received)))
+        if self.resume:
+            messages.append((CONTROL_RESUME, (
+                bytes.fromhex(self.resume.resumeID),
+                self.resume.received,
+                self.resume.epoch
+            )))
+        return messages
+
+    def __legacyHeartbeat(self):
+        # h-ID-time-mode-c, mode being s(tandby) or a(ctive), "c" telling
+        # that we understand control frames, followed by
+        # -resumeID-received-epoch for resumable sessions
+        heartbeat = "h-%s-%s-%s-c" % (
+            self.uniqueID, time.time(), "a" if self.active else "s")
+        if self.resume:
+            heartbeat += "-%s-%d-%d" % (
+                self.resume.resumeID, self.resume.received, self.resume.epoch)
+        return self.padder.pad(heartbeat.encode('ascii'))
 
     def __afterReceive(self, raw):
         # unpack decrypted PLAINTEXT and extract headers etc.
-        # returns data needed to be written to TUN if any, otherwise None.
+        # returns a list of packets needed to be written to TUN, as
+        # memoryviews into `raw`.
         raw = self.padder.unpad(raw)
-        if not raw: return None
-        if raw.startswith(b"d-"):
-            return raw[2:]
-        if raw.startswith(b"h-"):
-            self.__heartbeatReceived(raw)
-            return None
+        if not raw:
+            self.metrics.rejects += 1
+            return []
+        if self.confirmAddress: self.confirmAddress()
+        frameType = raw[:2]
+        if frameType == b"c-":
+            raw = self.__controlReceived(raw)
+            if not raw: return []
+            frameType = raw[:2]
+        duplicate = False
+        if frameType == b"s-" and len(raw) >= 2 + SEQUENCE_HEAD.size:
+            sequence, = SEQUENCE_HEAD.unpack_from(raw, 2)
+            duplicate = not self.__acceptSequence(sequence)
+            raw = raw[2+SEQUENCE_HEAD.size:]
+            frameType = raw[:2]
+        elif frameType == b"a-" and len(raw) >= 2 + SEQUENCE_HEAD.size:
+            if self.resume:
+                self.resume.acknowledge(SEQUENCE_HEAD.unpack_from(raw, 2)[0])
+            return []
+        if frameType in COMPRESSED_TYPES.values():
+            raw = memoryview(self.decompressor.decompress(frameType, raw[2:]))
+            frameType = raw[:2]
+        if duplicate: return []
+        if frameType == b"d-" or frameType == b"v-":
+            packets = [raw[2:]]
+        elif frameType == b"m-" or frameType == b"w-":
+            packets = self.__splitAggregated(raw)
+        else:
+            if frameType == b"h-": self.__heartbeatReceived(bytes(raw))
+            return []
+        if (frameType == b"v-" or frameType == b"w-") == self.vnetHeader:
+            return packets
+        return self.__convertPackets(packets)
+
+    def __convertPackets(self, packets):
+        # convert packets from the peer to the format of our TUN device
+        if self.vnetHeader:
+            return [addVnetHeader(each) for each in packets]
+        converted = []
+        for each in packets:
+            converted += removeVnetHeader(each)
+        return converted
+
+    def __splitAggregated(self, raw):
+        # split a "m-" frame back into packets, drop it if malformed
+        packets, offset = [], 2
+        while offset < len(raw):
+            if offset + AGGREGATE_ITEM_HEAD.size > len(raw): return []
+            length, = AGGREGATE_ITEM_HEAD.unpack_from(raw, offset)
+            offset += AGGREGATE_ITEM_HEAD.size
+            if offset + length > len(raw): return []
+            packets.append(raw[offset:offset+length])
+            offset += length
+        return packets
+
+    def __acceptSequence(self, sequence):
+        # Returns False for frames received already by an earlier session.
+        # Those are still decompressed, as the peer's compression stream
+        # went on with them.
+        if not self.resume: return True
+        if not self.resume.accept(sequence):
+            self.metrics.rejects += 1
+            return False
+        self.unacknowledged += 1
+        if self.unacknowledged >= RESUME_ACK_FRAMES:
+            self.unacknowledged = 0
+            if self.peerControl and not self.toWSQueue.empty():
+                self.__pendingAck = True
+            elif not self.__acknowledging or self.__acknowledging.done():
+                # one at a time, later frames are acknowledged by the next
+                # one or by heartbeats
+                self.__acknowledging = asyncio.ensure_future(
+                    self.__sendAcknowledgement())
+        return True
+
+    async def __sendAcknowledgement(self):
+        if self.peerControl:
+            d = self.padder.pad(self.__packControl(
+                [(CONTROL_ACK, (self.resume.received,))]))
+        else:
+            d = self.padder.pad(
+                b"a-", SEQUENCE_HEAD.pack(self.resume.received))
+        try:
+            await self.__send(await self.encryptor(d))
+        except Exception as e:
+            debug("Connection %d cannot acknowledge: %s" % (self.wsid, e))
+
+    async def __send(self, e):
+        # every encrypted frame goes out here, shaped if so configured
+        if self.sendShaper: await self.sendShaper(len(e))
+        await self.websocket.send(e)
+
+    def __bindResume(self, resumeID):
+        if self.resume or not self.resumeStore: return
+        self.resume = self.resumeStore.bind(resumeID, self)
+
+    def activate(self):
+        # Start sending packets, after telling the peer with a heartbeat.
+        if self.active: return
+        if self.resumeID: self.__bindResume(self.resumeID)
+        self.active = True
+        if self.router:
+            self.toWSQueue = self.router.register(self)
+            pathMTU = getPathMTU(self.websocket)
+            if pathMTU: self.router.tun.fitPath(pathMTU)
+        self.activated.set()
+        debug("Connection %d activated." % self.wsid)
 
     # ---- Heartbeat to remote, and evaluation of remote sent heartbeats.
 
+    def __controlReceived(self, raw):
+        # Handle the messages of a control frame. Returns the frame riding
+        # along with them, or None if there's none or it's malformed.
+        if len(raw) < 3: return None
+        count, offset, messages = raw[2], 3, {}
+        for i in range(count):
+            if offset + CONTROL_HEAD.size > len(raw): return None
+            kind, length = CONTROL_HEAD.unpack_from(raw, offset)
+            offset += CONTROL_HEAD.size
+            if offset + length > len(raw): return None
+            message = CONTROL_MESSAGES.get(kind)
+            if message and length >= message.size:
+                messages[kind] = message.unpack_from(raw, offset)
+            offset += length
+        self.peerControl = True
+        if CONTROL_PING in messages:
+            timestamp, flags, digest = messages[CONTROL_PING]
+            resumeID, received, epoch = messages.get(
+                CONTROL_RESUME, (None, None, None))
+            if digest != self.connectionDigest or not self.__peerHeartbeat(
+                timestamp,
+                not flags & PING_ACTIVE,
+                resumeID and resumeID.hex(),
+                received,
+                epoch
+            ):
+                warning("Invalid ping on connection %d." % self.wsid)
+                return None
+            self.peerPing = (timestamp, time.monotonic())
+        if CONTROL_PONG in messages and self.peerAuthenticated:
+            timestamp, held = messages[CONTROL_PONG]
+            self.__measuredRTT(time.time() - timestamp - held)
+        if CONTROL_ACK in messages and self.resume:
+            self.resume.acknowledge(messages[CONTROL_ACK][0])
+        return raw[offset:]
+
     def __heartbeatReceived(self, raw):
-        # If a remote heartbeat received, record its timestamp.
+        # a heartbeat of a peer not sending control frames (yet)
+        if self.peerControl: return
         try:
             heartbeatSlices = raw.decode('ascii').split('-')
             assert heartbeatSlices[0] == "h"
             assert heartbeatSlices[1] == self.uniqueID
-            timestamp = float(heartbeatSlices[2])
-            nowtime = time.time()
-            if timestamp <= nowtime + TIMEDIFF_TOLERANCE:
-                self.lastHeartbeat = max(self.lastHeartbeat, timestamp)
-                self.peerAuthenticated = True
+            resumeID, received, epoch = None, None, None
+            if len(heartbeatSlices) >= 8:
+                resumeID = bytes.fromhex(heartbeatSlices[5]).hex()
+                received = int(heartbeatSlices[6])
+                epoch = int(heartbeatSlices[7])
+            assert self.__peerHeartbeat(
+                float(heartbeatSlices[2]),
+                heartbeatSlices[3:4] == ["s"],
+                resumeID,
+                received,
+                epoch
+            )
         except:
-            warning("Warning: invalid heartbeat!")
+            warning("Invalid heartbeat on connection %d." % self.wsid)
+            return
+        if heartbeatSlices[4:5] == ["c"]:
+            # switch to control frames, and tell the peer at once
+            self.peerControl = True
+            self.__heartbeatNow.set()
+
+    def __peerHeartbeat(
+        self, timestamp, standby, resumeID, received, epoch
+    ):
+        # Record a heartbeat sent at `timestamp` by the peer's clock, and
+        # activate or resume as told. Returns False if it's too far ahead.
+        if timestamp > time.time() + TIMEDIFF_TOLERANCE: return False
+        if self.peerAuthenticated:
+            gap = timestamp - self.lastHeartbeat
+            if 0 < gap < CONNECTION_TIMEOUT:
+                self.heartbeatGap = gap if self.heartbeatGap is None \
+                    else 0.875 * self.heartbeatGap + 0.125 * gap
+        self.lastHeartbeat = max(self.lastHeartbeat, timestamp)
+        self.peerAuthenticated = True
+        if resumeID is not None:
+            if self.activateByPeer and not standby:
+                self.__bindResume(resumeID)
+            if self.resume:
+                self.resume.meet(epoch)
+                self.resume.acknowledge(received)
+        if self.activateByPeer and not standby: self.activate()
+        return True
+
+    def __measuredRTT(self, sample):
+        # smooth RTT samples like TCP does (RFC 6298)
+        if sample < 0: return
+        self.metrics.rttTime.observe(sample)
+        if self.rtt is None:
+            self.rtt, self.jitter = sample, sample / 2
+        else:
+            self.jitter = 0.75 * self.jitter + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+    async def __sendHeartbeat(self):
+        self.__heartbeatNow.clear()
+        if self.peerControl:
+            d = self.__beforeSend(heartbeat=True)
+        else:
+            d = self.__legacyHeartbeat()
+        await self.__send(await self.encryptor(d))
 
     async def __sendLocalHeartbeat(self):
         # Try to send local heartbeats.
         while True:
-            d = self.__beforeSend(heartbeat=True)
-            e = await self.encryptor(d)
-            await self.websocket.send(e)
-            await asyncio.sleep(5)
+            try:
+                await asyncio.wait_for(
+                    self.__heartbeatNow.wait(), self.heartbeatInterval)
+            except asyncio.TimeoutError:
+                pass
+            await self.__sendHeartbeat()
+
+    def __timeout(self):
+        # Silence after which the peer is considered dead: a few of its
+        # heartbeat intervals as seen by us, plus the RTT and its deviation,
+        # or some RTTs as long as no deviation is known.
+        if self.heartbeatGap is None: return CONNECTION_TIMEOUT
+        timeout = HEARTBEAT_MISSES * self.heartbeatGap
+        if self.jitter is not None and self.peerControl:
+            timeout += self.rtt + 4 * self.jitter
+        else:
+            timeout += 4 * (self.rtt or 0)
+        return min(CONNECTION_TIMEOUT, max(TIMEOUT_MIN, timeout))
 
     async def __checkRemoteHeartbeat(self):
         # See if remote to us is still alive. If not, raise Exception and
-        # terminate the connections.
+        # terminate the connections. Any frame from it counts as a sign of
+        # life, not only heartbeats.
         while True:
-            await asyncio.sleep(5)
-            if time.time() - self.lastHeartbeat > CONNECTION_TIMEOUT:
+            await asyncio.sleep(min(self.heartbeatInterval, TIMEOUT_MIN) / 4)
+            if time.time() - self.lastReceived > self.__timeout():
                 raise Exception("Connection %d timed out." % self.wsid)
+            if self.resume and self.resume.owner is not self:
+                raise Exception("Connection %d taken over." % self.wsid)
 
+    async def __measureRTT(self):
+        # Measure the RTT by WebSocket pings, as long as the peer sends no
+        # control frames telling it.
+        await asyncio.sleep(RTT_INTERVAL)
+        while not self.peerControl:
+            start = time.time()
+            pong = await self.websocket.ping()
+            try:
+                await asyncio.wait_for(pong, CONNECTION_TIMEOUT)
+                if not self.peerControl:
+                    self.__measuredRTT(time.time() - start)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.sleep(RTT_INTERVAL)
 
     # ---- Data transfer
 
     async def __receiveToQueue(self):
+        metrics = self.metrics
         while True:
             e = await self.websocket.recv()     # data received
+            metrics.framesIn += 1
+            metrics.bytesIn += len(e)
+            if self.receiveShaper: await self.receiveShaper(len(e))
+            start = time.perf_counter()
             raw = await self.decryptor(e)
-            if not raw: continue                # decryption must success
-            d = self.__afterReceive(raw)
-            if not d: continue                  # if any data writable to TUN
+            metrics.decryptTime.observe(time.perf_counter() - start)
+            if not raw:                         # decryption must success
+                metrics.decryptFailures += 1
+                continue
+            self.lastReceived = time.time()
+            packets = self.__afterReceive(raw)
+            if not packets: continue            # if any data writable to TUN
             if self.peerAuthenticated:          # if peer authenticated
-                await self.fromWSQueue.put(d)
-            debug("               --|%3d|%s Local  %5d bytes" % (
-                self.wsid,
-                "--> " if self.peerAuthenticated else "-//-",
-                len(e)
-            ))
+                metrics.packetsIn += len(packets)
+                for d in packets:
+                    if CAPTURE.armed:
+                        CAPTURE.record(CAPTURE_WS_RECEIVE, self.wsid, d)
+                    if self.learnAddresses: self.router.learn(self, d)
+                    await self.fromWSQueue.put(d)
+            if self.debugging:
+                debug("               --|%3d|%s Local  %5d bytes" % (
+                    self.wsid,
+                    "--> " if self.peerAuthenticated else "-//-",
+                    len(e)
+                ))
 
-    async def __sendFromQueue(self):
+    async def __collectFromQueue(self):
+        # Get the next packet, and if aggregation is enabled, as many further
+        # packets as fit into `aggregateBytes`, lingering a little for them.
         while True:
-            d = await self.toWSQueue.get()      # data to be sent ready
-            s = self.__beforeSend(data=d)       # pack the data
-            if not s: continue                  # if packer refuses, drop it
-            e = await self.encryptor(s)         # encrypt packed data
-            await self.websocket.send(e)        # send it
+            if self.__carried:
+                d = self.__carried.popleft()
+            else:
+                d = await self.toWSQueue.get()
+            if len(d) <= AGGREGATE_MAX: break
+            # only super-packets in offload mode get this large, send them
+            # as several smaller ones
+            if self.vnetHeader:
+                self.__carried.extendleft(
+                    reversed(splitVnetPacket(d, AGGREGATE_MAX)))
+        packets = [d]
+        if not self.aggregateBytes: return packets
+
+        size = 2 + AGGREGATE_ITEM_HEAD.size + len(d)
+        deadline = time.time() + self.aggregateLinger
+        while size < self.aggregateBytes:
+            if self.__carried:
+                d = self.__carried.popleft()
+            elif not self.toWSQueue.empty():
+                try:
+                    d = self.toWSQueue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break       # CoDel dropped all that was queued
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0: break
+                try:
+                    d = await asyncio.wait_for(self.toWSQueue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            size += AGGREGATE_ITEM_HEAD.size + len(d)
+            if size > self.aggregateBytes:
+                self.__carried.appendleft(d)    # goes into the next frame
+                break
+            packets.append(d)
+        return packets
+
+    async def __sendFrame(self, d, sequence=None):
+        metrics = self.metrics
+        s = self.__beforeSend(data=d, sequence=sequence) # pack the data
+        if not s: return                        # if packer refuses, drop it
+        start = time.perf_counter()
+        e = await self.encryptor(s)             # encrypt packed data
+        metrics.encryptTime.observe(time.perf_counter() - start)
+        await self.__send(e)                    # send it
+        metrics.framesOut += 1
+        metrics.bytesOut += len(e)
+        metrics.packetsOut += len(d)
+        if CAPTURE.armed:
+            for each in d: CAPTURE.record(CAPTURE_WS_SEND, self.wsid, each)
+        if self.debugging:
             debug("   Internet   <--|%3d|--          %5d bytes" % (
                 self.wsid,
                 len(s)
             ))
 
+    async def __sendFromQueue(self):
+        await self.activated.wait()
+        # tell the peer before any data, which it may only accept as part of
+        # a resumed session once it knows
+        await self.__sendHeartbeat()
+        if self.resume:
+            # first send again what the peer may not have received yet
+            resent = list(self.resume.unacknowledged)
+            for sequence, d in resent: await self.__sendFrame(d, sequence)
+            self.metrics.framesResent += len(resent)
+        while True:
+            d = await self.__collectFromQueue() # data to be sent ready
+            sequence = None
+            if self.resume:
+                # kept until acknowledged, in case this connection breaks
+                if self.resume.owner is not self:
+                    raise Exception("Connection %d taken over." % self.wsid)
+                sequence = self.resume.record(d)
+            await self.__sendFrame(d, sequence)
+
     def __await__(self):
-        yield from asyncio.gather(
-            self.__receiveToQueue(),
-            self.__sendFromQueue(),
-            self.__sendLocalHeartbeat(),
-            self.__checkRemoteHeartbeat(),
-            self.padder
-        )
+        tasks = None
+        try:
+            self.padder.pool.start()
+            # authenticate to the peer with the very first frame
+            yield from self.__sendHeartbeat().__await__()
+            tasks = asyncio.gather(
+                self.__receiveToQueue(),
+                self.__sendFromQueue(),
+                self.__sendLocalHeartbeat(),
+                self.__checkRemoteHeartbeat(),
+                self.__measureRTT()
+            )
+            yield from tasks
+        finally:
+            # once one job fails, stop all others of this session too
+            if tasks: tasks.cancel()
+            if self.__acknowledging: self.__acknowledging.cancel()
+            if self.router: self.router.unregister(self)
+            if self.resume: self.resumeStore.release(self.resume, self)
+            METRICS.removeSession(self)
+            if self.metrics.compressIn:
+                info("Connection %d compressed %d bytes to %d (%.1f%%)." % (
+                    self.wsid,
+                    self.metrics.compressIn,
+                    self.metrics.compressOut,
+                    100.0 * self.metrics.compressOut / self.metrics.compressIn
+                ))
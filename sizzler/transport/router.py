@@ -1,6 +1,227 @@
 #!/usr/bin/env python3
 
+import socket
+import asyncio
+import zlib
+from logging import info, debug, critical, exception
+
+from ..packet import getSourceAddress, getDestinationAddress, getFlowKey
+
+# How a new flow chooses among the connections it may use:
+#   hash: by a hash of its addresses, protocol and ports
+#   rtt:  weighted round-robin, weights proportional to 1 / measured RTT
+SCHEDULE_POLICIES = ["hash", "rtt"]
+
+# Flows not seen for 1-2 times this many seconds are forgotten.
+FLOW_TIMEOUT = 60
+
+# Owners of addresses without any session are forgotten beyond this many.
+OWNERS_MAX = 65536
+
+
+def parsePrefix(prefix):
+    # "fd00:1::/64" -> network address and mask, as 16 bytes each
+    try:
+        address, length = prefix.split("/")
+        length = int(length)
+        assert 0 <= length <= 128
+        mask = ((1 << 128) - (1 << (128 - length))).to_bytes(16, "big")
+        address = socket.inet_pton(socket.AF_INET6, address)
+    except Exception:
+        raise Exception("Invalid IPv6 prefix: %s" % prefix)
+    return bytes([a & m for a, m in zip(address, mask)]), mask
+
+
 class PacketRouter:
 
-    def __init__(self, tun):
-        pass
+    # Dispatches packets read from TUN to sessions. Sessions registered here
+    # get their own queue.
+    #
+    # On a server, sessions learn addresses from the source of packets they
+    # receive, and packets are sent via sessions known to own the destination
+    # address (a client may use several). Only addresses within the subnet
+    # of the TUN device, or within the IPv6 prefix `ipv6` if given, are
+    # learned, and a client claiming an address takes it over from any other
+    # client. Addresses stay with their client after its sessions end, so
+    # packets to them go to its next session, or are dropped meanwhile.
+    # Packets to unknown destinations may use any registered session as long
+    # as all belong to one client (always so on a client), and are dropped
+    # otherwise; once more than one client has been seen, those within the
+    # subnet or prefix are always dropped, as they may belong to a client
+    # gone or not heard from yet. So no client gets what's meant for another.
+    #
+    # Among those, each flow (by addresses, protocol and ports) sticks to one
+    # session, so that its packets are not reordered. A flow only moves when
+    # its session dies, or when that session's queue has more than
+    # `congested` packets while another one has less than half as many.
+    #
+    # As long as no session is registered at all, all packets go to the
+    # shared queue of the TUN device, routed once a session registers.
+
+    def __init__(self, tun, policy="hash", congested=100, ipv6=None):
+        if policy not in SCHEDULE_POLICIES:
+            raise Exception("Unknown schedule policy: %s" % policy)
+        self.tun = tun
+        self.policy = policy
+        self.congested = congested
+        self.sessions = []
+        self.queues = {}        # session -> its own queue
+        self.addresses = {}     # virtual IP address -> [sessions]
+        self.clients = {}       # client -> number of its sessions
+        self.owners = {}        # virtual IP address -> client, kept
+        self.multiClient = False    # whether several clients were seen
+        self.weights = {}       # session -> current weight for `rtt` policy
+
+        # flow key -> session, for flows seen in this and the last period
+        self.flows, self.oldFlows = {}, {}
+
+        # the subnet of the TUN device, and the IPv6 prefix, as network
+        # address and mask, by address length
+        netmask = socket.inet_aton(tun.netmask)
+        self.subnets = {
+            4: (self.__mask(socket.inet_aton(tun.ip), netmask), netmask)
+        }
+        if ipv6: self.subnets[16] = parsePrefix(ipv6)
+
+    def __mask(self, address, netmask):
+        return bytes([a & m for a, m in zip(address, netmask)])
+
+    def __isLocal(self, address):
+        subnet = self.subnets.get(len(address or b""))
+        return subnet is not None and self.__mask(address, subnet[1]) == \
+            subnet[0]
+
+    def register(self, session):
+        queue = self.tun.createQueue()
+        self.sessions.append(session)
+        self.queues[session] = queue
+        self.clients[session.client] = self.clients.get(session.client, 0) + 1
+        if len(self.clients) > 1: self.multiClient = True
+        # packets queued while no session was there (e.g. for clients yet to
+        # resume) are routed now, so that this one gets only its own
+        if len(self.sessions) == 1: self.__reroute(self.tun.toWSQueue)
+        return queue
+
+    def unregister(self, session):
+        if session not in self.queues: return
+        self.sessions.remove(session)
+        queue = self.queues.pop(session)
+        self.weights.pop(session, None)
+        self.clients[session.client] -= 1
+        if not self.clients[session.client]: del self.clients[session.client]
+        for address, sessions in list(self.addresses.items()):
+            if session in sessions: sessions.remove(session)
+            if not sessions: del self.addresses[address]
+        # flows of this session are moved when their next packet comes, and
+        # packets still waiting for it are routed again; its addresses stay
+        # with its client
+        self.__reroute(queue)
+
+    def __reroute(self, queue):
+        # route all packets waiting in `queue` again
+        while not queue.empty():
+            try:
+                packet = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            target = self.__route(packet)
+            if target is not None: target.put_nowait(packet)
+
+    def learn(self, session, packet):
+        address = getSourceAddress(packet)
+        if session not in self.queues or not self.__isLocal(address): return
+        sessions = self.addresses.setdefault(address, [])
+        if session in sessions: return
+        if sessions and sessions[0].client != session.client:
+            debug("Address %s taken over from connection %d." % (
+                address.hex(), sessions[0].wsid))
+            del sessions[:]
+        sessions.append(session)
+        if self.owners.get(address) != session.client:
+            if len(self.owners) >= OWNERS_MAX:
+                self.owners = dict([
+                    (a, c) for a, c in self.owners.items()
+                    if a in self.addresses
+                ])
+            self.owners[address] = session.client
+        debug("Address %s is now routed to connection %d." % (
+            address.hex(), session.wsid
+        ))
+
+    # ---- Scheduling
+
+    def __chooseByHash(self, key, candidates):
+        return candidates[zlib.crc32(key or b"") % len(candidates)]
+
+    def __chooseByRTT(self, candidates):
+        # smooth weighted round-robin, sessions without RTT yet get the
+        # average weight of the others
+        known = [1.0 / s.rtt for s in candidates if s.rtt]
+        default = sum(known) / len(known) if known else 1.0
+        total, best = 0, None
+        for session in candidates:
+            weight = 1.0 / session.rtt if session.rtt else default
+            current = self.weights.get(session, 0) + weight
+            self.weights[session] = current
+            total += weight
+            if best is None or current > self.weights[best]: best = session
+        self.weights[best] -= total
+        return best
+
+    def __leastLoaded(self, candidates):
+        return min(candidates, key=lambda s: self.queues[s].qsize())
+
+    def __schedule(self, packet, candidates):
+        key = getFlowKey(packet)
+        session = self.flows.get(key)
+        if session is None:
+            session = self.oldFlows.get(key)
+            if session is not None: self.flows[key] = session
+
+        if session is not None and session in self.queues and (
+            candidates is self.sessions or session in candidates
+        ):
+            depth = self.queues[session].qsize()
+            if depth <= self.congested or len(candidates) < 2:
+                return session
+            other = self.__leastLoaded(candidates)
+            if self.queues[other].qsize() * 2 >= depth:
+                return session
+            session = other
+            debug("Flow moved to connection %d due to congestion." % (
+                session.wsid
+            ))
+        elif self.policy == "rtt":
+            session = self.__chooseByRTT(candidates)
+        else:
+            session = self.__chooseByHash(key, candidates)
+        self.flows[key] = session
+        return session
+
+    def __route(self, packet):
+        # returns the queue for the packet, or None to drop it
+        if not self.sessions: return self.tun.toWSQueue
+        destination = getDestinationAddress(packet)
+        candidates = self.addresses.get(destination)
+        if not candidates:
+            owner = self.owners.get(destination)
+            if owner is not None:
+                # sessions of its client, which haven't sent from it yet
+                candidates = [s for s in self.sessions if s.client == owner]
+                if not candidates: return None
+            elif len(self.clients) > 1 or (
+                self.multiClient and self.__isLocal(destination)
+            ):
+                return None
+        session = self.__schedule(packet, candidates or self.sessions)
+        return self.queues[session]
+
+    async def dispatch(self, packet):
+        queue = self.__route(packet)
+        if queue is not None: await queue.put(packet)
+
+    def __await__(self):
+        # forget flows not seen for a while
+        while True:
+            yield from asyncio.sleep(FLOW_TIMEOUT).__await__()
+            self.flows, self.oldFlows = {}, self.flows
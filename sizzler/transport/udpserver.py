@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+import collections
+from logging import info, debug, critical, exception
+
+from ._wssession import WebsocketSession, isGreeting, TIMEDIFF_TOLERANCE
+from ._transport import SizzlerTransport
+from ._datagram import DatagramConnection, DatagramProtocol, \
+    getDatagramSessionOptions, UDP_INBOX_MAX, UDP_PENDING_MAX, \
+    UDP_PENDING_INBOX
+from ..crypto.crypto import getCrypto
+from ..crypto.padding import ACCEPT_FIRST_NONCE_AFTER, NONCES_RESOLUTION
+from ..packetqueue import FairPacketQueue
+
+# IDs of ended connections are refused this long: until then, a frame of
+# theirs could be replayed as the first one of a new connection, as its
+# nonce, by the peer's clock (which may be ahead), is recent enough.
+UDP_ENDED_TIMEOUT = \
+    ACCEPT_FIRST_NONCE_AFTER / NONCES_RESOLUTION + TIMEDIFF_TOLERANCE
+
+
+class DatagramServer(SizzlerTransport):
+
+    # Serves sessions over UDP, see _datagram.py, usually alongside a
+    # WebsocketServer for clients which can't use UDP. A new connection
+    # starts with the first datagram of an unknown ID, if that decrypts to a
+    # heartbeat for the ID; only then a session is set up for it. At most
+    # UDP_PENDING_MAX connections are checked at a time, datagrams of
+    # further unknown IDs are dropped meanwhile. IDs of sessions which ended
+    # are not accepted again for UDP_ENDED_TIMEOUT, so that their frames
+    # can't be replayed to set them up anew. (With several workers, each
+    # knows the IDs of its own sessions only.)
+
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        key=None,
+        sessionOptions=None,
+        reusePort=False,
+        shaping=None
+    ):
+        SizzlerTransport.__init__(self, sessionOptions, 0, shaping)
+        self.sessionOptions = getDatagramSessionOptions(self.sessionOptions)
+        self.host = host
+        self.port = port
+        self.key = key
+        self.reusePort = reusePort
+        self.protocol = None
+        self.pending = set()    # connections not yet authenticated
+        self.ended = collections.OrderedDict()  # ID -> when its session ended
+
+    def __forgetEnded(self):
+        deadline = time.time() - UDP_ENDED_TIMEOUT
+        while self.ended and next(iter(self.ended.values())) < deadline:
+            self.ended.popitem(last=False)
+
+    def __accept(self, connectionID, address):
+        if len(self.pending) >= UDP_PENDING_MAX: return None
+        self.__forgetEnded()
+        if connectionID in self.ended: return None
+        connection = DatagramConnection(
+            self.protocol.transport,
+            address,
+            connectionID,
+            onClose=self.protocol.unregister,
+            inboxMax=UDP_PENDING_INBOX
+        )
+        self.protocol.register(connection)
+        self.pending.add(connection)
+        asyncio.ensure_future(self.__authenticate(connection))
+        return connection
+
+    async def __authenticate(self, connection):
+        # called once the first datagram is in the connection's inbox
+        valid = False
+        try:
+            decryptor = getCrypto(
+                self.key, self.sessionOptions.get("cryptoStrategy", "executor")
+            )[1]
+            raw = await decryptor(connection.inbox[0][0])
+            valid = bool(raw) and isGreeting(raw, connection.path)
+        except Exception as e:
+            debug("Cannot check connection over UDP: %s" % e)
+        finally:
+            self.pending.discard(connection)
+        if not valid:
+            connection.close("No heartbeat over UDP from %s." % (
+                connection.remote_address,))
+            return
+        connection.inboxMax = UDP_INBOX_MAX
+        await self.__handler(connection)
+
+    async def __handler(self, connection):
+        info("New connection over UDP: %s" % connection.path)
+        client = connection.remote_address[0]
+        sendShaper, receiveShaper = self.acquireShapers(client)
+        fromWSQueue = self.fromWSQueue
+        if isinstance(fromWSQueue, FairPacketQueue):
+            fromWSQueue = fromWSQueue.lane(client)
+        try:
+            self.increaseConnectionsCount()
+            session = WebsocketSession(
+                websocket=connection,
+                path=connection.path,
+                key=self.key,
+                fromWSQueue=fromWSQueue,
+                toWSQueue=self.toWSQueue,
+                router=self.router,
+                client=client,
+                vnetHeader=self.vnetHeader,
+                learnAddresses=True,
+                activateByPeer=True,
+                sendShaper=sendShaper,
+                receiveShaper=receiveShaper,
+                **self.sessionOptions
+            )
+            connection.probe(session)
+            await session
+        except Exception as e:
+            debug("Server connection break, reason: %s" % e)
+        finally:
+            connection.close()
+            self.ended[connection.connectionID] = time.time()
+            self.releaseShapers(client)
+            if fromWSQueue is not self.fromWSQueue: fromWSQueue.release()
+            self.decreaseConnectionsCount()
+            info("Current alive connections: %d" % self.connections)
+
+    def __await__(self):
+        assert self.toWSQueue != None and self.fromWSQueue != None
+        loop = asyncio.get_event_loop()
+        transport, self.protocol = yield from loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(accept=self.__accept),
+            local_addr=(self.host, self.port),
+            reuse_port=self.reusePort
+        ).__await__()
+        info("Listening on UDP %s:%d." % (self.host, self.port))
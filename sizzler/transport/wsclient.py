@@ -1,48 +1,156 @@
 #!/usr/bin/env python3
 
 import asyncio
-import websockets
+from websockets import connect
 import os
 import sys
 import time
+import random
 from logging import info, debug, critical, exception
 
-import yaml
-
 from ._wssession import WebsocketSession
 from ._transport import SizzlerTransport
+from ._datagram import DatagramConnector, getDatagramSessionOptions
+from ..metrics import METRICS
+
+# Reconnecting waits with exponential backoff, from RECONNECT_MIN up to
+# RECONNECT_MAX seconds, of which a random half is jitter. Once a connection
+# lasted RECONNECT_RESET seconds, the backoff starts over.
+RECONNECT_MIN = 0.05
+RECONNECT_MAX = 5
+RECONNECT_RESET = 10
 
 
 class WebsocketClient(SizzlerTransport):
 
-    def __init__(self, uris=None, key=None):
-        SizzlerTransport.__init__(self)
+    # For each URI, one connection is active, and `standby` more are kept
+    # connected but idle. When the active one breaks, a standby connection
+    # takes over at once, with no need to wait for a new handshake.
+    # URIs may also be udp://host:port, for connections over UDP (see
+    # _datagram.py), each with an optional URI in `fallbacks` to connect to
+    # instead as long as UDP gets no answer.
+
+    def __init__(
+        self,
+        uris=None,
+        key=None,
+        sessionOptions=None,
+        standby=0,
+        resume=0,
+        shaping=None,
+        fallbacks=None
+    ):
+        SizzlerTransport.__init__(self, sessionOptions, resume, shaping)
         self.uris = uris
+        self.fallbacks = fallbacks or [None for uri in uris or []]
         self.key = key
+        self.standby = standby
+        self.active = {}    # index of URI -> active session
+        self.standbys = {}  # index of URI -> [standby sessions]
+        # sessions to a URI resume each other, by an ID fixed for the URI
+        self.resumeIDs = [os.urandom(16).hex() for uri in uris or []]
+
+    def isAvailable(self):
+        # resumable sessions get packets queued while reconnecting
+        return self.connections > 0 or self.resumeStore is not None
+
+    def __enlist(self, index, session):
+        if self.active.get(index) is None:
+            self.__promote(index, session)
+        else:
+            self.standbys.setdefault(index, []).append(session)
 
-    async def __connect(self, baseURI):
+    def __promote(self, index, session):
+        self.active[index] = session
+        self.increaseConnectionsCount()
+        session.activate()
+
+    def __dismiss(self, index, session):
+        standbys = self.standbys.get(index, [])
+        if session in standbys:
+            standbys.remove(session)
+        elif self.active.get(index) is session:
+            self.active[index] = None
+            self.decreaseConnectionsCount()
+            if standbys:
+                info("Standby connection %d takes over." % standbys[0].wsid)
+                self.__promote(index, standbys.pop(0))
+
+    def __open(self, index, uri):
+        # Returns an async context manager of a connection to `uri`, its
+        # path (None for UDP, chosen by the connection), and WebsocketSession
+        # arguments for it.
+        if uri.startswith("udp://"):
+            # sessions over UDP don't resume
+            options = getDatagramSessionOptions(self.sessionOptions)
+            return DatagramConnector(uri), None, options
+        options = {
+            "resumeStore": self.resumeStore,
+            "resumeID": self.resumeIDs[index],
+        }
+        options.update(self.sessionOptions)
+        if not uri.endswith("/"): uri += "/"
+        uri += "?_=%s" % os.urandom(32).hex()
+        # frames are encrypted, so WebSocket compression can't help
+        return connect(uri, compression=None), uri, options
+
+    async def __connect(self, index, baseURI):
+        delay = RECONNECT_MIN
+        uri = baseURI
         while True:
+            session, started, shapers = None, None, None
             try:
-                uri = baseURI
-                if not uri.endswith("/"): uri += "/"
-                uri += "?_=%s" % os.urandom(32).hex()
-                async with websockets.connect(uri) as websocket:
-                    self.increaseConnectionsCount()
-                    await WebsocketSession(
+                opener, path, options = self.__open(index, uri)
+                async with opener as websocket:
+                    started = time.time()
+                    # all connections count as one client, identified by None
+                    shapers = self.acquireShapers(None)
+                    session = WebsocketSession(
                         websocket=websocket,
-                        path=uri,
+                        path=path or websocket.path,
                         key=self.key,
                         fromWSQueue=self.fromWSQueue,
-                        toWSQueue=self.toWSQueue
+                        toWSQueue=self.toWSQueue,
+                        router=self.router,
+                        vnetHeader=self.vnetHeader,
+                        sendShaper=shapers[0],
+                        receiveShaper=shapers[1],
+                        **options
                     )
+                    if path is None: websocket.probe(session)
+                    self.__enlist(index, session)
+                    await session
             except Exception as e:
                 debug("Client connection break, reason: %s" % e)
             finally:
-                self.decreaseConnectionsCount()
-                info("Connection failed or broken. Try again in 5 seconds.")
-                await asyncio.sleep(5)
+                if session: self.__dismiss(index, session)
+                if shapers: self.releaseShapers(None)
+
+            # over UDP without answer, try the fallback next, and UDP again
+            # once that breaks
+            fallback = self.fallbacks[index]
+            if fallback and uri == baseURI and \
+                    not (session and session.peerAuthenticated):
+                info("No answer from %s, falling back to %s." % (
+                    baseURI, fallback))
+                uri = fallback
+                continue
+            uri = baseURI
+
+            if started and time.time() - started > RECONNECT_RESET:
+                delay = RECONNECT_MIN
+            wait = delay / 2 + random.uniform(0, delay / 2)
+            delay = min(RECONNECT_MAX, delay * 2)
+            info("Connection failed or broken. Try again in %.2f seconds." %
+                wait)
+            await asyncio.sleep(wait)
+            METRICS.reconnects += 1
 
     def __await__(self):
         assert self.toWSQueue != None and self.fromWSQueue != None
-        services = [self.__connect(uri) for uri in self.uris]
+        services = [
+            self.__connect(index, uri)
+            for index, uri in enumerate(self.uris)
+            for i in range(1 + self.standby)
+        ]
         yield from asyncio.gather(*services)
@@ -1,40 +1,89 @@
 #!/usr/bin/env python3
 
 import asyncio
-import websockets
+from websockets import serve
 import time
 import sys
 from logging import info, debug, critical, exception
 
 from ._wssession import WebsocketSession
 from ._transport import SizzlerTransport
+from ..packetqueue import FairPacketQueue
 
 
 class WebsocketServer(SizzlerTransport):
 
-    def __init__(self, host=None, port=None, key=None):
-        SizzlerTransport.__init__(self)
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        key=None,
+        sessionOptions=None,
+        reusePort=False,
+        resume=0,
+        shaping=None
+    ):
+        SizzlerTransport.__init__(self, sessionOptions, resume, shaping)
         self.host = host
         self.port = port
         self.key = key
+        self.reusePort = reusePort  # let several workers listen on one port
 
-    async def __wsHandler(self, websocket, path):
+    def isAvailable(self):
+        # packets are queued while clients may still resume their sessions
+        return self.connections > 0 or bool(
+            self.resumeStore and self.resumeStore.isResumable())
+
+    def __identify(self, websocket):
+        try:
+            return websocket.remote_address[0]
+        except Exception:
+            return None
+
+    async def __wsHandler(self, websocket, path=None):
+        # newer versions of websockets pass no path, but keep it in request
+        if path is None:
+            path = getattr(websocket, "path", None) or websocket.request.path
         info("New connection: %s" % path)
+        # Clients are told apart by their IP address, for limits and fair
+        # shares of the queue towards TUN.
+        client = self.__identify(websocket)
+        sendShaper, receiveShaper = self.acquireShapers(client)
+        fromWSQueue = self.fromWSQueue
+        if isinstance(fromWSQueue, FairPacketQueue):
+            fromWSQueue = fromWSQueue.lane(client)
         try:
             self.increaseConnectionsCount()
             await WebsocketSession(
                 websocket=websocket,
                 path=path,
                 key=self.key,
-                fromWSQueue=self.fromWSQueue,
-                toWSQueue=self.toWSQueue
+                fromWSQueue=fromWSQueue,
+                toWSQueue=self.toWSQueue,
+                router=self.router,
+                client=client,
+                vnetHeader=self.vnetHeader,
+                learnAddresses=True,
+                activateByPeer=True,
+                resumeStore=self.resumeStore,
+                sendShaper=sendShaper,
+                receiveShaper=receiveShaper,
+                **self.sessionOptions
             )
         except Exception as e:
             debug("Server connection break, reason: %s" % e)
         finally:
+            self.releaseShapers(client)
+            if fromWSQueue is not self.fromWSQueue: fromWSQueue.release()
             self.decreaseConnectionsCount()
             info("Current alive connections: %d" % self.connections)
 
     def __await__(self):
         assert self.toWSQueue != None and self.fromWSQueue != None
-        yield from websockets.serve(self.__wsHandler, self.host, self.port)
+        yield from serve(
+            self.__wsHandler,
+            self.host,
+            self.port,
+            compression=None,   # frames are encrypted, nothing to compress
+            reuse_port=self.reusePort
+        ).__await__()
@@ -2,17 +2,63 @@
 
 import os
 import fcntl
+import socket
 import struct
 import asyncio
+import collections
 from logging import info, debug, critical, exception
 
 from .transport._transport import SizzlerTransport
+from .transport.router import PacketRouter
+from .packetqueue import PacketQueue, PriorityPacketQueue, FairPacketQueue
+from .metrics import METRICS
+from .capture import CAPTURE, CAPTURE_TUN_READ, CAPTURE_TUN_WRITE
+from .packet import PACKET_INFO_SIZE, VNET_HEADER_SIZE, setVnetHeader, \
+    clampMSS
+from .mtu import getTunnelMTU
+from .util.workers import EXCHANGE_PUBLISH_INTERVAL
 
 TUNSETIFF = 0x400454ca  
 IFF_TUN   = 0x0001      # Set up TUN device
 IFF_TAP   = 0x0002      # Set up TAP device
 IFF_NO_PI = 0x1000      # Without this flag, received frame will have 4 bytes
                         # for flags and protocol(each 2 bytes)
+IFF_MULTI_QUEUE = 0x0100 # Allow opening the device multiple times, the
+                        # kernel spreads outgoing flows across all queues
+IFF_VNET_HDR = 0x4000   # Packets carry a virtio-net header, with GSO info
+
+TUNSETOFFLOAD = 0x400454d0
+TUN_F_CSUM    = 0x01    # We accept packets with partial checksums
+TUN_F_TSO4    = 0x02    # ... and TCP super-packets over IPv4
+TUN_F_TSO6    = 0x04    # ... and over IPv6
+TUN_F_TSO_ECN = 0x08    # ... also with ECN set
+TUN_OFFLOADS = TUN_F_CSUM | TUN_F_TSO4 | TUN_F_TSO6 | TUN_F_TSO_ECN
+
+# largest IP packet, plus packet information and virtio-net header
+TUN_READ_SIZE = 0xFFFF + PACKET_INFO_SIZE + VNET_HEADER_SIZE
+
+# How the TUN device is read and written:
+#   executor:    blocking fd, every read/write is run in the default executor
+#   nonblocking: O_NONBLOCK fd, driven by the event loop via add_reader and
+#                add_writer, all readable packets are drained per wakeup
+TUN_ENGINES = ["executor", "nonblocking"]
+
+# Max. packets drained from the TUN fd per wakeup, and max. packets kept
+# waiting for the consumer before we stop watching the fd.
+TUN_DRAIN_BATCH = 64
+TUN_PENDING_MAX = 256
+
+QUEUE_REPORT_INTERVAL = 60
+
+# ioctls to configure a network interface, from linux/sockios.h and
+# linux/if.h; each takes a struct ifreq (name, then a union of 16 bytes)
+SIOCGIFFLAGS   = 0x8913
+SIOCSIFFLAGS   = 0x8914
+SIOCSIFADDR    = 0x8916
+SIOCSIFDSTADDR = 0x8918
+SIOCSIFNETMASK = 0x891c
+SIOCSIFMTU     = 0x8922
+IFF_UP = 0x1
 
 def _getTUNDeviceLocation():
     if os.path.exists("/dev/net/tun"): return "/dev/net/tun"
@@ -20,10 +66,31 @@ def _getTUNDeviceLocation():
     critical("TUN/TAP device not found on this OS!")
     raise Exception("No TUN/TAP device available.")
 
+def _configureInterface(name, ip, netmask, dstip, mtu):
+    # Set addresses and MTU of the interface `name` and bring it up, like
+    # `ifconfig name inet ip netmask netmask pointopoint dstip mtu mtu up`
+    # would, but without running a program for it.
+    name = name.encode("ascii")
+    def address(value):
+        return struct.pack(
+            "16sH2s4s8x", name, socket.AF_INET, b"", socket.inet_aton(value))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        fcntl.ioctl(sock, SIOCSIFADDR, address(ip))
+        fcntl.ioctl(sock, SIOCSIFNETMASK, address(netmask))
+        fcntl.ioctl(sock, SIOCSIFDSTADDR, address(dstip))
+        fcntl.ioctl(sock, SIOCSIFMTU, struct.pack("16si12x", name, mtu))
+        ret = fcntl.ioctl(sock, SIOCGIFFLAGS, struct.pack("16s16x", name))
+        flags, = struct.unpack_from("H", ret, 16)
+        fcntl.ioctl(
+            sock, SIOCSIFFLAGS, struct.pack("16sH14x", name, flags | IFF_UP))
+    finally:
+        sock.close()
+
 def _getReader(tun):
     loop = asyncio.get_event_loop()
     async def read():
-        future = loop.run_in_executor(None, os.read, tun, 65536)
+        future = loop.run_in_executor(None, os.read, tun, TUN_READ_SIZE)
         return await future
     return read
 
@@ -39,62 +106,278 @@ def _getWriter(tun):
         await future
     return write
 
+def _getNonblockingReader(tun):
+    # All reads go into one preallocated buffer; only the bytes of the actual
+    # packet are copied out. The fd is watched as long as the consumer keeps
+    # up, and unwatched while TUN_PENDING_MAX packets are waiting.
+    loop = asyncio.get_event_loop()
+    buffer = bytearray(TUN_READ_SIZE)
+    view = memoryview(buffer)
+    pending = collections.deque()
+    waiter = None
+    watching = False
+
+    def watch(enable):
+        nonlocal watching
+        if enable and not watching:
+            loop.add_reader(tun, onReadable)
+        if not enable and watching:
+            loop.remove_reader(tun)
+        watching = enable
+
+    def onReadable():
+        error = None
+        try:
+            for i in range(TUN_DRAIN_BATCH):
+                length = os.readv(tun, [buffer])
+                pending.append(bytes(view[:length]))
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            error = e
+        if error or len(pending) >= TUN_PENDING_MAX: watch(False)
+        if waiter is None or waiter.done(): return
+        if error:
+            waiter.set_exception(error)
+        elif pending:
+            waiter.set_result(None)
+
+    async def read():
+        nonlocal waiter
+        while not pending:
+            watch(True)
+            waiter = loop.create_future()
+            await waiter
+        if len(pending) < TUN_PENDING_MAX: watch(True)
+        return pending.popleft()
+    return read
+
+def _getNonblockingWriter(tun):
+    # Write directly; only if the kernel queue is full wait for the fd to
+    # become writable again.
+    loop = asyncio.get_event_loop()
+    async def write(data):
+        while True:
+            try:
+                os.write(tun, data)
+                return
+            except BlockingIOError:
+                waiter = loop.create_future()
+                loop.add_writer(
+                    tun,
+                    lambda: waiter.done() or waiter.set_result(None)
+                )
+                try:
+                    await waiter
+                finally:
+                    loop.remove_writer(tun)
+    return write
+
 
 class SizzlerVirtualNetworkInterface:
 
-    def __init__(self, ip, dstip, mtu=1500, netmask="255.255.255.0"):
+    def __init__(
+        self,
+        ip,
+        dstip,
+        mtu=1500,
+        netmask="255.255.255.0",
+        engine="executor",
+        queues=1,
+        queueOptions=None,
+        routerOptions=None,
+        priorityOptions=None,
+        offload=False,
+        clamp=True,
+        fair=False,
+        fd=None
+    ):
+        if engine not in TUN_ENGINES:
+            raise Exception("Unknown TUN engine: %s" % engine)
+        assert queues >= 1
         self.ip = ip
         self.dstip = dstip
         self.mtu = mtu
+        # With `clamp`, TCP connections through the tunnel are told to use
+        # segments fitting into this MTU, lowered if a connection finds a
+        # smaller path MTU than expected. 0 to leave them alone.
+        self.clampMTU = mtu if clamp else 0
         self.netmask = netmask
-        self.__tunR, self.__tunW = self.__setup()
-        self.toWSQueue = asyncio.Queue()
-        self.fromWSQueue = asyncio.Queue()
+        self.engine = engine
+        # In offload mode, the kernel passes TCP super-packets of up to 64kB
+        # and leaves checksums to us, see offload.py.
+        self.offload = offload
+        setVnetHeader(offload)
+        self.queueOptions = queueOptions or {} # arguments for PacketQueue
+        self.routerOptions = routerOptions or {} # arguments for PacketRouter
+        # arguments for PriorityPacketQueue, None for plain FIFO queues
+        self.priorityOptions = priorityOptions
+        # with `fair`, packets towards TUN wait in a lane per client (on a
+        # server), served in turns
+        self.fair = fair
+        if fd is None:
+            self.tuns = self.__setup(queues)
+        else:
+            # use a given fd (e.g. a socket) in place of a TUN device
+            os.set_blocking(fd, engine != "nonblocking")
+            self.tuns = [fd]
         self.transports = []
+        self.exchange = None
+        if queues == 1: self.selectQueue(0)
 
-    def __setup(self):
+    def __setup(self, queues):
+        # Returns a list of fds, one for each queue of the device.
         try:
-            self.tun = os.open(_getTUNDeviceLocation(), os.O_RDWR)
-            ret = fcntl.ioctl(\
-                self.tun,
-                TUNSETIFF,
-                struct.pack("16sH", b"sizzler-%d", IFF_TUN)
-            )
-            tunName = ret[:16].decode("ascii").strip("\x00")
-            info("Virtual network interface [%s] created." % tunName)
+            flags = os.O_RDWR
+            if self.engine == "nonblocking": flags |= os.O_NONBLOCK
+            tunFlags = IFF_TUN
+            if queues > 1: tunFlags |= IFF_MULTI_QUEUE
+            if self.offload: tunFlags |= IFF_VNET_HDR
 
-            os.system("ifconfig %s inet %s netmask %s pointopoint %s" %
-                (tunName, self.ip, self.netmask, self.dstip)
+            tuns, tunName = [], b"sizzler-%d"
+            for i in range(queues):
+                tun = os.open(_getTUNDeviceLocation(), flags)
+                ret = fcntl.ioctl(\
+                    tun,
+                    TUNSETIFF,
+                    struct.pack("16sH", tunName, tunFlags)
+                )
+                tunName = ret[:16].rstrip(b"\x00")
+                if self.offload:
+                    fcntl.ioctl(tun, TUNSETOFFLOAD, TUN_OFFLOADS)
+                tuns.append(tun)
+            tunName = tunName.decode("ascii")
+            info("Virtual network interface [%s] created with %d queue(s)." %
+                (tunName, queues)
             )
-            os.system("ifconfig %s mtu %d up" % (tunName, self.mtu))
+
+            try:
+                _configureInterface(
+                    tunName, self.ip, self.netmask, self.dstip, self.mtu)
+            except OSError as e:
+                # e.g. on systems with other ioctls, try ifconfig instead
+                debug("Cannot configure %s by ioctl: %s" % (tunName, e))
+                os.system("ifconfig %s inet %s netmask %s pointopoint %s" %
+                    (tunName, self.ip, self.netmask, self.dstip)
+                )
+                os.system("ifconfig %s mtu %d up" % (tunName, self.mtu))
             info(
-                """%s: mtu %d  addr %s  netmask %s  dstaddr %s""" %
-                (tunName, self.mtu, self.ip, self.netmask, self.dstip)
+                """%s: mtu %d  addr %s  netmask %s  dstaddr %s  engine %s"""
+                """  offload %s  clamp %s""" %
+                (tunName, self.mtu, self.ip, self.netmask, self.dstip,
+                self.engine, "on" if self.offload else "off",
+                "on" if self.clampMTU else "off")
             )
 
-            return _getReader(self.tun), _getWriter(self.tun)
+            return tuns
         except Exception as e:
             exception(e)
             raise Exception("Cannot set TUN/TAP device.")
 
+    def selectQueue(self, index, exchange=None):
+        # Use the queue `index` of the device in this process and close all
+        # others. Called once, in the worker process (and event loop) that is
+        # going to serve this queue, with the WorkerExchange of all workers.
+        self.exchange = exchange
+        for i, tun in enumerate(self.tuns):
+            if i != index: os.close(tun)
+        self.tun = self.tuns[index]
+        self.tuns = [self.tun]
+
+        if self.engine == "nonblocking":
+            self.__tunR = _getNonblockingReader(self.tun)
+            self.__tunW = _getNonblockingWriter(self.tun)
+        else:
+            self.__tunR = _getReader(self.tun)
+            self.__tunW = _getWriter(self.tun)
+        self.toWSQueue = self.createQueue()
+        if self.fair:
+            self.fromWSQueue = FairPacketQueue(self.queueOptions)
+        else:
+            self.fromWSQueue = self.createQueue(prioritized=False)
+        self.router = PacketRouter(self, **self.routerOptions)
+        METRICS.addQueue("toWS", self.toWSQueue)
+        METRICS.addQueue("fromWS", self.fromWSQueue)
+
+    def createQueue(self, prioritized=True):
+        # queues towards connections may have priority lanes
+        if prioritized and self.priorityOptions is not None:
+            return PriorityPacketQueue(
+                queueOptions=self.queueOptions, **self.priorityOptions)
+        return PacketQueue(**self.queueOptions)
+
     def connect(self, transport):
         assert isinstance(transport, SizzlerTransport)
         self.transports.append(transport)
         transport.fromWSQueue = self.fromWSQueue
         transport.toWSQueue = self.toWSQueue
+        transport.router = self.router
+        transport.vnetHeader = self.offload
+
+    def fitPath(self, pathMTU):
+        # called by sessions with the path MTU of their connection
+        mtu = getTunnelMTU(pathMTU)
+        if not self.clampMTU or mtu >= self.clampMTU: return
+        info("Path MTU is %d, clamping TCP MSS to fit MTU %d." % (
+            pathMTU, mtu))
+        self.clampMTU = mtu
 
     def __countAvailableTransports(self):
-        count = sum([each.connections for each in self.transports])
+        count = sum([each.isAvailable() for each in self.transports])
         return count
 
+    def __reportQueues(self):
+        # log queue counters, at info level if any packets were dropped
+        queues = [("toWS", self.toWSQueue), ("fromWS", self.fromWSQueue)] + [
+            ("ws%d" % session.wsid, queue)
+            for session, queue in self.router.queues.items()
+        ]
+        for name, queue in queues:
+            stats = queue.stats()
+            report = info if stats["dropped"] else debug
+            report(
+                "Queue %s: depth %d (%d bytes, peak %d), enqueued %d, "
+                "dequeued %d, dropped %d (%d bytes)" % (
+                    name, stats["depth"], stats["bytes"], stats["peak"],
+                    stats["enqueued"], stats["dequeued"], stats["dropped"],
+                    stats["droppedBytes"]
+                )
+            )
+
     def __await__(self):
+        async def reportQueues():
+            while True:
+                await asyncio.sleep(QUEUE_REPORT_INTERVAL)
+                self.__reportQueues()
         async def proxyQueueToTUN():
             while True:
                 s = await self.fromWSQueue.get()
+                if self.clampMTU: s = clampMSS(s, self.clampMTU)
+                if CAPTURE.armed: CAPTURE.record(CAPTURE_TUN_WRITE, 0, s)
                 await self.__tunW(s)
         async def proxyTUNToQueue():
             while True:
                 s = await self.__tunR()
-                if self.__countAvailableTransports() < 1: continue
-                await self.toWSQueue.put(s)
-        yield from asyncio.gather(proxyQueueToTUN(), proxyTUNToQueue())
+                if CAPTURE.armed: CAPTURE.record(CAPTURE_TUN_READ, 0, s)
+                if self.__countAvailableTransports() < 1:
+                    # another worker may have connections
+                    if self.exchange: self.exchange.handOver(s)
+                    continue
+                if self.clampMTU: s = clampMSS(s, self.clampMTU)
+                await self.router.dispatch(s)
+        async def proxyExchangeToQueue():
+            # packets handed over by other workers, never handed on again
+            while True:
+                available = self.__countAvailableTransports() > 0
+                self.exchange.publish(available)
+                try:
+                    s = await asyncio.wait_for(
+                        self.exchange.receive(), EXCHANGE_PUBLISH_INTERVAL)
+                except asyncio.TimeoutError:
+                    continue
+                if not available: continue
+                if self.clampMTU: s = clampMSS(s, self.clampMTU)
+                await self.router.dispatch(s)
+        jobs = [proxyQueueToTUN(), proxyTUNToQueue(), reportQueues()]
+        if self.exchange: jobs.append(proxyExchangeToQueue())
+        yield from asyncio.gather(self.router, *jobs)
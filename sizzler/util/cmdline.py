@@ -39,7 +39,9 @@ EXAMPLE_CONFIG = """
 
 
 # This is the key for authorized access to your virtual network.
-# Must be kept secret.
+# Must be kept secret. Against replays of captured traffic, frames carry the
+# time they were sent, so the clocks of server and clients must agree within
+# 5 minutes; use NTP or the like.
 
 key: example-key
 
@@ -49,23 +51,278 @@ key: example-key
 ip:
     server: 10.1.0.1
     client: 10.1.0.2
+    ipv6: null
 
-# The server will listen on the address and port as follow.
+# A server may serve several clients at once, each configured with its own
+# client IP address. The server sends packets to whichever client has sent
+# from the destination address last. Addresses other than the one above
+# need a route to the server's interface, e.g.
+#   ip route add 10.1.0.0/24 dev sizzler-0
+# Clients are told apart by their IP address, and their addresses must be
+# within the subnet of the interface (/24). An address stays with its client
+# when it disconnects. While several clients are connected, packets to
+# addresses not learned from any client are dropped, and once more than one
+# client has connected, so are those to unknown addresses within the subnet.
+# IPv6 addresses are learned the same way within the prefix `ipv6` (e.g.
+# fd00:1::/64), if given; setting up IPv6 on the interfaces is up to you.
+
+# The server will listen on the address and port as follow. With a UDP port
+# other than 0, the server also takes connections over UDP on that port.
+# These carry the same encrypted frames, one per datagram, which avoids TCP
+# retransmissions and head-of-line blocking getting in the way of the
+# tunneled traffic on lossy paths. Over UDP, zlib compression, resuming and
+# tun offload are not available, and aggregated frames are no larger than
+# the frame of a full-size packet (see `tun: mtu`), so that datagrams aren't
+# fragmented. A client changing its address keeps its connection, once the
+# server received an authentic frame from there; but with multiple workers,
+# it may end up with another worker, and has to wait for its connection to
+# time out and reconnect.
 
 server:
     host: localhost
     port: 8765
+    udp: 0
 
 # The client will attempt accessing the server via following URI. This may
 # differ from above server settings, especially when you desire to use e.g.
 # reverse proxies.
 #
 # Listing multiple URIs will make client also use multiple connections.
+#
+# A udp:// URI connects over UDP to a server's UDP port. If given with a
+# fallback URI, the client connects to that one instead whenever the server
+# doesn't answer over UDP within a few seconds, and tries UDP again once the
+# fallback connection breaks.
 
 client:
     - ws://123.1.1.1:8765   # suppose this is the server's Internet IP
     - ws://example.com/foo  # if you can redirect this to 123.1.1.1:8765
     - wss://example.org/bar # you may also use wss:// protocol
+    - uri: udp://123.1.1.1:8766
+      fallback: ws://123.1.1.1:8765
+
+# Client only: number of standby connections kept per URI. They stay idle
+# until the active connection to their URI breaks, then one of them takes
+# over at once, without waiting for reconnecting.
+
+standby: 0
+
+# Number of worker processes. With more than 1, the interface is opened
+# with multiple queues, and each worker serves one queue with its own
+# connections, so that traffic is spread over several CPU cores by the kernel.
+# A worker without any connection hands its packets over to one with
+# connections, so a single client connection suffices. With several
+# clients, a server worker only knows the addresses of clients connected to
+# itself, so each client should open at least as many connections (URIs, or
+# client workers) as there are server workers.
+
+workers: 1
+
+# Optional tuning of the virtual network interface. These settings are valid
+# for both server and client and may be omitted.
+
+tun:
+    # How packets are read from and written to the interface:
+    #   executor    - blocking reads/writes in a thread pool (default)
+    #   nonblocking - non-blocking reads/writes on the event loop, draining
+    #                 all pending packets at once; faster at high rates
+    engine: executor
+    # With offload, the kernel hands over TCP super-packets of up to 64kB,
+    # which are sent as single frames, instead of segmenting them to the MTU
+    # first. This saves a lot of CPU time for bulk TCP transfers. A peer
+    # without offload segments them itself, so both ends may differ.
+    offload: false
+    # MTU of the interface, `auto` (default) to compute it from `path`, the
+    # MTU of the network between both computers: every packet of the
+    # interface, with all that's added on its way (encryption, WebSocket,
+    # TLS, TCP and IP headers), then fits into a single TCP segment, which
+    # spares fragmentation and oversized messages at reverse proxies. For a
+    # path MTU of 1500, this gives an MTU of 1332. Random padding doesn't
+    # pad frames beyond the size of a full-size packet's frame either.
+    mtu: auto
+    path: 1500
+    # Lower the MSS option of TCP connections through the tunnel to fit into
+    # the MTU, also when a connection finds a smaller path MTU than `path`.
+    # This helps when the MTU of the computers behind the interfaces is
+    # larger.
+    clamp: true
+
+# Optional tuning of the Python runtime.
+
+runtime:
+    # Event loop: asyncio (default), uvloop, or auto (uvloop if installed,
+    # otherwise asyncio). uvloop (pip3 install uvloop) lowers the CPU time
+    # spent per packet. The one in use is logged at startup.
+    loop: asyncio
+    # Threads for blocking TUN I/O and crypto, 0 for one per CPU plus one
+    # (default).
+    executor: 0
+    # Pin the event loop to this CPU; worker N uses CPU `cpu + N`. Omit to
+    # let the system decide.
+    # cpu: 0
+    # Socket buffer sizes of the connections in bytes, 0 for the system
+    # default, and whether to disable Nagle's algorithm (default: true).
+    sndbuf: 0
+    rcvbuf: 0
+    nodelay: true
+
+# Optional limits for the queues of packets between the interface and the
+# connections. When the connections are slower than the local network, full
+# queues drop packets instead of growing without bounds, which keeps latency
+# low. `packets` and `bytes` limit the size of each queue (0 for unlimited).
+# `policy` decides which packets are dropped:
+#   taildrop - new packets, when the queue is full (default)
+#   headdrop - the oldest packets, when the queue is full
+#   codel    - packets waiting longer than `target` seconds for at least
+#              `interval` seconds, or new ones when the queue is full
+# Queue counters are logged every minute, at info level if packets dropped.
+
+queue:
+    packets: 1000
+    bytes: 0
+    policy: taildrop
+    target: 0.005
+    interval: 0.1
+
+# Optional priority lanes in the queues towards the connections, so that
+# interactive traffic doesn't wait behind bulk transfers. Packets are
+# interactive if marked so by DSCP (EF, CS5-7, AF4x), from/to a port in
+# `interactive`, or (except TCP) up to `small` bytes long. They are bulk if
+# marked by DSCP as CS1/LE or from/to a port in `bulk`, and normal
+# otherwise. Each flow stays in the lane of its first packet, so that its
+# packets aren't reordered; only TCP SYN, FIN and pure ACKs without payload
+# are always interactive. `scheduler` is one of:
+#   none   - no lanes, one FIFO queue (default)
+#   strict - interactive packets first, then normal ones, then bulk ones
+#   drr    - deficit round-robin, bandwidth shared by `weights` of the lanes
+#            (interactive, normal, bulk) when all are busy
+# Limits of the `queue` section apply to each lane.
+
+priority:
+    scheduler: none
+    small: 128
+    interactive: [22, 53, 123, 3389, 5900]
+    bulk: []
+    weights: [8, 4, 1]
+
+# Optional scheduling of packets across multiple connections. Each flow
+# (TCP connection etc.) sticks to one connection, so its packets arrive in
+# order. It only moves when that connection breaks, or when more than
+# `congested` packets wait for it while another connection has less than
+# half as many waiting. New flows pick a connection by `policy`:
+#   hash - by a hash of the flow's addresses and ports (default)
+#   rtt  - weighted round-robin, preferring connections with lower RTT
+
+schedule:
+    policy: hash
+    congested: 100
+
+# Optional limits of bytes per second (0 for no limit) of the connections,
+# as sent and received by this end, allowing bursts of up to `burst` bytes.
+# `session` limits each connection, `client` all connections of a client
+# together; on a server, clients are told apart by their IP address. Frames
+# beyond a limit wait, so TCP slows down the sender.
+# With `fair`, a server keeps packets received from each client in a queue
+# of their own (with the limits of `queue` each), and writes them to the
+# interface in turns, so that a busy client can't crowd out the others.
+
+shaping:
+    session:
+        send: 0
+        receive: 0
+        burst: 65536
+    client:
+        send: 0
+        receive: 0
+        burst: 262144
+    fair: true
+
+# Optional capture of recent packets, for debugging without debug logs. While
+# armed, the last `packets` packets read from and written to the interface,
+# sent and received by each connection, are kept in memory (their first
+# `snaplen` bytes). `kill -USR2 <pid>` arms or disarms the capture, and
+# `kill -USR1 <pid>` writes it to a pcapng file in `directory`, for
+# Wireshark. This costs next to nothing while disarmed, and little while
+# armed, so it may be armed all the time.
+
+capture:
+    packets: 4096
+    snaplen: 256
+    armed: false
+    directory: /tmp
+
+# Optional metrics (packets, bytes, crypto times, RTTs, queues etc.) for
+# Prometheus, served at http://host:port/metrics. A port of 0 disables this.
+# With multiple workers, worker N uses port + N.
+
+metrics:
+    host: 127.0.0.1
+    port: 0
+
+# Optional tuning of the connections between server and client.
+
+session:
+    # Pack several queued packets into one encrypted frame, which saves CPU
+    # and bandwidth under bulk transfers. `bytes` is the max. frame size
+    # (0 disables aggregation, max. 65523), `linger` the max. seconds to wait
+    # for more packets once one is ready. Peers always accept such frames.
+    aggregate:
+        bytes: 0
+        linger: 0
+
+    # How encryption and decryption are run:
+    #   executor - each packet in a thread pool (default)
+    #   inline   - each packet directly, cheapest for small packets
+    #   batch    - packets of many connections together in a thread pool
+    #   auto     - inline for small packets, batch for large ones
+    # Run `python3 -m sizzler.crypto.crypto` to compare them on your machine.
+    crypto: executor
+
+    # Resume sessions on new connections: up to `resume` frames not yet
+    # acknowledged by the peer are kept, and sent again on the next
+    # connection, so packets in flight are not lost when a connection
+    # breaks. 0 disables this. Set it on both ends, older versions of Sizzler
+    # don't support it.
+    resume: 0
+
+    # Seconds between heartbeats. A peer is considered dead after missing 3
+    # of its heartbeats (at least 2 seconds, at most 30 seconds of silence),
+    # then the connection is closed and the client reconnects. Set e.g. 1 on
+    # both ends to detect broken connections within a few seconds, at the
+    # cost of more frames on idle connections.
+    heartbeat: 5
+
+    # Compress frames before encryption, which saves bandwidth for plain
+    # text traffic like HTTP or logs. Flows not compressing well, like TLS,
+    # are detected and skipped. `algorithm` is one of:
+    #   none - no compression (default)
+    #   zlib - better compression, one stream per connection; `level` 1-9
+    #   lz4  - faster, needs `pip3 install lz4` on both ends
+    # Peers always accept compressed frames. The compression ratio is logged
+    # when a connection closes, and exported as a metric.
+    # Beware: compressing before encryption lets frame sizes tell how well
+    # the contents compress. Someone who can both inject data into a flow
+    # and watch the tunnel may guess secrets sent along (like cookies, see
+    # the CRIME attack), all the more with zlib, whose stream spans all
+    # frames of a connection. Only compress traffic which isn't sensitive
+    # to this; compression is refused together with `padding: none`.
+    compress:
+        algorithm: none
+        level: 1
+
+    # Pad frames before encryption, so that their sizes tell less about the
+    # packets within. `policy` is one of:
+    #   random - to a random size (default)
+    #   bucket - to the next of the sizes in `buckets`, which costs less
+    #            bandwidth and CPU, but tells a little more
+    #   none   - no padding, least bandwidth and CPU, frame sizes tell the
+    #            packet sizes
+    # Frames are never padded beyond the size of a frame with a full-size
+    # packet of the interface (see `tun: mtu`). Each end pads its frames as
+    # configured.
+    padding:
+        policy: random
+        buckets: [128, 256, 512, 1024, 1536, 2048]
 """
 
 #----------------------------------------------------------------------------#
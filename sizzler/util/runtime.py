@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import asyncio
+import concurrent.futures
+from logging import info, debug, critical, exception
+
+# Which event loop implementation to use:
+#   asyncio: the stock event loop (default)
+#   uvloop:  uvloop, fail if not installed
+#   auto:    uvloop if installed, otherwise the one of asyncio
+EVENT_LOOPS = ["auto", "asyncio", "uvloop"]
+
+
+def useEventLoop(kind="asyncio"):
+    # Install the event loop policy for `kind`, and set a new event loop for
+    # this process. Event loops of forked workers use the same policy.
+    # Returns the name of the implementation in use.
+    if kind not in EVENT_LOOPS:
+        raise Exception("Unknown event loop: %s" % kind)
+    name = "asyncio"
+    if kind != "asyncio":
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            name = "uvloop"
+        except ImportError:
+            if kind == "uvloop":
+                raise Exception("Event loop uvloop requested, not installed.")
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    info("Using event loop of %s." % name)
+    return name
+
+def tuneEventLoop(loop, executor=0, cpu=None):
+    # Give `loop` a default executor of `executor` threads (0 for one per
+    # CPU, plus one for the blocking TUN reads of the executor engine), and
+    # pin the thread running the loop to CPU `cpu`. The executor threads may
+    # still use all CPUs, as they do TUN I/O and crypto.
+    cpus = os.sched_getaffinity(0)
+    threads = executor or len(cpus) + 1
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+        max_workers=threads,
+        initializer=os.sched_setaffinity,
+        initargs=(0, cpus)
+    ))
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    info("Event loop pinned to CPU %s, executor with %d threads." % (
+        "(none)" if cpu is None else cpu, threads
+    ))
+
+def tuneSocket(websocket, sndbuf=0, rcvbuf=0, nodelay=True):
+    # Set buffer sizes (0 keeps the system default) and TCP_NODELAY on the
+    # socket under a WebSocket connection, or a connection over UDP (which
+    # may be shared with other connections).
+    try:
+        sock = websocket.transport.get_extra_info("socket")
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sock.family in [socket.AF_INET, socket.AF_INET6] and \
+                sock.type == socket.SOCK_STREAM:
+            sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if nodelay else 0)
+    except Exception as e:
+        debug("Cannot tune socket of connection: %s" % e)
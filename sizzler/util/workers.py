@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import zlib
+import signal
+import socket
+import asyncio
+from logging import info, debug, critical
+
+from ..packet import getFlowKey
+
+# Workers tell each other this often whether they have connections.
+EXCHANGE_PUBLISH_INTERVAL = 0.25
+EXCHANGE_PACKET_MAX = 0x20000
+
+
+def forkWorkers(count):
+    # Fork `count` worker processes and return the index (0 ... count-1) of
+    # the worker in each of them. Each worker gets its own fresh event loop.
+    #
+    # The original process becomes a supervisor and never returns: once any
+    # worker exits, all others are terminated and the supervisor exits too,
+    # so that e.g. Supervisor restarts the whole program.
+    if count <= 1: return 0
+
+    children = {}
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            info("Worker %d started as process %d." % (index, os.getpid()))
+            return index
+        children[pid] = index
+
+    def terminate():
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def onSignal(signum, frame):
+        terminate()
+        sys.exit(0)
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, onSignal)
+    signal.signal(signal.SIGINT, onSignal)
+    # e.g. for packet capture, see capture.py
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+
+    pid, status = os.wait()
+    critical("Worker %d exited, stopping all workers." % children.pop(pid))
+    terminate()
+    for pid in children:
+        os.waitpid(pid, 0)
+    sys.exit(1)
+
+
+class WorkerExchange:
+
+    # Hands packets read from the TUN device over to other workers. The
+    # kernel spreads flows across the queues of the device by a hash, not
+    # knowing which worker has connections, so a worker without any (e.g. on
+    # a server with a single client, connected to another worker) passes its
+    # packets on to one that has. Each worker has a datagram socket to
+    # receive such packets, and a flag in memory shared by all workers,
+    # telling whether it has connections. Created before forking.
+
+    def __init__(self, count):
+        self.count = count
+        self.index = None
+        self.flags = mmap.mmap(-1, count)
+        self.sockets = [
+            socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for i in range(count)
+        ]
+
+    def select(self, index):
+        # called in worker `index` after forking, keeps its own socket for
+        # receiving and those of the others for sending
+        self.index = index
+        self.senders = {}
+        for i, (receiver, sender) in enumerate(self.sockets):
+            if i == index:
+                self.receiver = receiver
+                sender.close()
+            else:
+                receiver.close()
+                sender.setblocking(False)
+                self.senders[i] = sender
+        self.receiver.setblocking(False)
+
+    def publish(self, available):
+        self.flags[self.index] = 1 if available else 0
+
+    def handOver(self, packet):
+        # Pass `packet` to a worker with connections, chosen by its flow so
+        # that a flow sticks to one. Returns False if there's none, or its
+        # socket is full.
+        candidates = [i for i in self.senders if self.flags[i]]
+        if not candidates: return False
+        key = getFlowKey(packet) or b""
+        target = candidates[zlib.crc32(key) % len(candidates)]
+        try:
+            self.senders[target].send(packet)
+        except OSError as e:
+            debug("Cannot hand packet over to worker %d: %s" % (target, e))
+            return False
+        return True
+
+    async def receive(self):
+        # a packet handed over by another worker
+        loop = asyncio.get_event_loop()
+        return await loop.sock_recv(self.receiver, EXCHANGE_PACKET_MAX)
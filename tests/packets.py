@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Packets as read from a TUN device (with packet info), for the tests.
+
+import socket
+import struct
+
+from sizzler.offload import onesComplementSum
+
+PACKET_INFO_IPV4 = b"\x00\x00\x08\x00"
+PACKET_INFO_IPV6 = b"\x00\x00\x86\xdd"
+
+
+def ipv4Packet(
+    payload,
+    protocol=17,
+    src="10.1.0.2",
+    dst="10.1.0.1",
+    dscp=0,
+    info=PACKET_INFO_IPV4
+):
+    header = bytearray(struct.pack(
+        "!BBHHHBBH4s4s",
+        0x45,
+        dscp << 2,
+        20 + len(payload),
+        0x1234,
+        0,
+        64,
+        protocol,
+        0,
+        socket.inet_aton(src),
+        socket.inet_aton(dst)
+    ))
+    struct.pack_into("!H", header, 10, ~onesComplementSum(header) & 0xFFFF)
+    return info + bytes(header) + bytes(payload)
+
+def ipv6Packet(payload, protocol=17, src="fd00::2", dst="fd00::1"):
+    header = struct.pack(
+        "!IHBB16s16s",
+        6 << 28,
+        len(payload),
+        protocol,
+        64,
+        socket.inet_pton(socket.AF_INET6, src),
+        socket.inet_pton(socket.AF_INET6, dst)
+    )
+    return PACKET_INFO_IPV6 + header + bytes(payload)
+
+def udpPacket(size, sport=5000, dport=6000, **kwargs):
+    # an IPv4 packet of `size` bytes, without packet info
+    payload = struct.pack("!HHHH", sport, dport, size - 20, 0)
+    return ipv4Packet(payload + bytes(size - 28), 17, **kwargs)
+
+def tcpSegment(
+    sport=40000,
+    dport=80,
+    sequence=1000,
+    flags=0x10,
+    options=b"",
+    payload=b""
+):
+    # a TCP header (checksum left 0) with `options` and `payload`
+    assert len(options) % 4 == 0
+    return struct.pack(
+        "!HHIIBBHHH",
+        sport,
+        dport,
+        sequence,
+        0,
+        (5 + len(options) // 4) << 4,
+        flags,
+        65535,
+        0,
+        0
+    ) + options + payload
+
+def tcpPacket(size=0, version=4, **kwargs):
+    # an IP packet with a TCP segment and a valid checksum, padded with
+    # payload to `size` bytes (without packet info) if given
+    segment = tcpSegment(**kwargs)
+    headerSize = 20 if version == 4 else 40
+    if size: segment += bytes(size - headerSize - len(segment))
+    if version == 4:
+        packet = bytearray(ipv4Packet(segment, 6))
+    else:
+        packet = bytearray(ipv6Packet(segment, 6))
+    start = 4 + headerSize
+    struct.pack_into("!H", packet, start + 16, tcpChecksum(packet[4:]))
+    return bytes(packet)
+
+def tcpChecksum(ip):
+    # the checksum of the TCP segment in IP packet `ip`, computed in full
+    # (with the checksum field taken as 0)
+    ip = bytearray(ip)
+    if ip[0] >> 4 == 4:
+        start = (ip[0] & 0x0F) * 4
+        pseudo = bytes(ip[12:20]) + struct.pack("!BBH", 0, 6, len(ip) - start)
+    else:
+        start = 40
+        pseudo = bytes(ip[8:40]) + struct.pack("!I3xB", len(ip) - start, 6)
+    struct.pack_into("!H", ip, start + 16, 0)
+    return ~onesComplementSum(pseudo + bytes(ip[start:])) & 0xFFFF
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import struct
+
+import pytest
+
+from sizzler.capture import CaptureRing, CAPTURE_POINTS, \
+    CAPTURE_TUN_READ, CAPTURE_WS_SEND, PCAPNG_SECTION_HEADER, \
+    PCAPNG_INTERFACE_DESCRIPTION, PCAPNG_ENHANCED_PACKET
+
+from packets import udpPacket
+
+
+def readPcapng(filename):
+    # (type, body) of each block in the file
+    with open(filename, "rb") as f: data = f.read()
+    blocks, offset = [], 0
+    while offset < len(data):
+        blockType, length = struct.unpack_from("<II", data, offset)
+        assert length % 4 == 0
+        assert struct.unpack_from("<I", data, offset + length - 4)[0] == \
+            length
+        blocks.append((blockType, data[offset+8:offset+length-4]))
+        offset += length
+    assert offset == len(data)
+    return blocks
+
+def readPackets(filename):
+    # (interface, captured data, original length, comment) of each packet
+    packets = []
+    for blockType, body in readPcapng(filename):
+        if blockType != PCAPNG_ENHANCED_PACKET: continue
+        interface, high, low, captured, length = \
+            struct.unpack_from("<IIIII", body)
+        data = body[20:20+captured]
+        options = body[20+captured+(-captured % 4):]
+        comment = None
+        if options[:2] == struct.pack("<H", 1):
+            size, = struct.unpack_from("<H", options, 2)
+            comment = options[4:4+size].decode("ascii")
+        packets.append((interface, data, length, comment))
+    return packets
+
+
+def test_dump_is_pcapng(tmp_path):
+    ring = CaptureRing(size=8, snaplen=64)
+    sent = udpPacket(100, sport=1)
+    ring.record(CAPTURE_TUN_READ, 0, sent)
+    ring.record(CAPTURE_WS_SEND, 7, sent)
+    filename = str(tmp_path / "capture.pcapng")
+    assert ring.dump(filename) == 2
+    blocks = readPcapng(filename)
+    assert blocks[0][0] == PCAPNG_SECTION_HEADER
+    assert [each[0] for each in blocks[1:5]] == \
+        [PCAPNG_INTERFACE_DESCRIPTION] * len(CAPTURE_POINTS)
+    # without the packet info of TUN, cut to `snaplen`
+    assert readPackets(filename) == [
+        (CAPTURE_TUN_READ, sent[4:68], 100, None),
+        (CAPTURE_WS_SEND, sent[4:68], 100, "connection 7"),
+    ]
+
+def test_ring_keeps_last_packets(tmp_path):
+    ring = CaptureRing(size=4, snaplen=256)
+    sent = [udpPacket(60 + i, sport=i) for i in range(10)]
+    for each in sent: ring.record(CAPTURE_TUN_READ, 0, each)
+    filename = str(tmp_path / "capture.pcapng")
+    assert ring.dump(filename) == 4
+    assert [each[1] for each in readPackets(filename)] == \
+        [each[4:] for each in sent[-4:]]
+
+def test_dump_creates_private_new_file(tmp_path):
+    ring = CaptureRing(size=4, snaplen=64)
+    ring.record(CAPTURE_TUN_READ, 0, udpPacket(60))
+    filename = str(tmp_path / "capture.pcapng")
+    ring.dump(filename)
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o600
+    # never overwritten, nor followed if a link
+    with pytest.raises(FileExistsError): ring.dump(filename)
+    target = tmp_path / "target"
+    target.write_bytes(b"kept")
+    link = str(tmp_path / "link.pcapng")
+    os.symlink(str(target), link)
+    with pytest.raises(OSError): ring.dump(link)
+    assert target.read_bytes() == b"kept"
+
+def test_dump_to_directory(tmp_path):
+    ring = CaptureRing(size=4, snaplen=64, directory=str(tmp_path))
+    ring.record(CAPTURE_TUN_READ, 0, udpPacket(60))
+    ring.dumpToDirectory()
+    filenames = os.listdir(str(tmp_path))
+    assert len(filenames) == 1 and filenames[0].endswith(".pcapng")
+    assert len(readPackets(str(tmp_path / filenames[0]))) == 1
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+
+import pytest
+
+from sizzler.compress import Compressor, Decompressor, getCompressBound, \
+    COMPRESSED_TYPES, COMPRESS_SKIP_MIN
+from sizzler.metrics import SessionMetrics
+from sizzler.crypto.padding import RandomPadding
+from sizzler.transport._wssession import AGGREGATE_MAX, AGGREGATE_ITEM_HEAD, \
+    SEQUENCE_HEAD
+
+from packets import udpPacket
+
+
+def frame(packets):
+    # chunks of an aggregated frame with `packets`
+    chunks = [b"m-"]
+    for each in packets:
+        chunks.append(AGGREGATE_ITEM_HEAD.pack(len(each)))
+        chunks.append(each)
+    return chunks
+
+def compressible(sport=5000):
+    return udpPacket(1400, sport=sport)
+
+def incompressible(size, sport=443):
+    packet = udpPacket(size, sport=sport)
+    return packet[:32] + os.urandom(size + 4 - 32)
+
+def fullFrame(packet):
+    # as many `packet`s as fit in a frame, and a smaller one filling it up
+    packets, length = [], 2
+    while length + 2 + len(packet(1400)) <= AGGREGATE_MAX:
+        packets.append(packet(1400))
+        length += 2 + 1404
+    if AGGREGATE_MAX - length - 2 > 100:
+        packets.append(packet(AGGREGATE_MAX - length - 2 - 4))
+    return packets
+
+
+def test_zlib_stream_round_trip():
+    compressor = Compressor("zlib", 1, AGGREGATE_MAX, SessionMetrics())
+    decompressor = Decompressor(AGGREGATE_MAX + 2)
+    for i in range(5):
+        packets = [compressible(5000 + i)] * 4
+        chunks = frame(packets)
+        compressed = compressor.compress(packets, chunks)
+        assert compressed[:2] == COMPRESSED_TYPES["zlib"]
+        assert len(compressed) < sum(map(len, chunks)) // 4
+        assert decompressor.decompress(compressed[:2], compressed[2:]) == \
+            b"".join(chunks)
+
+def test_small_frames_not_compressed():
+    compressor = Compressor("zlib", 1, AGGREGATE_MAX, SessionMetrics())
+    packet = udpPacket(60)
+    assert compressor.compress([packet], [b"d-", packet]) is None
+
+def test_badly_compressing_flows_skipped():
+    metrics = SessionMetrics()
+    compressor = Compressor("zlib", 1, AGGREGATE_MAX, metrics)
+    packets = [incompressible(1400)]
+    compressor.compress(packets, frame(packets))
+    for i in range(COMPRESS_SKIP_MIN):
+        assert compressor.compress(packets, frame(packets)) is None
+    assert metrics.compressSkipped == COMPRESS_SKIP_MIN
+    # other flows are still compressed
+    packets = [compressible()] * 2
+    assert compressor.compress(packets, frame(packets))
+
+@pytest.mark.parametrize("algorithm", ["zlib", "lz4"])
+def test_full_incompressible_frame_fits(algorithm):
+    # compressed, a full frame must still fit with its sequence number, or
+    # be sent as is
+    if algorithm == "lz4": pytest.importorskip("lz4.block")
+    compressor = Compressor(algorithm, 1, AGGREGATE_MAX, SessionMetrics())
+    padder = RandomPadding(2048)
+    for i in range(3):
+        packets = fullFrame(incompressible)
+        chunks = frame(packets)
+        assert sum(map(len, chunks)) > AGGREGATE_MAX - 20
+        compressed = compressor.compress(packets, chunks)
+        if compressed:
+            assert len(compressed) <= AGGREGATE_MAX
+            chunks = [compressed]
+        padder.pad(b"s-" + SEQUENCE_HEAD.pack(i + 1), *chunks)
+
+def test_zlib_frame_within_bound():
+    # the zlib stream can't leave out a frame, so nothing it might not fit
+    # is given to it (new flows each time, as bad ones would be skipped)
+    compressor = Compressor("zlib", 1, AGGREGATE_MAX, SessionMetrics())
+    decompressor = Decompressor(AGGREGATE_MAX + 2)
+    for i in range(4):
+        packets = [incompressible(1400, 1000 + 46 * i + j) for j in range(46)]
+        chunks = frame(packets)
+        length = sum(map(len, chunks))
+        compressed = compressor.compress(packets, chunks)
+        assert len(compressed) <= 2 + getCompressBound("zlib", length)
+        assert decompressor.decompress(compressed[:2], compressed[2:]) == \
+            b"".join(chunks)
+
+def test_lz4_incompressible_sent_as_is():
+    pytest.importorskip("lz4.block")
+    compressor = Compressor("lz4", 1, AGGREGATE_MAX, SessionMetrics())
+    packets = [incompressible(1400, sport=1000 + j) for j in range(4)]
+    assert compressor.compress(packets, frame(packets)) is None
+
+def test_decompress_refuses_oversized():
+    compressor = Compressor("zlib", 1, AGGREGATE_MAX, SessionMetrics())
+    packets = [compressible()] * 4
+    compressed = compressor.compress(packets, frame(packets))
+    with pytest.raises(Exception):
+        Decompressor(1000).decompress(compressed[:2], compressed[2:])
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import asyncio
+
+from sizzler.packetqueue import PacketQueue
+from sizzler.transport._datagram import DatagramConnection, \
+    DatagramProtocol, DatagramConnector, getDatagramSessionOptions, \
+    UDP_ID_SIZE, UDP_PENDING_MAX
+from sizzler.transport._wssession import WebsocketSession
+from sizzler.transport.udpserver import DatagramServer
+
+KEY = "test"
+HOME, AWAY = ("192.0.2.1", 4000), ("198.51.100.7", 5000)
+
+
+class Transport:
+
+    # stands for the transport of a datagram endpoint
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address=None):
+        self.sent.append((data, address))
+
+
+def test_connection_follows_only_confirmed_address():
+    async def main():
+        transport = Transport()
+        connection = DatagramConnection(transport, HOME, os.urandom(16))
+        connection.received(b"forged", AWAY)
+        # not confirmed by the session (as it didn't decrypt), stays
+        assert await connection.recv() == b"forged"
+        await connection.send(b"reply")
+        assert transport.sent[-1] == (connection.connectionID + b"reply", HOME)
+        # confirmed, the next datagrams go there
+        connection.received(b"genuine", AWAY)
+        assert await connection.recv() == b"genuine"
+        connection.confirm()
+        await connection.send(b"reply")
+        assert transport.sent[-1][1] == AWAY
+    asyncio.run(main())
+
+def test_connection_of_client_never_moves():
+    async def main():
+        connection = DatagramConnection(Transport(), None, os.urandom(16))
+        connection.received(b"data", AWAY)
+        await connection.recv()
+        connection.confirm()
+        assert connection.remote_address is None
+    asyncio.run(main())
+
+def test_inbox_limit():
+    async def main():
+        connection = DatagramConnection(
+            Transport(), HOME, os.urandom(16), inboxMax=2)
+        for i in range(5): connection.received(b"%d" % i, HOME)
+        assert [await connection.recv() for i in range(2)] == [b"0", b"1"]
+        connection.close("gone")
+        try:
+            await connection.recv()
+            assert False
+        except Exception as e:
+            assert str(e) == "gone"
+    asyncio.run(main())
+
+def test_protocol_dispatches_by_id():
+    accepted = []
+    def accept(connectionID, address):
+        connection = DatagramConnection(
+            Transport(), address, connectionID, onClose=protocol.unregister)
+        protocol.register(connection)
+        accepted.append(connection)
+        return connection
+    protocol = DatagramProtocol(accept=accept)
+    first, second = os.urandom(UDP_ID_SIZE), os.urandom(UDP_ID_SIZE)
+    protocol.datagram_received(first + b"a", HOME)
+    protocol.datagram_received(first + b"b", AWAY)
+    protocol.datagram_received(second + b"c", HOME)
+    protocol.datagram_received(os.urandom(UDP_ID_SIZE), HOME)  # empty
+    assert [len(each.inbox) for each in accepted] == [2, 1]
+    accepted[0].close()
+    assert list(protocol.connections) == [second]
+
+def test_session_options_fit_path():
+    options = getDatagramSessionOptions({
+        "compression": "zlib",
+        "aggregateBytes": 60000,
+        "paddingTarget": 1400,
+    })
+    assert options["compression"] == "none"
+    assert options["aggregateBytes"] == 1400 - 50
+    assert getDatagramSessionOptions({"aggregateBytes": 500}) \
+        ["aggregateBytes"] == 500
+
+
+def startServer(port):
+    server = DatagramServer(host="127.0.0.1", port=port, key=KEY,
+        sessionOptions={"cryptoStrategy": "inline"})
+    server.toWSQueue, server.fromWSQueue = PacketQueue(), PacketQueue()
+    return server
+
+def freePort():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_server_ignores_junk():
+    async def main():
+        port = freePort()
+        server = startServer(port)
+        await server
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(2000):
+            sock.sendto(os.urandom(200), ("127.0.0.1", port))
+            if i % 100 == 0: await asyncio.sleep(0.001)
+        await asyncio.sleep(0.2)
+        sock.close()
+        server.protocol.transport.close()
+        return server
+    server = asyncio.run(main())
+    assert server.connections == 0
+    assert not server.protocol.connections and not server.pending
+
+def test_server_caps_pending():
+    async def main():
+        server = startServer(freePort())
+        await server
+        accept = server._DatagramServer__accept
+        connections = [
+            accept(os.urandom(UDP_ID_SIZE), HOME)
+            for i in range(UDP_PENDING_MAX + 10)
+        ]
+        server.protocol.transport.close()
+        return connections
+    connections = asyncio.run(main())
+    assert connections[UDP_PENDING_MAX - 1] is not None
+    assert connections[UDP_PENDING_MAX:] == [None] * 10
+
+def test_server_accepts_client():
+    async def main():
+        port = freePort()
+        server = startServer(port)
+        await server
+        async with DatagramConnector("udp://127.0.0.1:%d" % port) as client:
+            session = WebsocketSession(
+                websocket=client,
+                path=client.path,
+                key=KEY,
+                fromWSQueue=asyncio.Queue(),
+                toWSQueue=PacketQueue(),
+                cryptoStrategy="inline",
+                heartbeatInterval=0.05
+            )
+            task = asyncio.ensure_future(session)
+            await asyncio.sleep(0.3)
+            accepted = server.protocol.connections[client.connectionID]
+            address = accepted.remote_address
+            # someone else knowing the ID doesn't take the session along
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            for i in range(10):
+                sock.sendto(
+                    client.connectionID + os.urandom(200), ("127.0.0.1", port))
+            await asyncio.sleep(0.2)
+            sock.close()
+            task.cancel()
+        server.protocol.transport.close()
+        assert server.connections == 1 and session.peerAuthenticated
+        assert accepted.remote_address == address
+    asyncio.run(main())
+
+def test_server_refuses_replayed_connection():
+    # datagrams of an ended connection, replayed from elsewhere, don't set
+    # it up again
+    async def main():
+        port = freePort()
+        server = startServer(port)
+        await server
+        sent = []
+        async with DatagramConnector("udp://127.0.0.1:%d" % port) as client:
+            send = client.send
+            async def recording(data):
+                sent.append(data)
+                await send(data)
+            client.send = recording
+            session = WebsocketSession(
+                websocket=client,
+                path=client.path,
+                key=KEY,
+                fromWSQueue=asyncio.Queue(),
+                toWSQueue=PacketQueue(),
+                cryptoStrategy="inline",
+                heartbeatInterval=0.05
+            )
+            task = asyncio.ensure_future(session)
+            await asyncio.sleep(0.3)
+            task.cancel()
+        server.protocol.connections[client.connectionID].close("Ended.")
+        await asyncio.sleep(0.1)
+        assert server.connections == 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for data in sent:
+            sock.sendto(client.connectionID + data, ("127.0.0.1", port))
+        await asyncio.sleep(0.3)
+        sock.close()
+        server.protocol.transport.close()
+        assert len(sent) > 1
+        assert server.connections == 0 and not server.pending
+        assert client.connectionID not in server.protocol.connections
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from sizzler.metrics import MetricsRegistry
+from sizzler.packetqueue import PacketQueue
+
+
+class Session:
+
+    # stands for a WebsocketSession, as far as metrics look at it
+
+    def __init__(self, wsid, rtt=None):
+        self.wsid = wsid
+        self.rtt = rtt
+        self.jitter = rtt / 2 if rtt is not None else None
+        self.toWSQueue = PacketQueue()
+
+
+def families(text):
+    # metric name -> (help, type, samples), checking that each family is
+    # one block, HELP and TYPE first
+    result, current = {}, None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            current = line.split(" ")[2]
+            assert current not in result
+            result[current] = [line, None, []]
+        elif line.startswith("# TYPE "):
+            assert line.split(" ")[2] == current
+            result[current][1] = line.split(" ")[3]
+        else:
+            name = line.split("{")[0].split(" ")[0]
+            if name != current:
+                # histograms have samples named _bucket, _sum and _count
+                assert result[current][1] == "histogram"
+                assert name.rsplit("_", 1)[0] == current
+            result[current][2].append(line)
+    return result
+
+
+def test_render_families_in_blocks():
+    registry = MetricsRegistry()
+    sessions = [Session(1, 0.02), Session(2)]
+    for session in sessions:
+        metrics = registry.addSession(session)
+        metrics.framesIn += session.wsid
+    registry.addQueue("toTUN", PacketQueue())
+    registry.reconnects = 3
+    result = families(registry.render())
+    assert result["sizzler_frames_in_total"][2] == [
+        "sizzler_frames_in_total 3"]
+    assert result["sizzler_session_frames_in_total"][1] == "counter"
+    assert result["sizzler_session_frames_in_total"][2] == [
+        'sizzler_session_frames_in_total{session="1"} 1',
+        'sizzler_session_frames_in_total{session="2"} 2',
+    ]
+    assert result["sizzler_session_rtt_seconds"][2] == [
+        'sizzler_session_rtt_seconds{session="1"} 0.020000']
+    assert len(result["sizzler_session_queue_depth"][2]) == 2
+    assert result["sizzler_reconnects_total"][2] == [
+        "sizzler_reconnects_total 3"]
+    assert result["sizzler_queue_dropped_total"][2] == [
+        'sizzler_queue_dropped_total{queue="toTUN"} 0']
+    assert all([each[1] for each in result.values()])
+
+def test_render_keeps_closed_sessions_in_totals():
+    registry = MetricsRegistry()
+    session = Session(1)
+    registry.addSession(session).packetsOut += 5
+    registry.removeSession(session)
+    result = families(registry.render())
+    assert result["sizzler_packets_out_total"][2] == [
+        "sizzler_packets_out_total 5"]
+    assert result["sizzler_session_packets_out_total"][2] == []
+    assert result["sizzler_sessions"][2] == ["sizzler_sessions 0"]
+    assert result["sizzler_sessions_opened_total"][2] == [
+        "sizzler_sessions_opened_total 1"]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import struct
+
+from sizzler.packet import VNET_HEADER, PACKET_INFO_SIZE
+from sizzler.offload import removeVnetHeader, addVnetHeader, \
+    splitVnetPacket, onesComplementSum, VIRTIO_NET_HDR_F_NEEDS_CSUM, \
+    VIRTIO_NET_HDR_GSO_NONE, VIRTIO_NET_HDR_GSO_TCPV4, \
+    VIRTIO_NET_HDR_GSO_TCPV6
+
+from packets import tcpPacket, tcpChecksum
+
+PAYLOAD = bytes([i % 251 for i in range(5000)])
+
+
+def superPacket(version=4, payload=PAYLOAD, gsoSize=1400, flags=0x18):
+    # a TCP super-packet as read from a TUN device with offloading, with
+    # its checksum left partial
+    packet = bytearray(tcpPacket(
+        version=version, flags=flags, sequence=0xFFFFF000, payload=payload))
+    ip = packet[PACKET_INFO_SIZE:]
+    start = 20 if version == 4 else 40
+    if version == 4:
+        pseudo = bytes(ip[12:20]) + struct.pack("!BBH", 0, 6, len(ip) - start)
+    else:
+        pseudo = bytes(ip[8:40]) + struct.pack("!I3xB", len(ip) - start, 6)
+    struct.pack_into("!H", ip, start + 16, onesComplementSum(pseudo))
+    header = VNET_HEADER.pack(
+        VIRTIO_NET_HDR_F_NEEDS_CSUM,
+        VIRTIO_NET_HDR_GSO_TCPV4 if version == 4 else VIRTIO_NET_HDR_GSO_TCPV6,
+        start + 20,
+        gsoSize,
+        start,
+        16
+    )
+    return bytes(packet[:PACKET_INFO_SIZE]) + header + bytes(ip)
+
+def checkSegments(segments, version=4, gsoSize=1400, flags=0x18):
+    start = 20 if version == 4 else 40
+    payload = b""
+    for i, segment in enumerate(segments):
+        ip = segment[PACKET_INFO_SIZE:]
+        last = i == len(segments) - 1
+        assert len(ip) - start - 20 == (
+            len(PAYLOAD) - gsoSize * i if last else gsoSize)
+        if version == 4:
+            assert struct.unpack_from("!H", ip, 2)[0] == len(ip)
+            assert onesComplementSum(ip[:20]) == 0xFFFF
+        else:
+            assert struct.unpack_from("!H", ip, 4)[0] == len(ip) - 40
+        sequence, = struct.unpack_from("!I", ip, start + 4)
+        assert sequence == (0xFFFFF000 + gsoSize * i) & 0xFFFFFFFF
+        # FIN and PSH only on the last one
+        assert ip[start + 13] == (flags if last else flags & ~0x09)
+        assert struct.unpack_from("!H", ip, start + 16)[0] == \
+            tcpChecksum(ip)
+        payload += bytes(ip[start+20:])
+    assert payload == PAYLOAD
+
+
+def test_segmentation_ipv4():
+    segments = removeVnetHeader(superPacket())
+    assert len(segments) == 4
+    checkSegments(segments)
+
+def test_segmentation_ipv6():
+    segments = removeVnetHeader(superPacket(version=6, gsoSize=1000))
+    assert len(segments) == 5
+    checkSegments(segments, version=6, gsoSize=1000)
+
+def test_fin_only_on_last_segment():
+    segments = removeVnetHeader(superPacket(flags=0x19))
+    checkSegments(segments, flags=0x19)
+
+def test_split_keeps_segments():
+    # split into smaller super-packets, segmenting those gives the same
+    packet = superPacket()
+    pieces = splitVnetPacket(packet, 3000)
+    assert len(pieces) > 1
+    assert all([len(each) <= 3000 for each in pieces])
+    segments = []
+    for each in pieces: segments.extend(removeVnetHeader(each))
+    assert segments == removeVnetHeader(packet)
+
+def test_split_small_packet_unchanged():
+    packet = superPacket(payload=PAYLOAD[:1000])
+    assert splitVnetPacket(packet, 3000) == [packet]
+
+def test_complete_checksum():
+    packet = superPacket(payload=PAYLOAD[:1000])
+    header = bytearray(packet[PACKET_INFO_SIZE:PACKET_INFO_SIZE+10])
+    header[1] = VIRTIO_NET_HDR_GSO_NONE
+    packet = packet[:PACKET_INFO_SIZE] + bytes(header) + \
+        packet[PACKET_INFO_SIZE+10:]
+    completed, = removeVnetHeader(packet)
+    ip = completed[PACKET_INFO_SIZE:]
+    assert struct.unpack_from("!H", ip, 36)[0] == tcpChecksum(ip)
+
+def test_header_round_trip():
+    packet = tcpPacket(100)
+    assert removeVnetHeader(addVnetHeader(packet)) == [packet]
+
+def test_malformed():
+    assert removeVnetHeader(b"\x00" * 20) == []
+    packet = bytearray(superPacket())
+    struct.pack_into("<H", packet, PACKET_INFO_SIZE + 4, 0)     # gso size
+    assert removeVnetHeader(bytes(packet)) == []
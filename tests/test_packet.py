@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import struct
+
+import pytest
+
+from sizzler.packet import clampMSS, getFlowKey, getPriority, isTcpControl, \
+    PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK
+
+from packets import tcpPacket, udpPacket, tcpChecksum
+
+
+def mss(value):
+    return struct.pack("!BBH", 2, 4, value)
+
+def tcpStart(packet):
+    return 4 + (20 if packet[4] >> 4 == 4 else 40)
+
+def getMSS(packet, offset):
+    return struct.unpack_from("!H", packet, tcpStart(packet) + 20 + offset)[0]
+
+def checksumOf(packet):
+    return struct.unpack_from("!H", packet, tcpStart(packet) + 16)[0]
+
+
+@pytest.mark.parametrize("version", [4, 6])
+@pytest.mark.parametrize("options, offset", [
+    (mss(1460), 2),                                 # aligned
+    (b"\x01" + mss(1460) + b"\x01\x01\x01", 3),     # not aligned
+    (b"\x01\x01" + mss(65495) + b"\x01\x01", 4),    # checksum carries
+    (b"\x01\x01\x01\x01\x04\x02" + mss(8960) + b"\x00\x00", 8),
+])
+def test_clamp_mss_checksum(version, options, offset):
+    for payload in [b"", b"\xff\xfe\x00"]:
+        packet = tcpPacket(
+            version=version, flags=0x02, options=options, payload=payload)
+        clamped = clampMSS(packet, 1400)
+        assert getMSS(clamped, offset) == (1360 if version == 4 else 1340)
+        # incremental update equals a full recomputation
+        assert checksumOf(clamped) == tcpChecksum(clamped[4:])
+        assert len(clamped) == len(packet)
+
+def test_clamp_mss_leaves_others():
+    # no SYN, MSS small enough already, no MSS option, other protocols
+    for packet in [
+        tcpPacket(flags=0x10, options=mss(1460)),
+        tcpPacket(flags=0x02, options=mss(1200)),
+        tcpPacket(flags=0x02, options=b"\x01\x01\x01\x00"),
+        udpPacket(100),
+    ]:
+        assert clampMSS(packet, 1400) is packet
+
+def test_clamp_mss_malformed_options():
+    # an option claiming a length below 2 must not loop forever
+    packet = tcpPacket(flags=0x02, options=b"\x05\x00\x00\x00")
+    assert clampMSS(packet, 1400) is packet
+    truncated = tcpPacket(flags=0x02, options=mss(1460))[:-2]
+    assert clampMSS(truncated, 1400) is truncated
+
+
+def test_flow_key():
+    a = udpPacket(100, sport=1)
+    assert getFlowKey(a) == getFlowKey(udpPacket(500, sport=1))
+    assert getFlowKey(a) != getFlowKey(udpPacket(100, sport=2))
+    assert getFlowKey(b"\x00" * 10) is None
+
+def test_priority():
+    assert getPriority(udpPacket(100)) == PRIORITY_INTERACTIVE
+    assert getPriority(udpPacket(1000)) == PRIORITY_NORMAL
+    assert getPriority(udpPacket(1000, dscp=46)) == PRIORITY_INTERACTIVE
+    assert getPriority(udpPacket(100, dscp=8)) == PRIORITY_BULK
+    assert getPriority(
+        udpPacket(1000, dport=873), bulkPorts=[873]) == PRIORITY_BULK
+    # TCP by what all segments of a connection share only
+    for flags in [0x02, 0x10, 0x01, 0x04]:
+        assert getPriority(tcpPacket(flags=flags)) == PRIORITY_NORMAL
+    assert getPriority(
+        tcpPacket(1400, dport=22), interactivePorts=[22]
+    ) == PRIORITY_INTERACTIVE
+
+def test_tcp_control():
+    assert isTcpControl(tcpPacket(flags=0x02))
+    assert isTcpControl(tcpPacket(flags=0x12))
+    assert isTcpControl(tcpPacket(flags=0x11))
+    assert isTcpControl(tcpPacket(flags=0x10))
+    assert isTcpControl(tcpPacket(version=6))
+    assert not isTcpControl(tcpPacket(flags=0x04))
+    assert not isTcpControl(tcpPacket(flags=0x18))     # PSH
+    assert not isTcpControl(tcpPacket(100))
+    assert not isTcpControl(tcpPacket(100, flags=0x11))
+    assert not isTcpControl(udpPacket(40))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+
+import pytest
+
+from sizzler.packetqueue import PacketQueue, PriorityPacketQueue, \
+    FairPacketQueue
+from sizzler.packet import PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+
+from packets import udpPacket, tcpPacket
+
+
+def packet(number, size=100):
+    # distinguishable packets of `size` bytes
+    return number.to_bytes(4, "big") + bytes(size - 4)
+
+def drain(queue):
+    packets = []
+    while True:
+        try:
+            packets.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return packets
+
+
+def test_taildrop_drops_incoming():
+    queue = PacketQueue(maxPackets=3)
+    results = [queue.put_nowait(packet(i)) for i in range(5)]
+    assert results == [True, True, True, False, False]
+    assert drain(queue) == [packet(i) for i in range(3)]
+    assert queue.stats()["dropped"] == 2
+
+def test_headdrop_drops_oldest():
+    queue = PacketQueue(maxPackets=3, policy="headdrop")
+    assert all([queue.put_nowait(packet(i)) for i in range(5)])
+    assert drain(queue) == [packet(i) for i in range(2, 5)]
+    assert queue.stats()["dropped"] == 2
+
+def test_byte_limit():
+    queue = PacketQueue(maxBytes=250, policy="headdrop")
+    for i in range(3): queue.put_nowait(packet(i))
+    assert queue.bytes <= 250
+    assert drain(queue) == [packet(1), packet(2)]
+    # a packet larger than the whole limit is never queued
+    assert not queue.put_nowait(packet(9, 300))
+
+def test_codel_drops_standing_queue():
+    queue = PacketQueue(policy="codel", target=0.001, interval=0.01)
+    for i in range(200): queue.put_nowait(packet(i, 1000))
+    time.sleep(0.005)
+    first = queue.get_nowait()          # above target, starts the interval
+    time.sleep(0.02)
+    rest = drain(queue)
+    assert queue.stats()["dropped"] > 0
+    assert 1 + len(rest) + queue.stats()["dropped"] == 200
+    # what gets through is still in order
+    numbers = [int.from_bytes(each[:4], "big") for each in [first] + rest]
+    assert numbers == sorted(numbers)
+
+def test_codel_keeps_short_queue():
+    queue = PacketQueue(policy="codel", target=0.001, interval=0.01)
+    queue.put_nowait(packet(1, 1000))
+    time.sleep(0.03)
+    assert queue.get_nowait() == packet(1, 1000)
+    assert queue.stats()["dropped"] == 0
+
+def test_empty_queue_raises():
+    for policy in ["taildrop", "headdrop", "codel"]:
+        with pytest.raises(asyncio.QueueEmpty):
+            PacketQueue(policy=policy).get_nowait()
+
+def test_get_waits_for_put():
+    async def main():
+        queue = PacketQueue()
+        getter = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.put_nowait(packet(1))
+        return await asyncio.wait_for(getter, 1)
+    assert asyncio.run(main()) == packet(1)
+
+
+def test_priority_lanes():
+    queue = PriorityPacketQueue(interactivePorts=[22])
+    bulk = tcpPacket(1000, dport=80)
+    ssh = tcpPacket(100, dport=22)
+    queue.put_nowait(bulk)
+    queue.put_nowait(ssh)
+    assert drain(queue) == [ssh, bulk]
+
+def test_priority_keeps_tcp_flow_in_one_lane():
+    # data segments of one connection are never reordered, whatever their
+    # size; only those without payload go ahead
+    queue = PriorityPacketQueue()
+    syn, fin = tcpPacket(flags=0x02), tcpPacket(flags=0x11)
+    data = [
+        tcpPacket(1400, sequence=1),
+        tcpPacket(60, sequence=1401, flags=0x18),
+        tcpPacket(1400, sequence=1421),
+    ]
+    acks = [tcpPacket(sequence=2821), tcpPacket(sequence=2821)]
+    queue.put_nowait(syn)
+    queue.put_nowait(data[0])
+    queue.put_nowait(acks[0])
+    queue.put_nowait(data[1])
+    queue.put_nowait(data[2])
+    queue.put_nowait(acks[1])
+    queue.put_nowait(fin)
+    assert [len(lane.items) for lane in queue.lanes] == [4, 3, 0]
+    assert drain(queue) == [syn, acks[0], acks[1], fin] + data
+
+def test_priority_tcp_control_leaves_flow_lane():
+    # a SYN first doesn't make its connection interactive
+    queue = PriorityPacketQueue()
+    queue.put_nowait(tcpPacket(flags=0x02))
+    queue.put_nowait(tcpPacket(100, flags=0x18))
+    assert [len(lane.items) for lane in queue.lanes] == [1, 1, 0]
+
+def test_priority_pins_flow_to_first_lane():
+    queue = PriorityPacketQueue(small=128)
+    small, large = udpPacket(100), udpPacket(1000)
+    queue.put_nowait(small)
+    queue.put_nowait(large)
+    assert len(queue.lanes[PRIORITY_INTERACTIVE].items) == 2
+    # another flow is classified on its own
+    queue.put_nowait(udpPacket(1000, sport=5001))
+    assert len(queue.lanes[PRIORITY_NORMAL].items) == 1
+
+
+def test_fair_queue_shares_equally():
+    # a client with large packets gets no more bytes than one with small
+    queue = FairPacketQueue()
+    large, small = queue.lane("a"), queue.lane("b")
+    for i in range(100):
+        large.put_nowait(packet(i, 1500))
+    for i in range(300):
+        small.put_nowait(packet(i, 500))
+    sent = {1500: 0, 500: 0}
+    for i in range(120):
+        each = queue.get_nowait()
+        sent[len(each)] += len(each)
+    assert abs(sent[1500] - sent[500]) <= 1500
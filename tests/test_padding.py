@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import time
+
+from sizzler.crypto.padding import NonceManagement, RandomPadding, \
+    NONCES_RESOLUTION, ACCEPT_FIRST_NONCE_AFTER, PADDING_TOTAL_OVERHEAD, \
+    PADDING_NUMBERS
+
+
+def now():
+    return int(time.time() * NONCES_RESOLUTION)
+
+
+def test_nonce_replay_refused():
+    nonces = NonceManagement()
+    first = now()
+    assert nonces.verify(first)
+    assert not nonces.verify(first)
+    assert nonces.verify(first + 1)
+    assert not nonces.verify(first + 1)
+
+def test_nonce_out_of_order_within_window():
+    nonces = NonceManagement(window=64)
+    base = now()
+    assert nonces.verify(base + 10)
+    assert nonces.verify(base + 5)
+    assert nonces.verify(base + 7)
+    assert not nonces.verify(base + 5)
+    assert nonces.verify(base + 11)
+
+def test_nonce_window_edges():
+    nonces = NonceManagement(window=64)
+    base = now()
+    assert nonces.verify(base)
+    newest = base + 100
+    assert nonces.verify(newest)
+    # the oldest 8 nonces of the window are refused, those above accepted
+    assert not nonces.verify(newest - 64 + 8)
+    assert nonces.verify(newest - 64 + 9)
+    assert not nonces.verify(newest - 64 + 9)
+    assert not nonces.verify(base)
+
+def test_nonce_window_wraps_around():
+    # the bitmap is a ring: sliding over its end must clear the bits of
+    # nonces now out of the window, and keep those still in it
+    nonces = NonceManagement(window=64)
+    base = now() // 64 * 64 + 60        # close to the end of the ring
+    assert nonces.verify(base)
+    for step in [2, 3, 4, 5, 7, 9, 20, 40]:
+        assert nonces.verify(base + step)
+    for step in [2, 3, 4, 5, 7, 9, 20, 40]:
+        assert not nonces.verify(base + step)
+    # nonces in the window never seen before, on both sides of the end
+    for step in [1, 6, 8, 10, 19, 21, 39]:
+        assert nonces.verify(base + step)
+    # once around the ring, the same bits stand for new nonces
+    for step in range(41, 200):
+        assert nonces.verify(base + step)
+
+def test_nonce_jump_beyond_window():
+    nonces = NonceManagement(window=64)
+    base = now()
+    for i in range(50): assert nonces.verify(base + i)
+    far = base + 1000
+    assert nonces.verify(far)
+    for i in range(1, 40): assert nonces.verify(far - i)
+    assert not nonces.verify(base + 10)
+
+def test_first_nonce_too_old():
+    nonces = NonceManagement()
+    oldest = now() - int(ACCEPT_FIRST_NONCE_AFTER)
+    assert not nonces.verify(oldest - 10**6)
+    assert nonces.verify(oldest + 10**6)
+
+def test_issued_nonces_increase():
+    nonces = NonceManagement()
+    issued = [nonces.new() for i in range(1000)]
+    assert issued == sorted(set(issued))
+
+def test_verify_leaves_issued_nonces():
+    nonces = NonceManagement()
+    issued = nonces.new()
+    assert nonces.verify(now() + 10**9)
+    assert not nonces.verify(now() - 10**9)
+    assert nonces.last == issued
+
+def test_refused_nonces_logged_rarely(caplog):
+    nonces = NonceManagement()
+    nonce = now()
+    nonces.verify(nonce)
+    for i in range(1000): assert not nonces.verify(nonce)
+    assert len(caplog.records) == 1
+    assert nonces.failures == 999
+
+
+def test_pad_unpad():
+    sender, receiver = RandomPadding(2048), RandomPadding(2048)
+    for size in [0, 1, 100, 1500, 3000]:
+        data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        padded = sender.pad(b"d-", data)
+        assert len(padded) <= max(
+            2048 - 40, PADDING_TOTAL_OVERHEAD - 40 + 2 + size)
+        assert bytes(receiver.unpad(padded)) == b"d-" + data
+    # replayed
+    assert receiver.unpad(padded) is None
+
+def test_bucket_padding():
+    padder = RandomPadding(2048, policy="bucket", buckets=[128, 512])
+    sizes = set([len(padder.pad(bytes(n))) + 40 for n in range(0, 400, 7)])
+    assert sizes == set([128, 512])
+
+def test_random_padding_lengths_differ():
+    # lengths don't repeat in a cycle, and differ between padders
+    first, second = RandomPadding(2048), RandomPadding(2048)
+    count = 3 * PADDING_NUMBERS
+    lengths = [len(first.pad(b"x")) for i in range(count)]
+    others = [len(second.pad(b"x")) for i in range(count)]
+    assert lengths[:PADDING_NUMBERS] != lengths[PADDING_NUMBERS:2*count//3]
+    assert lengths != others
+    assert len(set(lengths)) > count // 4
+    assert min(lengths) >= PADDING_TOTAL_OVERHEAD - 40 + 1
+    assert max(lengths) <= 2048 - 40
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import time
+
+from sizzler.transport import _resume
+from sizzler.transport._resume import ResumeState, ResumeStore
+
+
+class Session:
+
+    # stands for a WebsocketSession, as far as the store knows it
+    wsid = 0
+
+    def __init__(self):
+        Session.wsid += 1
+        self.wsid = Session.wsid
+
+
+def test_record_acknowledge_resend():
+    state = ResumeState("ab" * 16, 100)
+    sequences = [state.record([b"packet %d" % i]) for i in range(10)]
+    assert sequences == list(range(1, 11))
+    state.acknowledge(4)
+    # frames 5-10 would be sent again on a new connection
+    assert [each[0] for each in state.unacknowledged] == list(range(5, 11))
+    state.acknowledge(4)
+    state.acknowledge(3)
+    assert len(state.unacknowledged) == 6
+    state.acknowledge(10)
+    assert not state.unacknowledged
+
+def test_oldest_frames_given_up():
+    state = ResumeState("ab" * 16, 3)
+    for i in range(5): state.record([b"%d" % i])
+    assert [each[0] for each in state.unacknowledged] == [3, 4, 5]
+
+def test_accept_drops_resent():
+    state = ResumeState("ab" * 16, 100)
+    assert [state.accept(i) for i in [1, 2, 3]] == [True] * 3
+    # resent after a reconnect, received already
+    assert [state.accept(i) for i in [2, 3]] == [False] * 2
+    assert state.accept(4)
+    assert state.received == 4
+
+def test_cycle_between_peers():
+    # frames lost with a broken connection are sent again, and only the
+    # ones not received yet are accepted
+    sender, receiver = ResumeState("ab" * 16, 100), ResumeState("ab" * 16, 100)
+    sender.meet(receiver.epoch)
+    receiver.meet(sender.epoch)
+    delivered = []
+    for i in range(10):
+        sequence = sender.record([b"%d" % i])
+        if i < 6 and receiver.accept(sequence): delivered.append(sequence)
+    sender.acknowledge(receiver.received - 2)   # an ack lagging behind
+    for sequence, packets in list(sender.unacknowledged):
+        if receiver.accept(sequence): delivered.append(sequence)
+    sender.acknowledge(receiver.received)
+    assert delivered == list(range(1, 11))
+    assert not sender.unacknowledged
+
+def test_peer_restart_resets_state():
+    client, server = ResumeState("ab" * 16, 100), ResumeState("ab" * 16, 100)
+    client.meet(server.epoch)
+    for i in range(50):
+        assert client.accept(server.record([b"%d" % i]))
+    for i in range(5): client.record([b"%d" % i])
+
+    # the server restarts: a new state counting from scratch, which gets
+    # an acknowledgement meant for its predecessor
+    restarted = ResumeState("ab" * 16, 100)
+    sent = [restarted.record([b"new %d" % i]) for i in range(3)]
+    restarted.acknowledge(client.received)
+    assert len(restarted.unacknowledged) == 3
+
+    # the client learns of the new epoch and takes the new frames
+    client.meet(restarted.epoch)
+    assert client.received == 0
+    assert not client.unacknowledged
+    assert [client.accept(each) for each in sent] == [True] * 3
+
+    # the same epoch again changes nothing
+    client.meet(restarted.epoch)
+    assert client.received == 3
+
+
+def test_store_binds_and_takes_over():
+    store = ResumeStore(100)
+    first, second = Session(), Session()
+    state = store.bind("ab" * 16, first)
+    assert state.owner is first
+    assert store.bind("ab" * 16, second) is state
+    assert state.owner is second
+    # the former owner going away doesn't release the state
+    store.release(state, first)
+    assert state.owner is second
+    store.release(state, second)
+    assert state.owner is None
+    assert store.bind("ab" * 16, first) is state
+
+def test_store_forgets_old_states(monkeypatch):
+    store = ResumeStore(100)
+    session = Session()
+    state = store.bind("ab" * 16, session)
+    store.release(state, session)
+    later = time.time() + _resume.RESUME_TIMEOUT + 1
+    monkeypatch.setattr(_resume.time, "time", lambda: later)
+    assert store.bind("cd" * 16, session) is not state
+    assert "ab" * 16 not in store.states
+
+def test_store_resumable_until_timeout(monkeypatch):
+    # without any other client binding a state, expired ones are forgotten
+    store = ResumeStore(100)
+    session = Session()
+    store.release(store.bind("ab" * 16, session), session)
+    assert store.isResumable()
+    later = time.time() + _resume.RESUME_TIMEOUT + 1
+    monkeypatch.setattr(_resume.time, "time", lambda: later)
+    assert not store.isResumable()
+    assert not store.states
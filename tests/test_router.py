@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import socket
+import asyncio
+
+import pytest
+
+from sizzler.packetqueue import PacketQueue
+from sizzler.transport.router import PacketRouter, parsePrefix
+
+from packets import udpPacket, ipv6Packet
+
+
+class TUN:
+
+    # stands for a SizzlerVirtualNetworkInterface, as far as routers use it
+
+    def __init__(self):
+        self.ip = "10.1.0.1"
+        self.netmask = "255.255.255.0"
+        self.toWSQueue = PacketQueue()
+
+    def createQueue(self):
+        return PacketQueue()
+
+
+class Session:
+
+    wsid = 0
+
+    def __init__(self, client):
+        Session.wsid += 1
+        self.wsid = Session.wsid
+        self.client = client
+        self.rtt = None
+
+
+def route(router, packet):
+    asyncio.run(router.dispatch(packet))
+
+def queued(router, session):
+    return router.queues[session].qsize()
+
+
+def test_shared_queue_without_sessions():
+    tun = TUN()
+    router = PacketRouter(tun)
+    route(router, udpPacket(100, dst="10.1.0.2"))
+    assert tun.toWSQueue.qsize() == 1
+    # taken over by the first session
+    session = Session("192.0.2.1")
+    router.register(session)
+    assert queued(router, session) == 1
+    assert tun.toWSQueue.qsize() == 0
+
+def test_learn_and_route():
+    router = PacketRouter(TUN())
+    alice, bob = Session("192.0.2.1"), Session("192.0.2.2")
+    router.register(alice)
+    router.register(bob)
+    router.learn(alice, udpPacket(100, src="10.1.0.2"))
+    router.learn(bob, udpPacket(100, src="10.1.0.3"))
+    for i in range(5): route(router, udpPacket(100, dst="10.1.0.2"))
+    route(router, udpPacket(100, dst="10.1.0.3"))
+    assert (queued(router, alice), queued(router, bob)) == (5, 1)
+
+def test_learn_only_within_subnet():
+    router = PacketRouter(TUN())
+    alice = Session("192.0.2.1")
+    router.register(alice)
+    router.learn(alice, udpPacket(100, src="10.1.1.2"))
+    router.learn(alice, udpPacket(100, src="8.8.8.8"))
+    assert not router.addresses
+    router.learn(alice, udpPacket(100, src="10.1.0.9"))
+    assert list(router.addresses) == [socket.inet_aton("10.1.0.9")]
+
+def test_newer_claim_takes_address_over():
+    router = PacketRouter(TUN())
+    alice, mallory = Session("192.0.2.1"), Session("192.0.2.66")
+    router.register(alice)
+    router.register(mallory)
+    router.learn(alice, udpPacket(100, src="10.1.0.2"))
+    router.learn(mallory, udpPacket(100, src="10.1.0.2"))
+    assert router.addresses[socket.inet_aton("10.1.0.2")] == [mallory]
+    # several sessions of one client share an address
+    second = Session("192.0.2.66")
+    router.register(second)
+    router.learn(second, udpPacket(100, src="10.1.0.2"))
+    assert router.addresses[socket.inet_aton("10.1.0.2")] == [mallory, second]
+
+def test_unknown_destination():
+    router = PacketRouter(TUN())
+    alice = Session("192.0.2.1")
+    router.register(alice)
+    # with a single client, it may get anything
+    route(router, udpPacket(100, dst="10.1.0.77"))
+    assert queued(router, alice) == 1
+    # with several, nobody gets what's not known to be theirs
+    bob = Session("192.0.2.2")
+    router.register(bob)
+    route(router, udpPacket(100, dst="10.1.0.77"))
+    assert (queued(router, alice), queued(router, bob)) == (1, 0)
+    # nor once alone again, as it may be bob's, not heard from yet; but
+    # what's beyond the subnet is still alice's
+    router.unregister(bob)
+    route(router, udpPacket(100, dst="10.1.0.77"))
+    assert queued(router, alice) == 1
+    route(router, udpPacket(100, dst="192.168.1.1"))
+    assert queued(router, alice) == 2
+
+def test_address_stays_with_client():
+    router = PacketRouter(TUN())
+    alice, bob = Session("192.0.2.1"), Session("192.0.2.2")
+    router.register(alice)
+    router.register(bob)
+    router.learn(bob, udpPacket(100, src="10.1.0.3"))
+    router.unregister(bob)
+    # bob is gone, alice doesn't get his packets
+    route(router, udpPacket(100, dst="10.1.0.3"))
+    assert queued(router, alice) == 0
+    # bob's next session does, before sending from that address
+    again = Session("192.0.2.2")
+    router.register(again)
+    route(router, udpPacket(100, dst="10.1.0.3"))
+    assert (queued(router, alice), queued(router, again)) == (0, 1)
+
+def test_ipv6_within_prefix():
+    router = PacketRouter(TUN(), ipv6="fd00:1::/64")
+    alice, bob = Session("192.0.2.1"), Session("192.0.2.2")
+    router.register(alice)
+    router.register(bob)
+    router.learn(alice, ipv6Packet(bytes(20), src="fd00:1::2"))
+    router.learn(bob, ipv6Packet(bytes(20), src="fd00:2::3"))
+    assert list(router.addresses) == [
+        socket.inet_pton(socket.AF_INET6, "fd00:1::2")]
+    route(router, ipv6Packet(bytes(20), dst="fd00:1::2"))
+    assert (queued(router, alice), queued(router, bob)) == (1, 0)
+    # without a prefix, none are learned
+    router = PacketRouter(TUN())
+    router.register(alice)
+    router.learn(alice, ipv6Packet(bytes(20), src="fd00:1::2"))
+    assert not router.addresses
+
+def test_invalid_prefix():
+    for prefix in ["fd00::", "fd00::/129", "10.1.0.0/24"]:
+        with pytest.raises(Exception):
+            parsePrefix(prefix)
+
+def test_flow_sticks_to_session():
+    router = PacketRouter(TUN())
+    sessions = [Session("192.0.2.1") for i in range(4)]
+    for each in sessions: router.register(each)
+    for i in range(20): route(router, udpPacket(100, sport=1234))
+    assert sorted([queued(router, each) for each in sessions]) == \
+        [0, 0, 0, 20]
+
+def test_unregister_reroutes_queued():
+    router = PacketRouter(TUN())
+    first, second = Session("192.0.2.1"), Session("192.0.2.1")
+    router.register(first)
+    router.register(second)
+    router.learn(first, udpPacket(100, src="10.1.0.2"))
+    router.learn(second, udpPacket(100, src="10.1.0.2"))
+    for port in range(1000, 1020):
+        route(router, udpPacket(100, sport=port, dst="10.1.0.2"))
+    router.queues[second].put_nowait(udpPacket(100))    # some waiting
+    before = queued(router, first) + queued(router, second)
+    router.unregister(first)
+    assert first not in router.queues
+    assert queued(router, second) == before
+    assert router.addresses[socket.inet_aton("10.1.0.2")] == [second]
+    router.unregister(second)
+    assert not router.addresses and not router.clients
+
+def test_queued_packets_routed_on_register():
+    # packets queued while nobody was connected go to whom they're for
+    tun = TUN()
+    router = PacketRouter(tun)
+    alice, bob = Session("192.0.2.1"), Session("192.0.2.2")
+    router.register(alice)
+    router.learn(alice, udpPacket(100, src="10.1.0.2"))
+    router.unregister(alice)
+    router.register(bob)
+    router.learn(bob, udpPacket(100, src="10.1.0.3"))
+    router.unregister(bob)
+    for i in range(3): route(router, udpPacket(100, dst="10.1.0.2"))
+    route(router, udpPacket(100, dst="10.1.0.3"))
+    assert tun.toWSQueue.qsize() == 4
+    again = Session("192.0.2.2")
+    router.register(again)
+    assert queued(router, again) == 1
+    assert tun.toWSQueue.qsize() == 0
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import asyncio
+
+import pytest
+
+from sizzler.util.runtime import useEventLoop, tuneEventLoop, tuneSocket
+
+
+@pytest.fixture
+def eventLoop():
+    # the event loop set by a test, closed and reset afterwards
+    yield
+    asyncio.get_event_loop_policy().get_event_loop().close()
+    asyncio.set_event_loop_policy(None)
+
+
+class Connection:
+
+    # stands for a WebSocket connection, as far as its socket is concerned
+
+    def __init__(self, sock):
+        self.transport = self
+        self.sock = sock
+
+    def get_extra_info(self, name):
+        return self.sock if name == "socket" else None
+
+
+def test_stock_event_loop(eventLoop):
+    assert useEventLoop("asyncio") == "asyncio"
+    loop = asyncio.get_event_loop_policy().get_event_loop()
+    assert type(loop).__module__.startswith("asyncio")
+
+def test_uvloop_event_loop(eventLoop):
+    pytest.importorskip("uvloop")
+    assert useEventLoop("auto") == "uvloop"
+    assert useEventLoop("uvloop") == "uvloop"
+
+def test_unknown_event_loop():
+    with pytest.raises(Exception):
+        useEventLoop("trio")
+
+def test_executor_threads():
+    loop = asyncio.new_event_loop()
+    try:
+        tuneEventLoop(loop, executor=3)
+        affinities = loop.run_until_complete(asyncio.gather(*[
+            loop.run_in_executor(None, os.sched_getaffinity, 0)
+            for i in range(6)
+        ]))
+        # executor threads may use all CPUs of the process
+        assert all([each == os.sched_getaffinity(0) for each in affinities])
+        assert loop._default_executor._max_workers == 3
+    finally:
+        loop.close()
+
+def test_tune_socket():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    sock = socket.create_connection(server.getsockname())
+    try:
+        tuneSocket(Connection(sock), sndbuf=65536, rcvbuf=65536)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 65536
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        tuneSocket(Connection(sock), nodelay=False)
+        assert not sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        sock.close()
+        server.close()
+    # connections without a socket are left alone
+    tuneSocket(Connection(None))
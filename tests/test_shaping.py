@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+
+import pytest
+
+from sizzler import shaping
+from sizzler.shaping import TokenBucket, Shaping, getShaper
+
+
+class Clock:
+
+    # stands for the time module as used by shaping, moved on by hand
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shaping, "time", clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_rate(clock):
+    bucket = TokenBucket(1000, 3000)
+    assert [bucket.take(1000) for i in range(3)] == [0, 0, 0]
+    # in debt, until paid at `rate`
+    assert bucket.take(500) == pytest.approx(0.5)
+    clock.now += 1.5
+    assert bucket.take(1000) == 0
+    # tokens never exceed the burst, however long idle
+    clock.now += 100
+    assert bucket.take(3000) == 0
+    assert bucket.take(1) > 0
+
+def test_no_limits_no_shaper():
+    assert getShaper([None, None]) is None
+    send, receive = Shaping().acquire("client")
+    assert send is None and receive is None
+
+def test_sessions_of_client_share_buckets(clock):
+    limits = Shaping(clientSend=1000, clientBurst=2000)
+    first = limits.acquire("client")[0]
+    second = limits.acquire("client")[0]
+    other = limits.acquire("other")[0]
+    async def main():
+        await first(2000)
+        # the client's burst is used up, by whichever session
+        sleeping = asyncio.ensure_future(second(1000))
+        await asyncio.sleep(0)
+        assert not sleeping.done()
+        sleeping.cancel()
+        # another client is limited on its own
+        await asyncio.wait_for(other(2000), 0.1)
+    asyncio.run(main())
+
+def test_session_and_client_limits(clock):
+    limits = Shaping(
+        sessionSend=1000, sessionBurst=1000,
+        clientSend=100000, clientBurst=100000
+    )
+    send, receive = limits.acquire("client")
+    assert receive is None
+    async def main():
+        await send(1000)
+        clock.now += 0.5        # half the session's bucket refilled
+        sleeping = asyncio.ensure_future(send(1000))
+        await asyncio.sleep(0)
+        assert not sleeping.done()
+        sleeping.cancel()
+    asyncio.run(main())
+
+def test_release_forgets_client():
+    limits = Shaping(clientReceive=1000)
+    limits.acquire("client")
+    limits.acquire("client")
+    limits.release("client")
+    assert "client" in limits.clients
+    limits.release("client")
+    assert limits.clients == {}
+    limits.release("unknown")
+
+def test_shaper_limits_rate():
+    # frames of 1000 bytes at 50000 bytes/s, after a burst of 2000 bytes
+    send = getShaper([TokenBucket(50000, 2000)])
+    async def main():
+        started = time.monotonic()
+        for i in range(7): await send(1000)
+        return time.monotonic() - started
+    assert 0.09 <= asyncio.run(main()) < 0.5
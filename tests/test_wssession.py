@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+
+from sizzler.packetqueue import PacketQueue
+from sizzler.crypto.padding import RandomPadding
+from sizzler.transport._resume import ResumeStore, RESUME_ACK_FRAMES
+from sizzler.transport._wssession import WebsocketSession, CONTROL_HEAD, \
+    CONTROL_MESSAGES, CONTROL_PING, CONTROL_PONG, PING_ACTIVE, isGreeting
+
+from packets import udpPacket
+
+KEY = "test"
+
+
+class Connection:
+
+    # one end of a WebSocket connection within the process, delivering
+    # messages to `peer` after `delay` seconds
+
+    def __init__(self, delay=0.001):
+        self.delay = delay
+        self.inbox = asyncio.Queue()
+        self.peer = None
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+        if self.peer:
+            asyncio.get_event_loop().call_later(
+                self.delay, self.peer.inbox.put_nowait, data)
+
+    async def recv(self):
+        return await self.inbox.get()
+
+    async def ping(self):
+        return asyncio.get_event_loop().create_future()
+
+
+def newSession(websocket=None, path="/?_=test", **kwargs):
+    return WebsocketSession(
+        websocket=websocket or Connection(),
+        path=path,
+        key=KEY,
+        fromWSQueue=asyncio.Queue(),
+        toWSQueue=PacketQueue(),
+        cryptoStrategy="inline",
+        **kwargs
+    )
+
+def control(*messages):
+    # a control frame with `messages` of (type, body) as given
+    frame = [b"c-", bytes([len(messages)])]
+    for kind, body in messages:
+        frame.append(CONTROL_HEAD.pack(kind, len(body)))
+        frame.append(body)
+    return b"".join(frame)
+
+def ping(session, digest=None):
+    return (CONTROL_PING, CONTROL_MESSAGES[CONTROL_PING].pack(
+        time.time(), PING_ACTIVE, digest or session.connectionDigest))
+
+def received(session, frame):
+    result = session._WebsocketSession__controlReceived(frame)
+    return None if result is None else bytes(result)
+
+
+def test_control_with_frame_along():
+    async def main():
+        session = newSession()
+        frame = control(ping(session)) + b"d-data"
+        assert received(session, frame) == b"d-data"
+        assert session.peerControl and session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_unknown_messages_skipped():
+    async def main():
+        session = newSession()
+        frame = control(
+            (99, b"abc"),
+            ping(session),
+            (100, b""),
+        ) + b"d-x"
+        assert received(session, frame) == b"d-x"
+        assert session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_truncated():
+    async def main():
+        session = newSession()
+        complete = control(ping(session))
+        for length in range(len(complete)):
+            assert not received(session, complete[:length])
+        # more messages announced than there are
+        assert received(session, b"c-\x02" + complete[3:] + b"d-x") is None
+        assert not session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_oversized_messages():
+    # messages longer than known are parsed, and their rest skipped, so
+    # that later versions may extend them
+    async def main():
+        session = newSession()
+        kind, body = ping(session)
+        frame = control(
+            (kind, body + b"future"),
+            (CONTROL_PONG, bytes(16) + b"more"),
+        ) + b"d-x"
+        assert received(session, frame) == b"d-x"
+        assert session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_undersized_message_ignored():
+    async def main():
+        session = newSession()
+        kind, body = ping(session)
+        assert received(session, control((kind, body[:5])) + b"d-x") == b"d-x"
+        assert not session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_ping_of_other_connection():
+    async def main():
+        session = newSession()
+        frame = control(ping(session, bytes(16))) + b"d-x"
+        assert received(session, frame) is None
+        assert not session.peerAuthenticated
+    asyncio.run(main())
+
+def test_control_maximum_size():
+    # as many messages as the count allows, each at its maximum length
+    async def main():
+        session = newSession()
+        messages = [(200, bytes(255))] * 254 + [ping(session)]
+        frame = control(*messages) + b"d-x"
+        assert received(session, frame) == b"d-x"
+        assert session.peerAuthenticated
+    asyncio.run(main())
+
+
+def test_collect_stops_when_queue_turns_out_empty():
+    # a queue may not be empty(), and still have nothing to get, e.g. as
+    # CoDel dropped all it had
+    class Queue:
+        def __init__(self): self.packets = [udpPacket(100)]
+        def empty(self): return False
+        async def get(self): return self.packets.pop()
+        def get_nowait(self): raise asyncio.QueueEmpty()
+
+    async def main():
+        session = newSession(aggregateBytes=4000, aggregateLinger=1)
+        session.toWSQueue = Queue()
+        collect = session._WebsocketSession__collectFromQueue
+        return await asyncio.wait_for(collect(), 0.5)
+    assert asyncio.run(main()) == [udpPacket(100)]
+
+
+def test_acknowledgement_ends_with_session():
+    # an acknowledgement still being sent doesn't outlive its session
+    class Stalling(Connection):
+        stalled = False
+        async def send(self, data):
+            if self.stalled: await asyncio.get_event_loop().create_future()
+            await Connection.send(self, data)
+
+    async def main():
+        connection = Stalling()
+        session = newSession(connection, resumeStore=ResumeStore(100))
+        session._WebsocketSession__bindResume("ab" * 16)
+        task = asyncio.ensure_future(session)
+        await asyncio.sleep(0.01)
+        connection.stalled = True
+        accept = session._WebsocketSession__acceptSequence
+        for i in range(3 * RESUME_ACK_FRAMES): accept(i + 1)
+        acknowledging = session._WebsocketSession__acknowledging
+        await asyncio.sleep(0.01)
+        assert not acknowledging.done()
+        # one at a time
+        assert len([
+            each for each in asyncio.all_tasks()
+            if "sendAcknowledgement" in repr(each.get_coro())
+        ]) == 1
+        task.cancel()
+        await asyncio.sleep(0.01)
+        assert acknowledging.cancelled()
+    asyncio.run(main())
+
+
+def test_greeting():
+    async def main():
+        connection = Connection()
+        session = newSession(connection, path="/?_=abcd")
+        await session._WebsocketSession__sendHeartbeat()
+        decryptor = session.decryptor
+        raw = await decryptor(connection.sent[0])
+        assert isGreeting(raw, "/?_=abcd")
+        assert not isGreeting(raw, "/?_=abce")
+        # data is no greeting
+        data = await session.encryptor(session.padder.pad(b"d-", b"x"))
+        assert not isGreeting(await decryptor(data), "/?_=abcd")
+    asyncio.run(main())
+
+
+def test_sessions_negotiate_control_frames():
+    async def main():
+        a, b = Connection(), Connection()
+        a.peer, b.peer = b, a
+        client = newSession(a, heartbeatInterval=0.05)
+        server = newSession(b, heartbeatInterval=0.05, activateByPeer=True)
+        tasks = [asyncio.ensure_future(each) for each in [client, server]]
+        client.activate()
+        try:
+            for i in range(10): client.toWSQueue.put_nowait(udpPacket(100))
+            await asyncio.sleep(0.3)
+            frames, padder = [], RandomPadding()
+            for each in a.sent:
+                raw = padder.unpad(await server.decryptor(each))
+                frames.append(bytes(raw[:2]))
+        finally:
+            for each in tasks: each.cancel()
+        assert client.peerControl and server.peerControl
+        assert server.fromWSQueue.qsize() == 10
+        # heartbeats start in the form every peer knows
+        assert frames[0] == b"h-"
+        assert b"c-" in frames
+        assert client.rtt is not None
+    asyncio.run(main())